@@ -0,0 +1,837 @@
+"""
+Бенчмарки контроллера на локальном имитаторе ESP32.
+
+Использование:
+  python3 benchmark.py suite [--duration 60] [--latency 0.02] [--jitter 0.01] [--error-rate 0.01] [--output bench.json]
+  python3 benchmark.py compare old.json new.json
+  python3 benchmark.py fleet [--nodes 1,10,50,100,200] [--duration 10] [--interval 1] [--shards N]
+  python3 benchmark.py parse [--fuzz 100000] [--seed 3]
+  python3 benchmark.py detectors
+  python3 benchmark.py dashboard [--clients 100] [--duration 20] [--nodes 10]
+  python3 benchmark.py startup [--repeat 5]
+"""
+import argparse
+import asyncio
+import functools
+import io
+import json
+import math
+import os
+import platform
+import queue
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import fancontroller as fc
+
+# ======================== Имитатор ESP32 ===========================
+
+# Уровни датчиков в чистом воздухе и их шум - как в synthetic_trace
+FAKE_LEVELS = {"ppm": (12.5, 0.3), "cur": (3.2, 0.05), "mq2": (1200.0, 10.0)}
+# Относительный рост уровня на пике задымления
+FAKE_SMOKE_GAIN = {"ppm": 1.0, "cur": 1.2, "mq2": 0.5}
+# Вентиляторы: обороты на 1% скорости и постоянная скорость вентиляторов 1 и 2
+FAKE_RPM_PER_PERCENT = 30
+FAKE_FAN_PERCENT = 50
+
+class FakeESP32:
+    """
+    Локальная замена HTTP API прошивки (/getSmoke, /getAnalogRead34, /set3, /get1../get3, /remtime).
+    Один event loop в отдельном потоке обслуживает любое число узлов, каждый на своём порту.
+    latency и jitter - задержка ответа (секунды, разброс ±jitter), error_rate - доля ответов
+    HTTP 500, noise - множитель шума датчиков. events - сценарий задымления
+    [(начало, длительность), ...] в секундах от start(): рост за ~20 с, затухание за ~5 мин.
+    stalled - номера узлов, у которых вентилятор 3 принимает команды, но не вращается.
+    """
+    def __init__(self, nodes=1, host="127.0.0.1", latency=0.0, jitter=0.0, error_rate=0.0,
+                 noise=0.0, events=(), seed=0, stalled=()):
+        self.host = host
+        self.nodes = nodes
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.noise = noise
+        self.events = list(events)
+        self.stalled = set(stalled)
+        self.ports = []
+        self.fan = {}
+        self.requests = 0
+        self.errors = 0
+        self.started = None
+        self._rng = random.Random(seed)
+        self._loop = asyncio.new_event_loop()
+        self._servers = []
+        self._handlers = set()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+
+    @property
+    def urls(self):
+        return [f"http://{self.host}:{port}" for port in self.ports]
+
+    def start(self):
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start_servers(), self._loop).result()
+        self.started = time.time()
+        return self
+
+    def stop(self):
+        async def _close():
+            for server in self._servers:
+                server.close()
+            # Открытые keep-alive соединения закрываются явно, иначе их задачи гибнут вместе с loop
+            for task in list(self._handlers):
+                task.cancel()
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+        asyncio.run_coroutine_threadsafe(_close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _start_servers(self):
+        for node in range(self.nodes):
+            server = await asyncio.start_server(
+                lambda r, w, node=node: self._handle(node, r, w), self.host, 0)
+            self._servers.append(server)
+            self.ports.append(server.sockets[0].getsockname()[1])
+
+    def smoke(self, t):
+        """Интенсивность задымления (0..1) через t секунд после start()."""
+        level = 0.0
+        for start, duration in self.events:
+            dt = t - start
+            if 0 <= dt < duration:
+                level += min(dt / 20, 1) * math.exp(-max(dt - 20, 0) / 300)
+        return level
+
+    def level(self, sensor, t):
+        base, sigma = FAKE_LEVELS[sensor]
+        value = base * (1 + FAKE_SMOKE_GAIN[sensor] * self.smoke(t))
+        return value + self._rng.gauss(0, sigma * self.noise) if self.noise else value
+
+    def reading(self, node, path):
+        t = time.time() - self.started
+        if path.startswith("/getSmoke"):
+            return f"avg:1.00  cur:{self.level('cur', t):.2f} ppm:{self.level('ppm', t):.2f}"
+        if path.startswith("/getAnalogRead34"):
+            return f"{self.level('mq2', t):.0f}"
+        if path.startswith("/set3"):
+            self.fan[node] = int(path.partition("s3=")[2] or 0)
+            return str(self.rpm(node))
+        if path.startswith("/get3"):
+            return f"{self.rpm(node)},{self.fan.get(node, 0)}"
+        if path.startswith(("/get1", "/get2")):
+            return f"{FAKE_FAN_PERCENT * FAKE_RPM_PER_PERCENT},{FAKE_FAN_PERCENT}"
+        if path.startswith("/remtime"):
+            return "0"
+        return None
+
+    def rpm(self, node):
+        return 0 if node in self.stalled else self.fan.get(node, 0) * FAKE_RPM_PER_PERCENT
+
+    async def _handle(self, node, reader, writer):
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                path = request_line.split()[1].decode()
+                self.requests += 1
+                delay = self.latency + (self._rng.uniform(-self.jitter, self.jitter) if self.jitter else 0)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if self.error_rate and self._rng.random() < self.error_rate:
+                    self.errors += 1
+                    status, body = "500 Internal Server Error", "error"
+                else:
+                    body = self.reading(node, path)
+                    status = "200 OK" if body is not None else "404 Not Found"
+                    body = body or "Not found"
+                body = body.encode()
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain\r\n"
+                             f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+            self._handlers.discard(task)
+
+def prepare_controller(ctrl):
+    """Базовые уровни имитатора вместо 40-секундной калибровки: детекция работает с первого отсчёта."""
+    ctrl.baseline_ppm, ctrl.baseline_cur, ctrl.baseline_mq2 = (FAKE_LEVELS[s][0] for s in ("ppm", "cur", "mq2"))
+    ctrl.sensor_warmed_up = True
+    ctrl.last_calibration_time = ctrl.clock()
+    ctrl.log_sink = lambda msg: None
+    return ctrl
+
+# ======================== Вспомогательные ===========================
+
+def stats(seconds):
+    """Сводка замеров (секунды) в миллисекундах."""
+    if not len(seconds):
+        return {"n": 0}
+    ms = np.asarray(seconds) * 1000
+    return {"n": int(len(ms)), "mean_ms": float(ms.mean()), "p50_ms": float(np.percentile(ms, 50)),
+            "p99_ms": float(np.percentile(ms, 99)), "max_ms": float(ms.max())}
+
+def rss_kb():
+    """Резидентная память процесса, КБ (VmRSS из /proc; None вне Linux)."""
+    try:
+        with open("/proc/self/status") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith("VmRSS"))
+    except (OSError, StopIteration):
+        return None
+
+def trace_samples(trace, n=None):
+    return [fc.Sample(ts, ppm, cur, mq2, False, False, 0.0, 0.0)
+            for ts, ppm, cur, mq2 in zip(*(trace[k][:n].tolist() for k in ("ts", "ppm", "cur", "mq2")))]
+
+def fake_readings(n, seed=2):
+    """Отсчёты для отрисовки: шум вокруг уровней имитатора, периодическая тревога."""
+    rng = np.random.default_rng(seed)
+    thresholds = fc.compute_thresholds(*(FAKE_LEVELS[s][0] for s in ("mq2", "ppm", "cur")))
+    noise = rng.normal(0, 1, (n, 3))
+    start = time.time()
+    for i in range(n):
+        ppm, cur, mq2 = (FAKE_LEVELS[s][0] + 3 * FAKE_LEVELS[s][1] * noise[i, k]
+                         for k, s in enumerate(("ppm", "cur", "mq2")))
+        sample = fc.Sample(start + i * fc.INTERVAL, ppm, cur, mq2, False, False, 0.01, 0.01)
+        alarm = i % 100 >= 90
+        yield fc.Reading(sample, (ppm, cur, mq2), (mq2, ppm, cur), thresholds, alarm,
+                         60 if alarm else 20, 60 if alarm else 20, 1800.0 if alarm else 600.0, fc.INTERVAL)
+
+# ======================== Бенчмарки ===========================
+
+def parse_smoke_reference(text):
+    """Прежний разбор /getSmoke (re.search без компиляции) - эталон для сравнения в бенчмарке и fuzz."""
+    ppm_match = re.search(r'ppm:(\d+\.?\d*)', text)
+    cur_match = re.search(r'cur:(\d+\.?\d*)', text)
+    if ppm_match and cur_match:
+        return float(ppm_match.group(1).replace(',', '.')), float(cur_match.group(1).replace(',', '.'))
+    return np.nan, np.nan
+
+def firmware_responses(rng, n):
+    """Ответы прошивки: /getSmoke, /get1../get3, /getAnalogRead34 и /remtime."""
+    return {
+        "smoke": [f"avg:{rng.uniform(0, 5):.2f}  cur:{rng.uniform(0, 10):.2f} ppm:{rng.uniform(0, 100):.2f}"
+                  for _ in range(n)],
+        "rpm": [f"{rng.randrange(11000)},{rng.randrange(101)}" for _ in range(n)],
+        "number": [str(rng.randrange(4096)) for _ in range(n)],
+    }
+
+def bench_parse(n=20000):
+    """Разбор ответов прошивки каждым разборщиком; каждый 50-й ответ испорчен."""
+    rng = random.Random(1)
+    parsers = {"smoke": fc.parse_smoke, "smoke_reference": parse_smoke_reference,
+               "rpm": fc.parse_rpm, "number": fc.parse_number}
+    responses = firmware_responses(rng, n)
+    responses["smoke_reference"] = responses["smoke"]
+    results = {}
+    for name, parse in parsers.items():
+        texts = list(responses[name])
+        texts[::50] = ["garbage"] * len(texts[::50])
+        times = []
+        for text in texts:
+            start = time.perf_counter()
+            parse(text)
+            times.append(time.perf_counter() - start)
+        results[name] = stats(times)
+    return results
+
+# Символы для порчи ответов: цифры и разделители формата, управляющие, не-ASCII
+FUZZ_ALPHABET = "0123456789.,:- \t\r\n\x00naifovcurpmgAVG\u00a0\u0661\ufffdдым"
+FUZZ_TOKENS = ("nan", "inf", "ovf", "-1", "1e5", "1,5", "0x1f", "9" * 400, "", "  ")
+
+def mutate(text, rng):
+    """Случайная порча ответа: обрезка, вставки, замены, повторы, подмена числа, длинные числа."""
+    kind = rng.randrange(8)
+    i = rng.randrange(len(text) + 1)
+    if kind == 0:
+        return text[:i]
+    if kind == 1:
+        return text[:i] + text[i + 1:]
+    if kind == 2:
+        return text[:i] + "".join(rng.choice(FUZZ_ALPHABET) for _ in range(rng.randint(1, 4))) + text[i:]
+    if kind == 3:
+        return text[:i] + rng.choice(FUZZ_ALPHABET) + text[i + 1:]
+    if kind == 4:
+        j = rng.randrange(len(text) + 1)
+        return text[:max(i, j)] + text[min(i, j):]
+    if kind == 5:
+        return re.sub(r"\d+\.?\d*", lambda m: rng.choice(FUZZ_TOKENS) if rng.random() < 0.5 else m[0], text)
+    if kind == 6:
+        return bytes(rng.randrange(256) for _ in range(rng.randint(0, 40))).decode("utf-8", "replace")
+    return text[:i] + text[i:] * rng.randint(2, 5)
+
+def fuzz_parsers(n=20000, seed=3):
+    """
+    Разборщики на испорченных ответах прошивки. Проверяется: нет исключений; результат -
+    float, nan или конечное неотрицательное число; parse_smoke совпадает с прежней реализацией,
+    кроме случаев, когда та возвращала inf (там должен быть nan). Неиспорченные ответы
+    разбираются точно. Возвращает счётчики и первые примеры нарушений.
+    """
+    rng = random.Random(seed)
+    parsers = {"smoke": fc.parse_smoke, "rpm": fc.parse_rpm, "number": fc.parse_number}
+    responses = firmware_responses(rng, n)
+    counts = {"cases": 0, "exceptions": 0, "invalid": 0, "mismatches": 0}
+    examples = []
+
+    def fail(kind, name, text, detail):
+        counts[kind] += 1
+        if len(examples) < 10:
+            examples.append(f"{kind} {name}: {text[:60]!r} -> {detail}")
+
+    for name, parse in parsers.items():
+        for clean in responses[name]:
+            expected = parse(clean)
+            exact = tuple(float(v) for v in re.findall(r"\d+\.?\d*", clean))
+            if name == "smoke":
+                exact = exact[2:0:-1]
+            if (expected if isinstance(expected, tuple) else (expected,)) != exact[:2 if name != "number" else 1]:
+                fail("mismatches", name, clean, expected)
+            text = mutate(clean, rng)
+            counts["cases"] += 1
+            try:
+                result = parse(text)
+            except Exception as e:
+                fail("exceptions", name, text, repr(e))
+                continue
+            values = result if isinstance(result, tuple) else (result,)
+            if not all(isinstance(v, float) and (v != v or 0 <= v < math.inf) for v in values):
+                fail("invalid", name, text, result)
+            elif name == "smoke":
+                reference = parse_smoke_reference(text)
+                if math.inf in reference:
+                    if not all(v != v for v in result):
+                        fail("mismatches", name, text, f"{result} вместо nan")
+                elif not (result == reference or all(v != v for v in result + reference)):
+                    fail("mismatches", name, text, f"{result} вместо {reference}")
+    # Ответы, собранные в Telemetry: частичные отказы не портят остальные поля
+    for _ in range(n // 10):
+        texts = [rng.choice((None, mutate(rng.choice(responses["rpm"]), rng), rng.choice(responses["rpm"])))
+                 for _ in range(3)] + [rng.choice((None, "0", mutate("15", rng)))]
+        counts["cases"] += 1
+        try:
+            telemetry = fc.parse_telemetry(0.0, texts)
+        except Exception as e:
+            fail("exceptions", "telemetry", repr(texts), repr(e))
+            continue
+        for endpoint, text, value in zip(fc.TELEMETRY_ENDPOINTS, texts,
+                                         (telemetry.rpm1, telemetry.rpm2, telemetry.rpm3, telemetry.remtime)):
+            if (endpoint in telemetry.failed) != (value != value) or (text is None and value == value):
+                fail("invalid", "telemetry", repr(texts), telemetry)
+                break
+    counts["examples"] = examples
+    return counts
+
+def bench_detection(n=20000):
+    """Обработка одного отсчёта (fallback, усреднение, детекторы, тревога) для каждого типа детектора."""
+    samples = trace_samples(fc.synthetic_trace(hours=n / 3600 + 0.5, events=1, spikes=5), n)
+    results = {}
+    for kind in fc.DETECTOR_TYPES:
+        clock = fc.ReplayClock(samples[0].ts)
+        ctrl = prepare_controller(fc.DeviceController("http://bench", clock=clock))
+        ctrl.command_sender = lambda c, value: None
+        ctrl.detectors = fc.make_detectors({sensor: kind for sensor in fc.DETECTORS})
+        times = []
+        for sample in samples:
+            clock.now = sample.ts
+            start = time.perf_counter()
+            ctrl.process(sample)
+            times.append(time.perf_counter() - start)
+        results[kind] = stats(times)
+    return results
+
+def check_detector_rearm(seed=4):
+    """
+    Повторное срабатывание статистических детекторов: подъём +12% (срабатывание, disarm как
+    в начале тревоги), удержание, медленный спад к baseline, чистый сигнал и новый подъём +10%.
+    Процентный порог не мешает (inf). Возвращает {тип: номера отсчётов срабатываний}; детектор
+    исправен, если сработал на обоих подъёмах.
+    """
+    baseline = 1200.0
+    levels = ([1.0] * 300 + [1.12] * 600 + [1.12 - 0.12 * k / 600 for k in range(600)]
+              + [1.0] * 3000 + [1.10] * 50)
+    second = len(levels) - 50
+    results = {}
+    for kind in fc.DETECTOR_TYPES:
+        if kind == "threshold":
+            continue
+        rng = random.Random(seed)
+        detector = fc.DETECTOR_TYPES[kind]()
+        fires = []
+        for i, level in enumerate(levels):
+            x = baseline * level + rng.gauss(0, 3)
+            if detector.update(x, x, baseline, math.inf):
+                fires.append(i)
+                detector.disarm()
+        results[kind] = {"fires": fires, "ok": any(300 <= i < 350 for i in fires) and any(i >= second for i in fires)}
+    return results
+
+def bench_terminal(n=2000):
+    """Кадр терминального режима: сборка строк и diff-вывод (в буфер вместо терминала)."""
+    renderer, log_tail = fc.TerminalRenderer(stream=io.StringIO()), fc.LogTail()
+    times = []
+    for reading in fake_readings(n):
+        fc.trend.append(reading.sample.ts, reading.values[2])
+        start = time.perf_counter()
+        fc.update_terminal(renderer, reading, log_tail)
+        times.append(time.perf_counter() - start)
+        renderer.stream.seek(0)
+        renderer.stream.truncate()
+    return stats(times)
+
+def bench_gui(n=300, window=fc.GUI_WINDOW, backfill=0):
+    """
+    Кадр GUI (блиттинг и полные перерисовки) на Agg без окна; None без matplotlib.
+    backfill - секунд истории до первого кадра, window - окно графиков в секундах.
+    """
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        figure = fc.build_figure()
+    except ImportError:
+        return None
+    data_queue = queue.Queue()
+    history = fc.LODHistory()
+    if backfill:
+        ts = time.time() - np.arange(int(backfill / fc.INTERVAL), 0, -1) * fc.INTERVAL
+        noise = np.random.default_rng(4).normal(0, 1, (3, len(ts)))
+        history.extend(ts, *(FAKE_LEVELS[s][0] + FAKE_LEVELS[s][1] * noise[k] for k, s in enumerate(("ppm", "cur", "mq2"))))
+    renderer = fc.BlitRenderer(figure, data_queue, history)
+    renderer.window = window
+    renderer.frame_times = []
+    figure.fig.canvas.draw()
+    for reading in fake_readings(n):
+        data_queue.put(reading)
+        renderer.frame()
+        if renderer._background is None:
+            figure.fig.canvas.draw()  # draw_idle на Agg откладывается - рисуем сразу, как окно
+    return stats(renderer.frame_times)
+
+def bench_lod(windows=(600, 3600, 86400, 7 * 86400), width=800, repeat=200):
+    """Запрос линии из LODHistory для окон разной длины при неделе истории: стоимость и число точек."""
+    history = fc.LODHistory()
+    n = int(7 * 86400 / fc.INTERVAL)
+    ts = 1_700_000_000 + np.arange(n) * fc.INTERVAL
+    mq2 = FAKE_LEVELS["mq2"][0] + FAKE_LEVELS["mq2"][1] * np.random.default_rng(5).normal(0, 1, n)
+    mq2[n // 3] *= 3  # одиночный выброс должен остаться на графике любого окна, которое его включает
+    history.extend(ts, mq2, mq2, mq2)
+    results = {}
+    for window in windows:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            x, y = history.series("mq2", ts[-1] - window, ts[-1], width)
+            times.append(time.perf_counter() - start)
+        spike_in_window = ts[n // 3] >= ts[-1] - window
+        results[f"{window}s"] = dict(stats(times), points=len(x),
+                                     spike_kept=bool(np.nanmax(y) == mq2[n // 3]) if spike_in_window else None)
+    return results
+
+def bench_memory(samples, checkpoints=5):
+    """
+    Рост памяти на длинном прогоне: отсчёты идут через контроллер с записью истории
+    на диск (во временный каталог), RSS снимается в контрольных точках.
+    """
+    clock = fc.ReplayClock(1_700_000_000.0)
+    ctrl = prepare_controller(fc.DeviceController("http://bench", clock=clock))
+    ctrl.command_sender = lambda c, value: None
+    step = max(samples // checkpoints, 1)
+    noise = np.random.default_rng(3).normal(0, 1, (step, 3)).tolist()
+    points = []
+    with tempfile.TemporaryDirectory() as root:
+        ctrl.recorder = fc.HistoryStore(root)
+        for done in range(step, samples + 1, step):
+            for n_ppm, n_cur, n_mq2 in noise:
+                clock.now += fc.INTERVAL
+                ctrl.process(fc.Sample(clock.now, 12.5 + 0.3 * n_ppm, 3.2 + 0.05 * n_cur, 1200 + 10 * n_mq2,
+                                       False, False, 0.0, 0.0))
+            ctrl.recorder.flush()
+            points.append((done, rss_kb()))
+    growth = None
+    if len(points) > 1 and points[0][1] is not None:
+        # Первая точка - после прогрева (кэши, буферы); рост считается от неё
+        growth = (points[-1][1] - points[0][1]) / (points[-1][0] - points[0][0]) * 100_000
+    return {"samples": points[-1][0] if points else 0, "rss_kb": [p[1] for p in points],
+            "growth_kb_per_100k_samples": growth}
+
+def bench_loop(duration, interval, nodes, latency, jitter, error_rate, noise, event_start=20.0):
+    """
+    Сквозной цикл на имитаторе: HTTP-опрос, разбор, детекция, команды вентилятору.
+    Тик - от начала опроса до конца обработки отсчёта. Через event_start секунд на всех
+    узлах начинается задымление; задержка обнаружения - от начала события до тревоги.
+    """
+    server = FakeESP32(nodes, latency=latency, jitter=jitter, error_rate=error_rate, noise=noise,
+                       events=[(event_start, 900)]).start()
+    scheduler = fc.FleetScheduler([(f"node{i}", url) for i, url in enumerate(server.urls)], interval=interval)
+    polls, ticks, detected = [], [], {}
+    stale = 0
+    for ctrl in scheduler.controllers:
+        prepare_controller(ctrl)
+        poll, process = ctrl.poller.poll, ctrl.process
+
+        async def timed_poll(ctrl=ctrl, poll=poll):
+            ctrl.tick_start = time.perf_counter()
+            sample = await poll()
+            polls.append(time.perf_counter() - ctrl.tick_start)
+            return sample
+
+        def timed_process(sample, ctrl=ctrl, process=process):
+            nonlocal stale
+            process(sample)
+            ticks.append(time.perf_counter() - ctrl.tick_start)
+            stale += sample.smoke_stale or sample.mq2_stale
+            if ctrl.smoke_detected and ctrl.name not in detected:
+                detected[ctrl.name] = time.time() - server.started - event_start
+        ctrl.poller.poll, ctrl.process = timed_poll, timed_process
+    rss_before = rss_kb()
+    start = time.perf_counter()
+    asyncio.run(scheduler.run(duration, calibrate=False, summary=False))
+    elapsed = time.perf_counter() - start
+    server.stop()
+    rss_after = rss_kb()
+    return {
+        "nodes": nodes,
+        "duration_s": elapsed,
+        "polls_per_sec": len(polls) / elapsed,
+        "poll": stats(polls),
+        "tick": stats(ticks),
+        "stale_ratio": stale / len(ticks) if ticks else None,
+        "server_requests": server.requests,
+        "server_errors": server.errors,
+        "fan_commands_sent": sum(c.actuator.sent for c in scheduler.controllers),
+        # Тревога до начала события - ложное срабатывание, а не обнаружение
+        "detection_latency_s": {"n": len(detected), "max": max(detected.values()), "min": min(detected.values())}
+                               if detected else None,
+        "rss_growth_kb": rss_after - rss_before if rss_before is not None else None,
+    }
+
+def bench_suite(args):
+    results = {}
+    print("Разбор ответов...")
+    results["parse"] = bench_parse()
+    fuzz = fuzz_parsers()
+    results["parse_fuzz"] = {k: v for k, v in fuzz.items() if k != "examples"}
+    print("Детекция...")
+    results["detection"] = bench_detection()
+    print("Кадр терминала...")
+    results["terminal_frame"] = bench_terminal()
+    print("Кадр GUI...")
+    results["gui_frame"] = bench_gui()
+    results["gui_frame_week"] = bench_gui(window=7 * 86400, backfill=7 * 86400)
+    print("Уровни детализации истории...")
+    results["lod_series"] = bench_lod()
+    print(f"Память на {args.memory_samples} отсчётах...")
+    results["memory"] = bench_memory(args.memory_samples)
+    print(f"Сквозной цикл, {args.duration:g} с...")
+    results["loop"] = bench_loop(args.duration, args.interval, args.nodes, args.latency, args.jitter,
+                                 args.error_rate, args.noise)
+    report = {"meta": run_meta(vars(args)), "results": results}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    for path, value in flatten(results).items():
+        print(f"  {path:<45} {value:>12.4f}")
+    print(f"Результаты: {args.output}")
+
+def run_meta(params):
+    """Условия прогона, чтобы результаты разных машин и ревизий можно было сопоставить."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit,
+            "python": platform.python_version(), "platform": platform.platform(),
+            "params": {k: v for k, v in params.items() if k != "bench"}}
+
+def flatten(data, prefix=""):
+    """Числовые значения вложенного словаря по составным ключам: {"loop.tick.p50_ms": ...}."""
+    flat = {}
+    for key, value in (data or {}).items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, path + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+def compare_reports(old_path, new_path):
+    """Сравнение двух прогонов suite по всем числовым показателям."""
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)
+    print(f"было: {old['meta']['commit']} ({old['meta']['time']}), стало: {new['meta']['commit']} ({new['meta']['time']})")
+    old_flat, new_flat = flatten(old["results"]), flatten(new["results"])
+    print(f"{'показатель':<45} {'было':>12} {'стало':>12} {'изменение':>10}")
+    for path in sorted(old_flat.keys() | new_flat.keys()):
+        a, b = old_flat.get(path), new_flat.get(path)
+        change = f"{(b - a) / abs(a):+.1%}" if a and b is not None else ""
+        print(f"{path:<45} {'-' if a is None else f'{a:.4f}':>12} {'-' if b is None else f'{b:.4f}':>12} {change:>10}")
+
+def bench_sharded(server, duration, interval, shards, warmup=3):
+    """
+    Парк под ShardSupervisor: узлы тёпло стартуют из снимков во временном каталоге, опросы
+    и задержки читаются из общей таблицы. Имитатор работает в этом же процессе (один поток),
+    поэтому на сотнях узлов он сам может стать узким местом.
+    """
+    devices = [(f"node{i}", url) for i, url in enumerate(server.urls)]
+    with tempfile.TemporaryDirectory() as snapshots:
+        for name, url in devices:
+            ctrl = prepare_controller(fc.DeviceController(url, name=name))
+            fc.save_snapshot(os.path.join(snapshots, f"{name}.json"), ctrl.snapshot())
+        supervisor = fc.ShardSupervisor(devices, shards=shards, interval=interval,
+                                        settings={"HISTORY_DIR": None, "SNAPSHOT_DIR": snapshots})
+        try:
+            for shard in range(supervisor.shards):
+                supervisor._spawn(shard)
+            time.sleep(warmup + fc.SNAPSHOT_VALIDATION_SAMPLES * fc.SNAPSHOT_VALIDATION_INTERVAL)
+            start, polls_before, latencies = time.perf_counter(), supervisor.table.read()["polls"].sum(), []
+            while time.perf_counter() - start < duration:
+                time.sleep(interval)
+                supervisor.check()
+                latencies.extend(supervisor.table.read()["latency"].tolist())
+            elapsed = time.perf_counter() - start
+            polls = supervisor.table.read()["polls"].sum() - polls_before
+        finally:
+            supervisor.stop()
+    return polls / elapsed, np.asarray(latencies)
+
+def bench_fleet(node_counts, duration, interval, shards=None):
+    """Опросов в секунду и задержка опроса в зависимости от числа узлов (с shards - по процессам)."""
+    print(f"{'узлов':>6} {'опросов/с':>10} {'ожидалось':>10} {'p50, мс':>8} {'p99, мс':>8}")
+    for nodes in node_counts:
+        server = FakeESP32(nodes).start()
+        if shards is not None:
+            rate, latencies = bench_sharded(server, duration, interval, shards)
+            server.stop()
+            print(f"{nodes:>6} {rate:>10.1f} {nodes / interval:>10.1f} "
+                  f"{np.nanpercentile(latencies, 50) * 1000:>8.2f} {np.nanpercentile(latencies, 99) * 1000:>8.2f}")
+            continue
+        scheduler = fc.FleetScheduler([(f"node{i}", url) for i, url in enumerate(server.urls)], interval=interval)
+        latencies = []
+        for ctrl in scheduler.controllers:
+            prepare_controller(ctrl)
+            poll = ctrl.poller.poll
+
+            async def timed_poll(poll=poll):
+                sample = await poll()
+                latencies.append(sample.latency)
+                return sample
+            ctrl.poller.poll = timed_poll
+        start = time.perf_counter()
+        asyncio.run(scheduler.run(duration, calibrate=False, summary=False))
+        elapsed = time.perf_counter() - start
+        server.stop()
+        polls = sum(c.polls for c in scheduler.controllers)
+        expected = nodes / interval if interval > 0 else float("nan")
+        print(f"{nodes:>6} {polls / elapsed:>10.1f} {expected:>10.1f} "
+              f"{np.percentile(latencies, 50) * 1000:>8.2f} {np.percentile(latencies, 99) * 1000:>8.2f}")
+
+async def dashboard_client(port, received, latencies, stop):
+    """Клиент WebSocket дашборда: считает сообщения и задержку доставки отсчётов (от начала опроса)."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET /ws HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                 f"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n".encode())
+    await reader.readuntil(b"\r\n\r\n")
+    try:
+        while not stop.is_set():
+            _, payload = await fc.ws_read_frame(reader, max_size=1 << 24)
+            now = time.time()
+            received[0] += 1
+            received[1] += len(payload)
+            for update in json.loads(payload).get("d", ()):
+                if update[0] == "s":
+                    latencies.append(now - update[2])
+    except (asyncio.IncompleteReadError, ConnectionError):
+        # Сервер отключает клиента, который не успевает читать
+        received[2] += not stop.is_set()
+    finally:
+        writer.close()
+
+def bench_dashboard(clients, duration, nodes, interval):
+    """
+    Цикл опроса с веб-дашбордом: сначала без клиентов, затем с clients подключениями WebSocket.
+    Клиенты работают в отдельном потоке со своим event loop (как браузеры - вне процесса опроса
+    по сети). Сравниваются запросы к ESP32, длительность тика, задержка event loop опроса и
+    задержка доставки отсчётов клиентам.
+    """
+    server = FakeESP32(nodes, latency=0.01).start()
+    dashboard = fc.dashboard if fc.dashboard.enabled else fc.enable_dashboard(0)
+    devices = [(f"node{i}", url) for i, url in enumerate(server.urls)]
+    results = {}
+    for phase, count in (("no_clients", 0), ("clients", clients)):
+        stop = threading.Event()
+        received, latencies = [[0, 0, 0] for _ in range(count)], []
+
+        async def connect_clients():
+            await asyncio.gather(*(dashboard_client(dashboard.port, r, latencies, stop) for r in received))
+        thread = threading.Thread(target=asyncio.run, args=(connect_clients(),), daemon=True) if count else None
+        if thread:
+            thread.start()
+            deadline = time.time() + 10
+            while len(dashboard.clients) < count and time.time() < deadline:
+                time.sleep(0.05)
+        scheduler = fc.FleetScheduler(devices, interval=interval)
+        ticks, lags = [], []
+        for ctrl in scheduler.controllers:
+            prepare_controller(ctrl)
+            process = ctrl.process
+
+            def timed_process(sample, process=process):
+                start = time.perf_counter()
+                process(sample)
+                ticks.append(time.perf_counter() - start)
+            ctrl.process = timed_process
+
+        async def probe(step=0.05):
+            # Задержка пробуждения таймера - насколько цикл опроса занят чем-то ещё
+            while True:
+                start = time.perf_counter()
+                await asyncio.sleep(step)
+                lags.append(time.perf_counter() - start - step)
+
+        async def run():
+            task = asyncio.create_task(probe())
+            await scheduler.run(duration, calibrate=False, summary=False)
+            task.cancel()
+        requests, frames, sent = server.requests, dashboard.frames_sent, dashboard.bytes_sent
+        start = time.perf_counter()
+        asyncio.run(run())
+        elapsed = time.perf_counter() - start
+        results[phase] = {
+            "clients": len(dashboard.clients),
+            "esp32_requests_per_sec": (server.requests - requests) / elapsed,
+            "polls_per_sec": sum(c.polls for c in scheduler.controllers) / elapsed,
+            "process": stats(ticks),
+            "loop_lag": stats(lags),
+            "frames_sent": dashboard.frames_sent - frames,
+            "sent_kb_per_sec": (dashboard.bytes_sent - sent) / 1024 / elapsed,
+            "messages_per_client": float(np.mean([r[0] for r in received])) if count else None,
+            "disconnected": sum(r[2] for r in received),
+            "delivery": stats(latencies),
+        }
+        if thread:
+            stop.set()
+            for writer in list(dashboard.clients):
+                dashboard._loop.call_soon_threadsafe(writer.transport.abort)
+            thread.join(5)
+    server.stop()
+    base, loaded = results["no_clients"], results["clients"]
+    print(f"{'':<26} {'без клиентов':>14} {f'{clients} клиентов':>14}")
+    for label, key in (("запросов к ESP32 в с", ("esp32_requests_per_sec",)),
+                       ("опросов в с", ("polls_per_sec",)),
+                       ("process p50, мс", ("process", "p50_ms")), ("process p99, мс", ("process", "p99_ms")),
+                       ("задержка loop p99, мс", ("loop_lag", "p99_ms")),
+                       ("отправлено КБ/с", ("sent_kb_per_sec",)),
+                       ("доставка p50, мс", ("delivery", "p50_ms")), ("доставка p99, мс", ("delivery", "p99_ms"))):
+        a, b = (functools.reduce(lambda d, k: (d or {}).get(k), key, r) for r in (base, loaded))
+        print(f"{label:<26} {'-' if a is None else f'{a:.2f}':>14} {'-' if b is None else f'{b:.2f}':>14}")
+    print(f"сообщений на клиента: {loaded['messages_per_client'] or 0:.0f}, отключено: {loaded['disconnected']}")
+    return results
+
+# Что делает каждый режим до начала работы; выполняется в чистом интерпретаторе
+STARTUP_MODES = {
+    "python": "pass",
+    "import": "import fancontroller",
+    "daemon": "import fancontroller as fc; fc.FleetScheduler([('node', fc.URL)])",
+    "terminal": "import fancontroller as fc; fc.TerminalRenderer; fc.AcquisitionThread(fc.controller, None)",
+    "gui": "import fancontroller as fc; fc.build_figure()",
+}
+
+# Пиковая память - VmHWM из /proc: ru_maxrss на Linux наследуется от родителя через fork/exec
+STARTUP_CHILD = ("import time; _start = time.perf_counter(); {code}; _setup = time.perf_counter() - _start; "
+                 "print(_setup, next(l.split()[1] for l in open('/proc/self/status') if l.startswith('VmHWM')))")
+
+def bench_startup(repeat):
+    """Холодный старт каждого режима в отдельном процессе: время до готовности и пиковая память."""
+    env = dict(os.environ, MPLBACKEND="Agg")
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    print(f"{'режим':<10} {'процесс, мс':>12} {'импорт и настройка, мс':>23} {'RSS, МБ':>8}")
+    for mode, code in STARTUP_MODES.items():
+        totals, setups, rss = [], [], []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            out = subprocess.run([sys.executable, "-c", STARTUP_CHILD.format(code=code)], env=env, cwd=cwd,
+                                 capture_output=True, text=True, check=True).stdout.split()
+            totals.append(time.perf_counter() - start)
+            setups.append(float(out[-2]))
+            rss.append(int(out[-1]) / 1024)  # VmHWM в КБ
+        print(f"{mode:<10} {np.median(totals) * 1000:>12.0f} {np.median(setups) * 1000:>23.0f} {np.median(rss):>8.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарки контроллера на имитаторе ESP32")
+    sub = parser.add_subparsers(dest="bench", required=True)
+    p_suite = sub.add_parser("suite", help="разбор, детекция, кадры отрисовки, память и сквозной цикл; итог в JSON")
+    p_suite.add_argument("--duration", type=float, default=60, help="секунд сквозного цикла")
+    p_suite.add_argument("--interval", type=float, default=fc.INTERVAL)
+    p_suite.add_argument("--nodes", type=int, default=1)
+    p_suite.add_argument("--latency", type=float, default=0.02, help="задержка ответа имитатора, с")
+    p_suite.add_argument("--jitter", type=float, default=0.01, help="разброс задержки, ±с")
+    p_suite.add_argument("--error-rate", type=float, default=0.01, help="доля ответов HTTP 500")
+    p_suite.add_argument("--noise", type=float, default=1.0, help="множитель шума датчиков")
+    p_suite.add_argument("--memory-samples", type=int, default=200_000)
+    p_suite.add_argument("--output", default="bench.json")
+    p_compare = sub.add_parser("compare", help="сравнение двух результатов suite")
+    p_compare.add_argument("old")
+    p_compare.add_argument("new")
+    p_fleet = sub.add_parser("fleet", help="масштабирование опроса по числу узлов")
+    p_fleet.add_argument("--nodes", default="1,10,50,100,200")
+    p_fleet.add_argument("--duration", type=float, default=10)
+    p_fleet.add_argument("--interval", type=float, default=fc.INTERVAL)
+    p_fleet.add_argument("--shards", type=int, default=None, help="процессов-шардов (0 - по числу ядер)")
+    p_parse = sub.add_parser("parse", help="скорость разборщиков ответов прошивки и fuzz на испорченных ответах")
+    p_parse.add_argument("--fuzz", type=int, default=100_000, help="испорченных ответов на разборщик")
+    p_parse.add_argument("--seed", type=int, default=3)
+    sub.add_parser("detectors", help="скорость детекторов и повторное срабатывание после медленного спада")
+    p_dashboard = sub.add_parser("dashboard", help="нагрузка на веб-дашборд: цикл опроса без клиентов и с клиентами")
+    p_dashboard.add_argument("--clients", type=int, default=100)
+    p_dashboard.add_argument("--duration", type=float, default=20)
+    p_dashboard.add_argument("--nodes", type=int, default=10)
+    p_dashboard.add_argument("--interval", type=float, default=fc.INTERVAL)
+    p_dashboard.add_argument("--output", default=None, help="сохранить результат в JSON")
+    p_startup = sub.add_parser("startup", help="холодный старт и память по режимам")
+    p_startup.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.bench == "suite":
+        bench_suite(args)
+    elif args.bench == "compare":
+        compare_reports(args.old, args.new)
+    elif args.bench == "fleet":
+        bench_fleet([int(n) for n in args.nodes.split(",")], args.duration, args.interval, args.shards)
+    elif args.bench == "parse":
+        for name, result in bench_parse().items():
+            print(f"{name:<16} p50 {result['p50_ms'] * 1000:6.2f} мкс  p99 {result['p99_ms'] * 1000:6.2f} мкс")
+        fuzz = fuzz_parsers(args.fuzz, args.seed)
+        print(f"fuzz: случаев {fuzz['cases']}, исключений {fuzz['exceptions']}, "
+              f"недопустимых значений {fuzz['invalid']}, расхождений {fuzz['mismatches']}")
+        for example in fuzz["examples"]:
+            print(f"  {example}")
+        sys.exit(1 if fuzz["exceptions"] or fuzz["invalid"] or fuzz["mismatches"] else 0)
+    elif args.bench == "detectors":
+        for kind, result in bench_detection().items():
+            print(f"{kind:<10} p50 {result['p50_ms'] * 1000:6.2f} мкс  p99 {result['p99_ms'] * 1000:6.2f} мкс")
+        rearm = check_detector_rearm()
+        for kind, result in rearm.items():
+            print(f"{kind:<10} срабатывания {result['fires']} - {'ок' if result['ok'] else 'НЕ ВЗВОДИТСЯ'}")
+        sys.exit(0 if all(result["ok"] for result in rearm.values()) else 1)
+    elif args.bench == "dashboard":
+        result = bench_dashboard(args.clients, args.duration, args.nodes, args.interval)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"meta": run_meta(vars(args)), "results": result}, f, indent=2)
+    elif args.bench == "startup":
+        bench_startup(args.repeat)
@@ -2,35 +2,48 @@ import sys
 import os
 import numpy as np
 import argparse
-import requests
 import time
-import numpy as np
-import matplotlib.pyplot as plt
 import re
-from matplotlib.animation import FuncAnimation
-from mpl_toolkits.mplot3d import Axes3D  # Для 3D-графика
-from matplotlib import gridspec
+import math
+import json
+import base64
+import hashlib
+import asyncio
+import queue
+import signal
+import shutil
+import functools
+import bisect
+import threading
+from urllib.parse import urlsplit, parse_qs
+from collections import namedtuple
 from collections import deque
-import matplotlib.dates as mdates
-from datetime import datetime
+# matplotlib импортируется только в GUI-режиме (build_figure): демону и терминалу он не нужен
 
 # ======================== Параметры конфигурации ===========================
 use_mq2_pin = True
 use_getSmoke = False
 #cal sensor 21
 URL = "http://192.168.1.75"
-GET_URL = f"{URL}/getSmoke"
-MQ2_URL = f"{URL}/getAnalogRead34"
-COMMAND_URL = f"{URL}/set3?s3="
 
 MAXFANSPEED = 60
 INTERVAL = 1
+POLL_DEADLINE = 0.8             # секунд, крайний срок опроса обоих эндпоинтов за один тик
 CALIBRATION_DURATION = 40       # секунд
 RECALIBRATION_INTERVAL = 3600   # секунд
+RECALIBRATION_MIN_SAMPLES = 30  # минимум отсчётов без тревоги для фонового обновления baseline
 SMOKE_HOLD_DURATION = 600       # секунд
 WARMUP_TIME = 10  # время прогрева в секундах
-sensor_warmed_up = False
-warmup_start_time = None  # Время начала прогрева
+
+# Управление вентилятором: таймаут команды, повторы с экспоненциальной задержкой, проверка по /get3
+FAN_COMMAND_TIMEOUT = 3         # секунд на /set3 и /get3
+FAN_RETRY_BASE = 0.5            # секунд до первого повтора, дальше удваивается
+FAN_RETRY_MAX = 30              # секунд, потолок задержки между повторами
+FAN_MIN_RPM = 1                 # об/мин, ниже которых ненулевая скорость считается не применённой
+FAN_STALL_GRACE = 15            # секунд на разгон после новой уставки, до проверки оборотов во время тревоги
+FAN_STALL_SAMPLES = 3           # замеров подряд ниже FAN_MIN_RPM, после которых вентилятор считается вставшим
+TELEMETRY_INTERVAL = 10         # секунд между чтениями оборотов (/get1, /get2, /get3) и /remtime
+TELEMETRY_ALARM_INTERVAL = 2    # то же во время тревоги - для контроля вращения вентилятора
 
 # Порог срабатывания для каждого датчика (в процентах от baseline)
 TRIGGER_PERCENTAGEMQ2 = 20
@@ -39,455 +52,3407 @@ TRIGGER_PERCENTAGECUR = 60
 
 AVG_WINDOW_SIZE = 3
 
-# Глобальные переменные калибровки
-baseline_ppm = baseline_cur = baseline_mq2 = 0
+# Детекторы по датчикам (detectors=): threshold - процентный порог, как раньше; ewma, cusum, zscore -
+# статистические, срабатывают в дополнение к порогу
+DETECTORS = {"mq2": "threshold", "ppm": "threshold", "cur": "threshold"}
+DETECTOR_MIN_SAMPLES = 30       # отсчётов для оценки шума до первого статистического срабатывания
+DETECTOR_MIN_RISE = 0.05        # минимальный подъём над baseline (доля) для статистического срабатывания
+DETECTOR_MIN_SIGMA = 0.002      # нижняя граница оценки шума (доля baseline)
+DETECTOR_NOISE_ALPHA = 0.01     # скорость обучения оценки шума
+DETECTOR_CLIP = 4               # обрезка нормированного остатка (защита от одиночных выбросов)
+EWMA_ALPHA = 0.3
+EWMA_L = 4                      # ширина контрольной границы EWMA, σ
+CUSUM_K = 0.5                   # допуск CUSUM на отсчёт, σ
+CUSUM_H = 8                     # порог CUSUM, σ
+ZSCORE_WINDOW = 120             # отсчётов в окне медианы
+ZSCORE_MAD_EVERY = 10           # отсчётов между пересчётами MAD
+ZSCORE_THRESHOLD = 6
+# История графиков: уровни детализации (сырые отсчёты и корзины по LOD_FACTOR**k отсчётов)
+LOD_CAPACITY = 4096             # точек на каждом уровне (сырой: ~1 ч при опросе раз в секунду)
+LOD_LEVELS = 5                  # уровней агрегации (min/max/mean); последний - ~48 суток при 1 Гц
+LOD_FACTOR = 4                  # отсчётов предыдущего уровня в одной корзине
+LOD_OVERSAMPLE = 2              # точек уровня на пиксель оси, выше - берётся уровень грубее
+LOD_SURFACE_POINTS = 150        # точек 3D-поверхности (LTTB)
+GUI_WINDOW = 600                # секунд на графиках при запуске; клавиши -/+ меняют в LOD_FACTOR раз
+GUI_WINDOW_MIN = 60
+GUI_BACKFILL = 86400            # секунд истории с диска при запуске GUI
+GUI_FRAME_INTERVAL = 0.05       # секунд между кадрами GUI (блиттинг)
+GUI_QUEUE_SIZE = 1000           # отсчётов в очереди между потоком опроса и GUI
+SURFACE_REFRESH_INTERVAL = 10   # секунд между перестроениями 3D-поверхности
+TREND_WIDTH = 50                # точек в строке тренда MQ2 в терминальном режиме
+TERMINAL_REFRESH_RATE = 10      # кадров в секунду в терминальном режиме
+TERMINAL_LOG_LINES = 5          # строк сообщений под таблицей
 
-# Глобальные переменные тревоги
-smoke_detected = False
-smoke_start_time = 0
-current_device_state = 20
+# Метрики (включаются аргументом metrics=true|PORT)
+METRICS_PORT = 9108
+METRICS_SUMMARY_INTERVAL = 60   # секунд между строками сводки
 
-# Данные для графиков
-timestamps = []
-ppm_data = []
-cur_data = []
-mq2_data = []
+# Веб-дашборд (включается аргументом web=true|PORT)
+DASHBOARD_PORT = 8080
+DASHBOARD_HOST = "127.0.0.1"      # "0.0.0.0" - доступ из локальной сети
+DASHBOARD_PUSH_INTERVAL = 0.2     # секунд накопления изменений перед рассылкой клиентам
+DASHBOARD_CLIENT_BUFFER = 1 << 20 # байт неотправленных данных, после которых медленный клиент отключается
+DASHBOARD_REQUEST_TIMEOUT = 10    # секунд на заголовки HTTP-запроса
+DASHBOARD_HISTORY_SECONDS = 600   # окно /history по умолчанию
+DASHBOARD_HISTORY_CAPACITY = 1024 # точек на уровень истории узла в памяти (LODHistory)
+DASHBOARD_HISTORY_LEVELS = 3      # уровней агрегации: 17 мин сырых, до ~18 ч в корзинах при 1 Гц
 
-# Буферы для усреднения
-mq2_avg_window = deque(maxlen=AVG_WINDOW_SIZE)
-ppm_avg_window = deque(maxlen=AVG_WINDOW_SIZE)
-cur_avg_window = deque(maxlen=AVG_WINDOW_SIZE)
+# История на диске (None - не сохранять)
+HISTORY_DIR = "history"
+HISTORY_SEGMENT_DURATION = 86400  # секунд данных в одном сегменте
+HISTORY_FLUSH_INTERVAL = 1        # секунд между пачками записи на диск
 
-# Для сохранения последних валидных значений (fallback)
-last_valid_ppm = None
-last_valid_cur = None
-last_valid_mq2 = None
+# Снимки состояния для тёплого старта без калибровки (None - не сохранять)
+SNAPSHOT_DIR = "snapshots"
+SNAPSHOT_INTERVAL = 10             # секунд между снимками (при смене состояния тревоги - сразу)
+SNAPSHOT_MAX_AGE = 3600            # секунд; снимок старше - полная калибровка
+SNAPSHOT_VALIDATION_SAMPLES = 5    # живых отсчётов для проверки снимка
+SNAPSHOT_VALIDATION_INTERVAL = 0.2 # секунд между ними
+SNAPSHOT_TOLERANCE = 0.25          # допустимое отклонение медианы живых отсчётов от baseline
 
-# Глобальная переменная для хранения начального превышения MQ2 при активации режима
-initial_excess_mq2 = None
+# Адаптивный опрос (sampling=adaptive): интервал по близости к порогам и скорости изменения сигнала
+ADAPTIVE_SAMPLING = False
+SAMPLING_MIN_INTERVAL = 0.25    # секунд, у порога и при быстром росте
+SAMPLING_MAX_INTERVAL = 5       # секунд, в спокойном воздухе
+SAMPLING_NEAR_THRESHOLD = 0.9   # доля порога, выше которой опрос на минимальном интервале
+SAMPLING_LOOKAHEAD = 4          # опросов до прогнозного достижения порога
+SAMPLING_BACKOFF = 1.5          # рост интервала за спокойный тик
+SAMPLING_BUDGET_PER_HOUR = 7200 # запросов к узлу в час (2 на опрос и 4 на телеметрию; опрос раз в секунду - 8640)
+SAMPLING_BUDGET_BURST = 600     # запросов, которые можно израсходовать сверх средней скорости
 
-# ======================== Функции ===========================
+# Мультиустройственный режим: общий лимит одновременных HTTP-соединений и период сводки
+FLEET_MAX_CONNECTIONS = 256
+FLEET_SUMMARY_INTERVAL = 10     # секунд
 
-def send_device_command(value, force=False):
-    global current_device_state
-    if force or current_device_state != value:
-        try:
-            response = requests.get(f"{COMMAND_URL}{value}", timeout=3)
-            response.raise_for_status()
-            current_device_state = value
-            print(f"Устройство установлено в {value}")
-        except requests.RequestException as e:
-            print(f"Ошибка отправки команды: {e}")
+# Шардирование парка по процессам (shards=): процессов, 0 - по числу ядер
+FLEET_SHARDS = 0
+FLEET_TABLE_NAME = "fancontroller_fleet"  # имя таблицы состояния в разделяемой памяти
+SHARD_HEARTBEAT_INTERVAL = 1    # секунд между метками жизни шарда
+SHARD_HEARTBEAT_TIMEOUT = 15    # секунд без метки жизни - шард завис и перезапускается
+SHARD_RESTART_DELAY = 1         # секунд до перезапуска упавшего шарда, дальше удваивается
+SHARD_RESTART_MAX = 60          # секунд, потолок задержки перезапуска
+SHARD_STABLE_TIME = 60          # секунд работы, после которых задержка перезапуска сбрасывается
+SHARD_STOP_TIMEOUT = 10         # секунд на штатную остановку шарда (снимки, история)
+
+# ======================== Функции ===========================
 
 def is_valid_value(value):
     return not (np.isnan(value) or np.isinf(value) or value <= 0)
 
-def calibrate_sensor():
+# ======================== Метрики ===========================
+
+# Границы корзин гистограмм, секунды
+METRICS_BUCKETS = (0.00001, 0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+class Metrics:
+    """
+    Счётчики и гистограммы этапов цикла с экспортом в формате Prometheus.
+    Точки замера в коде проверяют metrics.enabled, поэтому выключенные метрики
+    стоят одну проверку атрибута; включённые - bisect и пару сложений на замер.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())) if labels else ())
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        hist = self.histograms.get(key)
+        if hist is None:
+            # [счётчики по корзинам (+Inf последняя), сумма, количество]
+            hist = self.histograms[key] = [[0] * (len(METRICS_BUCKETS) + 1), 0.0, 0]
+        hist[0][bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+        hist[1] += seconds
+        hist[2] += 1
+
+    def quantile(self, name, q, **labels):
+        """Оценка квантиля по гистограмме (верхняя граница корзины); nan, если замеров нет."""
+        hist = self.histograms.get(self._key(name, labels))
+        if not hist or not hist[2]:
+            return np.nan
+        rank = q * hist[2]
+        seen = 0
+        for bound, count in zip(METRICS_BUCKETS + (float("inf"),), hist[0]):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def export(self):
+        """Текст в формате Prometheus exposition."""
+        def fmt_labels(labels, extra=()):
+            items = list(labels) + list(extra)
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}" if items else ""
+
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"fancontroller_{name}_total{fmt_labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, c in zip(METRICS_BUCKETS + ("+Inf",), buckets):
+                cumulative += c
+                lines.append(f"fancontroller_{name}_seconds_bucket{fmt_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"fancontroller_{name}_seconds_sum{fmt_labels(labels)} {total}")
+            lines.append(f"fancontroller_{name}_seconds_count{fmt_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Короткая строка сводки: p50/p99 этапов и доля ошибок опроса."""
+        parts = []
+        for (name, labels), (_, _, count) in sorted(self.histograms.items()):
+            label = "/".join(str(v) for _, v in labels)
+            p50, p99 = self.quantile(name, 0.5, **dict(labels)), self.quantile(name, 0.99, **dict(labels))
+            parts.append(f"{name}{'[' + label + ']' if label else ''} p50≤{p50 * 1000:g}мс p99≤{p99 * 1000:g}мс")
+        polls = sum(v for (name, _), v in self.counters.items() if name == "polls")
+        errors = sum(v for (name, _), v in self.counters.items() if name == "poll_errors")
+        if polls:
+            parts.append(f"ошибки опроса {errors / polls:.1%}")
+        return "; ".join(parts)
+
+    def serve(self, port, host="127.0.0.1"):
+        """HTTP-эндпоинт /metrics в фоновом потоке."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.export().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        return server
+
+    def start_summary(self, interval=METRICS_SUMMARY_INTERVAL):
+        """Периодическая строка сводки в консоль."""
+        def loop():
+            while True:
+                time.sleep(interval)
+                print(f"[метрики] {self.summary()}")
+        threading.Thread(target=loop, name="metrics-summary", daemon=True).start()
+
+metrics = Metrics()
+
+def enable_metrics(port=METRICS_PORT):
+    metrics.enabled = True
+    if port:
+        metrics.serve(port)
+        print(f"Метрики: http://127.0.0.1:{port}/metrics")
+    metrics.start_summary()
+
+# ======================== Веб-дашборд ===========================
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"  # RFC 6455
+WS_MAX_CLIENT_MESSAGE = 65536  # байт; от браузера приходят только служебные кадры
+
+def ws_frame(data, opcode=0x1):
+    """Кадр WebSocket от сервера (FIN, без маски); data - str или bytes."""
+    payload = data.encode() if isinstance(data, str) else data
+    n = len(payload)
+    if n < 126:
+        header = bytes((0x80 | opcode, n))
+    elif n < 65536:
+        header = bytes((0x80 | opcode, 126)) + n.to_bytes(2, "big")
+    else:
+        header = bytes((0x80 | opcode, 127)) + n.to_bytes(8, "big")
+    return header + payload
+
+async def ws_read_frame(reader, max_size=WS_MAX_CLIENT_MESSAGE):
+    """Один кадр WebSocket: (opcode, payload); маска клиента снимается."""
+    head = await reader.readexactly(2)
+    opcode, length = head[0] & 0x0F, head[1] & 0x7F
+    if length == 126:
+        length = int.from_bytes(await reader.readexactly(2), "big")
+    elif length == 127:
+        length = int.from_bytes(await reader.readexactly(8), "big")
+    if length > max_size:
+        raise ValueError(f"кадр WebSocket {length} байт")
+    mask = await reader.readexactly(4) if head[1] & 0x80 else None
+    payload = await reader.readexactly(length)
+    if mask:
+        payload = (int.from_bytes(payload, "big") ^ int.from_bytes((mask * (length // 4 + 1))[:length], "big")
+                   ).to_bytes(length, "big")
+    return opcode, payload
+
+def _json_num(value):
+    """Число для JSON: nan и бесконечность - null (JSON.parse их не принимает)."""
+    value = float(value)
+    return round(value, 3) if math.isfinite(value) else None
+
+class Dashboard:
     """
-    Калибровка всех датчиков (getSmoke: ppm и cur, а также MQ2).
-    Собираются данные, удаляются выбросы, затем вычисляется медиана.
+    Веб-дашборд: страница, WebSocket /ws, история /history и состояние /state - на своём
+    event loop в отдельном потоке. Цикл опроса только передаёт состояние узла после тика
+    (publish - без ожидания и без сети); разностные обновления (новые отсчёты, смена порогов,
+    тревоги, вентилятора) копятся DASHBOARD_PUSH_INTERVAL и уходят всем клиентам одним кадром,
+    закодированным один раз. Сколько бы ни было клиентов, к ESP32 не уходит ни одного лишнего запроса.
     """
-    global baseline_ppm, baseline_cur, baseline_mq2,warmup_start_time, sensor_warmed_up
-    ppm_samples, cur_samples, mq2_samples = [], [], []
-    warmup_start_time = time.time() + CALIBRATION_DURATION + 30
-    sensor_warmed_up = False
-    print("Калибровка датчиков...")
-    start_time = time.time()
-    while time.time() - start_time < CALIBRATION_DURATION:
+    def __init__(self):
+        self.enabled = False
+        self.port = None
+        self.clients = set()
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self._loop = None
+        self._index = {}
+        self._devices = []  # [имя, ts, mq2, ppm, cur, порог mq2, ppm, cur, тревога, уставка, скорость, об/мин]
+        self._history = []
+        self._pending = []
+        self._flush_handle = None
+
+    def serve(self, port, host=DASHBOARD_HOST):
+        """Запускает сервер в фоновом потоке; port=0 - любой свободный (фактический - в self.port)."""
+        self._loop = asyncio.new_event_loop()
+        server = self._loop.run_until_complete(asyncio.start_server(self._handle, host, port))
+        self.port = server.sockets[0].getsockname()[1]
+        threading.Thread(target=self._loop.run_forever, name="dashboard", daemon=True).start()
+        return server
+
+    # ---------- приём состояния (поток опроса -> поток дашборда) ----------
+
+    def publish(self, ctrl):
+        """Состояние узла после тика; вызывается из цикла опроса, вся обработка - в потоке дашборда."""
+        self._loop.call_soon_threadsafe(
+            self._receive, ctrl.name or device_history_name(ctrl.url), ctrl.last_sample.ts, ctrl.last_filtered,
+            ctrl.calculate_thresholds(), ctrl.smoke_detected, ctrl.fan_setpoint, ctrl.current_device_state,
+            ctrl.fan_rpm)
+
+    def _receive(self, name, ts, filtered, thresholds, alarm, setpoint, fan, rpm):
+        i = self._index.get(name)
+        if i is None:
+            i = self._index[name] = len(self._devices)
+            self._devices.append([name, None] + [None] * 10)
+            self._history.append(LODHistory(DASHBOARD_HISTORY_CAPACITY, DASHBOARD_HISTORY_LEVELS,
+                                            fields=("mq2", "ppm", "cur")))
+            self._pending.append(["n", i, name])
+        device = self._devices[i]
+        self._history[i].append(ts, *filtered)
+        values = [_json_num(v) for v in filtered]
+        device[1:5] = [ts] + values
+        self._pending.append(["s", i, ts] + values)
+        thresholds = [_json_num(v) for v in thresholds]
+        if device[5:8] != thresholds:
+            device[5:8] = thresholds
+            self._pending.append(["t", i] + thresholds)
+        if device[8] != int(alarm):
+            device[8] = int(alarm)
+            self._pending.append(["a", i, int(alarm), ts])
+        fan_state = [int(setpoint), int(fan), _json_num(rpm)]
+        if device[9:12] != fan_state:
+            device[9:12] = fan_state
+            self._pending.append(["f", i] + fan_state)
+        if self._flush_handle is None:
+            self._flush_handle = self._loop.call_later(DASHBOARD_PUSH_INTERVAL, self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        pending, self._pending = self._pending, []
+        if not pending or not self.clients:
+            return
+        frame = ws_frame(json.dumps({"d": pending}, separators=(",", ":")))
+        for writer in list(self.clients):
+            if writer.transport.get_write_buffer_size() > DASHBOARD_CLIENT_BUFFER:
+                # Клиент не успевает читать: отключаем, после переподключения он получит полное состояние
+                self.clients.discard(writer)
+                writer.transport.abort()
+                continue
+            writer.write(frame)
+            self.bytes_sent += len(frame)
+        self.frames_sent += 1
+
+    # ---------- HTTP и WebSocket ----------
+
+    def state(self):
+        return {"init": self._devices}
+
+    def history(self, name, seconds, width):
+        """Ряды узла за последние seconds секунд, прорежённые до width точек (min-max по пикселям)."""
+        i = self._index.get(name)
+        if i is None:
+            return None
+        history = self._history[i]
+        if not len(history):
+            return {"device": name}
+        last = history.timestamps[-1]
+        result = {"device": name}
+        for field in history.fields:
+            x, y = history.series(field, last - seconds, last, width)
+            result[field] = [x.tolist(), [_json_num(v) for v in y]]
+        return result
+
+    async def _handle(self, reader, writer):
         try:
-            response = requests.get(GET_URL, timeout=5).text
-            ppm_match = re.search(r'ppm:(\d+\.?\d*)', response)
-            cur_match = re.search(r'cur:(\d+\.?\d*)', response)
-            if ppm_match and cur_match:
-                ppm = float(ppm_match.group(1).replace(',', '.'))
-                cur = float(cur_match.group(1).replace(',', '.'))
-                if is_valid_value(ppm):
-                    ppm_samples.append(ppm)
-                if is_valid_value(cur):
-                    cur_samples.append(cur)
-        except Exception as e:
-            print(f"Ошибка калибровки getSmoke: {e}")
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), DASHBOARD_REQUEST_TIMEOUT)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            writer.close()
+            return
+        lines = request.decode("latin-1").split("\r\n")
+        target = (lines[0].split(" ") + [""])[1]
+        headers = {k.strip().lower(): v.strip() for k, _, v in (line.partition(":") for line in lines[1:] if line)}
+        url = urlsplit(target)
+        if url.path == "/ws" and headers.get("upgrade", "").lower() == "websocket" and "sec-websocket-key" in headers:
+            await self._websocket(reader, writer, headers["sec-websocket-key"])
+            return
+        status, ctype, body = "200 OK", "application/json", None
+        if url.path == "/":
+            ctype, body = "text/html; charset=utf-8", DASHBOARD_HTML.encode()
+        elif url.path == "/state":
+            body = json.dumps(self.state())
+        elif url.path == "/history":
+            query = parse_qs(url.query)
+            try:
+                seconds = float(query.get("seconds", [DASHBOARD_HISTORY_SECONDS])[0])
+                width = min(max(int(query.get("width", [800])[0]), 1), 4096)
+            except ValueError:
+                status, body = "400 Bad Request", json.dumps({"error": "seconds и width - числа"})
+            else:
+                data = self.history(query.get("device", [""])[0], seconds, width)
+                if data is None:
+                    status, body = "404 Not Found", json.dumps({"error": "нет такого узла"})
+                else:
+                    body = json.dumps(data)
+        else:
+            status, ctype, body = "404 Not Found", "text/plain", "Not found"
+        body = body.encode() if isinstance(body, str) else body
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\nContent-Length: {len(body)}\r\n"
+                     f"Cache-Control: no-store\r\nConnection: close\r\n\r\n".encode() + body)
         try:
-            response_mq2 = requests.get(MQ2_URL, timeout=5).text.strip()
-            mq2 = float(response_mq2)
-            if is_valid_value(mq2):
-                mq2_samples.append(mq2)
-        except Exception as e:
-            print(f"Ошибка калибровки MQ2: {e}")
-    time.sleep(INTERVAL)
-    
-    def remove_outliers(data):
-        if len(data) < 3:
-            return data
-        q1 = np.percentile(data, 25)
-        q3 = np.percentile(data, 75)
-        iqr = q3 - q1
-        return [x for x in data if (x > q1 - 1.5 * iqr) and (x < q3 + 1.5 * iqr)]
-    
-    ppm_filtered = remove_outliers(ppm_samples)
-    cur_filtered = remove_outliers(cur_samples)
-    mq2_filtered = remove_outliers(mq2_samples)
-    
-    if ppm_filtered:
-        baseline_ppm = np.median(ppm_filtered)
-    if cur_filtered:
-        baseline_cur = np.median(cur_filtered)
-    if mq2_filtered:
-        baseline_mq2 = np.median(mq2_filtered)
-    
-    print(f"Калибровка завершена.\n  ppm: {baseline_ppm:.1f}\n  cur: {baseline_cur:.1f}\n  MQ2: {baseline_mq2:.1f}")
-
-def calculate_thresholds():
-    """
-    Вычисление порогов для датчиков как baseline * (1 + TRIGGER_PERCENTAGE/100).
-    """
-    threshold_mq2 = baseline_mq2 * (1 + TRIGGER_PERCENTAGEMQ2 / 100)
-    threshold_ppm = baseline_ppm * (1 + TRIGGER_PERCENTAGEPPM / 100)
-    threshold_cur = baseline_cur * (1 + TRIGGER_PERCENTAGECUR / 100)
-    return threshold_mq2, threshold_ppm, threshold_cur
-
-def check_smoke(ppm, cur, mq2):
-    """
-    Детекция дыма:
-      - Если оба датчика используются, срабатывание, если MQ2 и хотя бы один из getSmoke (ppm или cur) превышают порог.
-      - Если один из датчиков отключён, то детекция по оставшемуся.
-      - При активации фиксируется начальное превышение (initial_excess_mq2).
-      - Если в режиме задымления, начиная с 50% времени, текущее превышение MQ2 снижается до 50% от начального, скорость вентилятора уменьшается постепенно.
-    """
-    global smoke_detected, smoke_start_time, current_device_state, initial_excess_mq2,sensor_warmed_up, warmup_start_time
-    if not sensor_warmed_up and time.time() - warmup_start_time >= WARMUP_TIME:
-        sensor_warmed_up = True
-        print("Датчик прогрелся, данные теперь можно использовать.")
-    if not sensor_warmed_up:
-        print("Датчик ещё не прогрет. Пропускаем данные.")
-        return  # Пропускаем обработку данных, если датчик не прогрелся
-    mq2_avg_window.append(mq2)
-    ppm_avg_window.append(ppm)
-    cur_avg_window.append(cur)
-    
-    mq2_filtered = np.mean(mq2_avg_window)
-    ppm_filtered = np.mean(ppm_avg_window)
-    cur_filtered = np.mean(cur_avg_window)
-    
-    threshold_mq2, threshold_ppm, threshold_cur = calculate_thresholds()
-    
-    if use_mq2_pin and use_getSmoke:
-        condition = (mq2_filtered > threshold_mq2) or ((ppm_filtered > threshold_ppm) or (cur_filtered > threshold_cur))
-    elif use_mq2_pin:
-        condition = mq2_filtered > threshold_mq2
-    elif use_getSmoke:
-        condition = (ppm_filtered > threshold_ppm) or (cur_filtered > threshold_cur)
-    else:
-        condition = False
-
-    if condition:
-        if not smoke_detected:
-            smoke_start_time = time.time()
-            initial_excess_mq2 = mq2_filtered - threshold_mq2
-            if initial_excess_mq2 < 0:
-                initial_excess_mq2 = 0
-            send_device_command(MAXFANSPEED)
-            smoke_detected = True
-            print("Обнаружено задымление!")
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def _websocket(self, reader, writer, key):
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+        writer.write(f"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                     f"Sec-WebSocket-Accept: {accept}\r\n\r\n".encode())
+        writer.write(ws_frame(json.dumps(self.state(), separators=(",", ":"))))
+        self.clients.add(writer)
+        try:
+            while True:
+                opcode, payload = await ws_read_frame(reader)
+                if opcode == 0x8:
+                    writer.write(ws_frame(payload[:2], 0x8))
+                    break
+                if opcode == 0x9:
+                    writer.write(ws_frame(payload, 0xA))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    def summary(self):
+        return f"клиентов: {len(self.clients)}, кадров: {self.frames_sent}, отправлено {self.bytes_sent / 1024:.0f} КБ"
+
+dashboard = Dashboard()
+
+def enable_dashboard(port=DASHBOARD_PORT, host=DASHBOARD_HOST):
+    dashboard.serve(port, host)
+    dashboard.enabled = True
+    print(f"Дашборд: http://{host}:{dashboard.port}/")
+    return dashboard
+
+# Страница дашборда: таблица узлов и график выбранного узла; история - /history, дальше - дельты из /ws
+DASHBOARD_HTML = """<!doctype html>
+<html lang="ru"><head><meta charset="utf-8"><title>Контроллер вентиляторов</title>
+<style>
+body{font:14px sans-serif;margin:1em}table{border-collapse:collapse}
+td,th{padding:2px 8px;text-align:right}td:first-child,th:first-child{text-align:left}
+tbody tr{cursor:pointer}tr.alarm{background:#fcc}tr.sel{outline:2px solid #36c}canvas{border:1px solid #ccc}
+</style></head><body>
+<h3>Узлы <small id="conn">подключение...</small></h3>
+<table><thead><tr><th>Узел</th><th>MQ2</th><th>порог</th><th>ppm</th><th>порог</th><th>cur</th><th>порог</th>
+<th>вент.</th><th>уставка</th><th>об/мин</th><th>статус</th></tr></thead><tbody id="rows"></tbody></table>
+<p><canvas id="chart" width="900" height="260"></canvas></p>
+<script>
+const SPAN = 600, W = 900, H = 260;
+let devs = [], sel = 0, xs = [], ys = [], dirty = false;
+const fmt = v => v === null || v === undefined ? "-" : v.toFixed(1);
+// Имя узла приходит из конфигурации/URL - в innerHTML только экранированным
+const esc = s => String(s).replace(/[&<>"']/g, ch => `&#${ch.charCodeAt(0)};`);
+function render() {
+  const rows = devs.map((d, i) => `<tr data-i="${i}" class="${d[8] ? "alarm" : ""} ${i === sel ? "sel" : ""}">` +
+    `<td>${esc(d[0])}</td><td>${fmt(d[2])}</td><td>${fmt(d[5])}</td><td>${fmt(d[3])}</td><td>${fmt(d[6])}</td>` +
+    `<td>${fmt(d[4])}</td><td>${fmt(d[7])}</td><td>${d[10] ?? "-"}</td><td>${d[9] ?? "-"}</td><td>${d[11] ?? "-"}</td>` +
+    `<td>${d[8] ? "КУРЯТ!" : "норма"}</td></tr>`);
+  document.getElementById("rows").innerHTML = rows.join("");
+  const c = document.getElementById("chart").getContext("2d"), d = devs[sel];
+  c.clearRect(0, 0, W, H);
+  if (!d || !xs.length) return;
+  const t1 = xs[xs.length - 1], t0 = t1 - SPAN, thr = d[5];
+  const vals = ys.filter(v => v !== null).concat(thr === null ? [] : [thr]);
+  const lo = Math.min(...vals) - 10, hi = Math.max(...vals) + 10;
+  const px = t => (t - t0) / SPAN * W, py = v => H - (v - lo) / (hi - lo) * H;
+  c.strokeStyle = "green"; c.beginPath();
+  xs.forEach((t, k) => { if (ys[k] !== null) c.lineTo(px(t), py(ys[k])); }); c.stroke();
+  if (thr !== null) { c.strokeStyle = "red"; c.setLineDash([6, 4]); c.beginPath();
+    c.moveTo(0, py(thr)); c.lineTo(W, py(thr)); c.stroke(); c.setLineDash([]); }
+  c.fillText(`${d[0]}: MQ2 за ${SPAN / 60} мин`, 8, 14);
+}
+function load(i) {
+  sel = i; xs = []; ys = []; dirty = true;
+  if (!devs[i]) return;
+  fetch(`/history?device=${encodeURIComponent(devs[i][0])}&seconds=${SPAN}&width=${W}`).then(r => r.json())
+    .then(h => { if (sel === i && h.mq2) { xs = h.mq2[0]; ys = h.mq2[1]; dirty = true; } });
+}
+function apply(u) {
+  const d = devs[u[1]];
+  if (u[0] === "n") devs[u[1]] = [u[2], null, null, null, null, null, null, null, 0, null, null, null];
+  else if (u[0] === "s") { d[1] = u[2]; d.splice(2, 3, u[3], u[4], u[5]);
+    if (u[1] === sel) { xs.push(u[2]); ys.push(u[3]);
+      while (xs.length && xs[0] < u[2] - SPAN) { xs.shift(); ys.shift(); } } }
+  else if (u[0] === "t") d.splice(5, 3, u[2], u[3], u[4]);
+  else if (u[0] === "a") d[8] = u[2];
+  else if (u[0] === "f") d.splice(9, 3, u[2], u[3], u[4]);
+}
+function connect() {
+  const ws = new WebSocket(`ws://${location.host}/ws`);
+  ws.onopen = () => document.getElementById("conn").textContent = "";
+  ws.onclose = () => { document.getElementById("conn").textContent = "нет связи"; setTimeout(connect, 1000); };
+  ws.onmessage = e => {
+    const m = JSON.parse(e.data);
+    if (m.init) { devs = m.init; load(Math.min(sel, Math.max(devs.length - 1, 0))); }
+    if (m.d) { const fresh = !devs[sel]; m.d.forEach(apply); if (fresh && devs[sel]) load(sel); }
+    dirty = true;
+  };
+}
+document.getElementById("rows").onclick = e => { const r = e.target.closest("tr"); if (r) load(+r.dataset.i); };
+setInterval(() => { if (dirty) { dirty = false; render(); } }, 200);
+connect();
+</script></body></html>
+"""
+
+# ======================== Асинхронный опрос датчиков ===========================
+
+class ESP32Error(Exception):
+    """Ошибка обмена с ESP32 (код ответа, обрыв соединения)."""
+
+class AsyncHTTPPool:
+    """
+    Минимальный HTTP/1.1 клиент поверх asyncio (только GET).
+    Держит keep-alive соединения и переиспользует их между тиками;
+    если ESP32 закрыл соединение, открывается новое.
+    """
+    def __init__(self, max_idle_per_host=2, max_connections=None):
+        self.max_idle_per_host = max_idle_per_host
+        # Общий лимит одновременных запросов (для опроса сотен узлов через один пул)
+        self._limit = asyncio.Semaphore(max_connections) if max_connections else None
+        self._idle = {}
+
+    async def get(self, url):
+        if self._limit is None:
+            return await self._get(url)
+        async with self._limit:
+            return await self._get(url)
+
+    async def _get(self, url):
+        parts = urlsplit(url)
+        host, port = parts.hostname, parts.port or 80
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        key = (host, port)
+        request = (f"GET {path} HTTP/1.1\r\nHost: {host}\r\n"
+                   "Connection: keep-alive\r\n\r\n").encode()
+        idle = self._idle.get(key)
+        if idle:
+            # Переиспользованное соединение могло быть закрыто сервером - одна повторная попытка
+            reader, writer = idle.pop()
+            try:
+                return await self._exchange(key, reader, writer, request)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+        reader, writer = await asyncio.open_connection(host, port)
+        return await self._exchange(key, reader, writer, request)
+
+    async def _exchange(self, key, reader, writer, request):
+        try:
+            writer.write(request)
+            await writer.drain()
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionError("соединение закрыто сервером")
+            status = int(status_line.split()[1])
+            length = None
+            keep_alive = True
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                name = name.strip().lower()
+                if name == "content-length":
+                    length = int(value)
+                elif name == "connection" and value.strip().lower() == "close":
+                    keep_alive = False
+            if length is None:
+                body = await reader.read()
+                keep_alive = False
+            else:
+                body = await reader.readexactly(length)
+        except BaseException:
+            writer.close()
+            raise
+        if keep_alive and len(self._idle.setdefault(key, [])) < self.max_idle_per_host:
+            self._idle[key].append((reader, writer))
         else:
-            elapsed = time.time() - smoke_start_time
-            current_excess = mq2_filtered - threshold_mq2
-            if current_excess < 0:
-                current_excess = 0
-            # Если прошло 50% от SMOKE_HOLD_DURATION
-            if elapsed >= SMOKE_HOLD_DURATION * 0.5:
-                # После 75% времени продолжаем мониторинг и, если превышение снизилось до 50% от начального, уменьшаем скорость
-                if current_excess <= initial_excess_mq2 * 0.5:
-                    new_speed = max(20, current_device_state - 1)
-                    if new_speed != current_device_state:
-                        send_device_command(new_speed)
-                        print(f"Снижение скорости вентилятора до {new_speed} (elapsed: {elapsed:.1f}s, excess: {current_excess:.1f})")
-                    if new_speed == 20:
-                        smoke_detected = False
-                        print("Задымление прекращено (минимальная скорость).")
+            writer.close()
+        if status != 200:
+            raise ESP32Error(f"HTTP {status}")
+        return body.decode("utf-8", "replace")
+
+    def close(self):
+        for conns in self._idle.values():
+            for _, writer in conns:
+                writer.close()
+        self._idle.clear()
+
+class Sample(namedtuple("Sample", "ts ppm cur mq2 smoke_stale mq2_stale smoke_latency mq2_latency telemetry "
+                                  "requests", defaults=(None, 2))):
+    """
+    Один отсчёт датчиков. *_stale - ответ не успел к сроку или с ошибкой, значение = nan.
+    telemetry - Telemetry, если в этом тике читались обороты и /remtime, иначе None.
+    requests - сколько HTTP-запросов к узлу стоил тик (с телеметрией - 2 + TELEMETRY_ENDPOINTS).
+    """
+    __slots__ = ()
+
+    @property
+    def latency(self):
+        return max(self.smoke_latency, self.mq2_latency)
+
+class Telemetry(namedtuple("Telemetry", "ts rpm1 rpm2 rpm3 fan1 fan2 fan3 remtime failed")):
+    """
+    Обороты и скорости (%) трёх вентиляторов прошивки (/get1../get3) и остаток цикла /remtime, с.
+    Неполученное или нераспознанное значение - nan, остальные сохраняются; failed - имена таких эндпоинтов.
+    """
+    __slots__ = ()
+
+# Ответ прошивки "avg:1.00  cur:3.20 ppm:12.50" разбирается одним match; всё остальное - поиском полей
+SMOKE_RE = re.compile(r"avg:[\w.-]*  cur:(\d+\.?\d*) ppm:(\d+\.?\d*)\s*$")
+SMOKE_PPM_RE = re.compile(r"ppm:(\d+\.?\d*)")
+SMOKE_CUR_RE = re.compile(r"cur:(\d+\.?\d*)")
+# /get1../get3: "обороты,скорость %"; старые прошивки отдают только обороты
+RPM_RE = re.compile(r"\s*(\d+)(?:,(\d+))?\s*$")
+NUMBER_RE = re.compile(r"\s*(\d+\.?\d*)\s*$")
+
+# Разборщики не бросают исключений: нераспознанный ответ - nan. Сотни цифр подряд float()
+# превращает в inf - это тоже мусор, а не показание (иначе ложная тревога).
+
+def parse_smoke(text):
+    """Разбор ответа /getSmoke в (ppm, cur); nan, если формат не распознан."""
+    match = SMOKE_RE.match(text)
+    if match:
+        ppm, cur = float(match[2]), float(match[1])
     else:
-        if smoke_detected and (time.time() - smoke_start_time >= SMOKE_HOLD_DURATION):
-            smoke_detected = False
-            send_device_command(20)
-            print("Задымление прекратилось.")
+        ppm_match = SMOKE_PPM_RE.search(text)
+        cur_match = SMOKE_CUR_RE.search(text)
+        if not (ppm_match and cur_match):
+            return np.nan, np.nan
+        ppm, cur = float(ppm_match[1]), float(cur_match[1])
+    if ppm < math.inf and cur < math.inf:
+        return ppm, cur
+    return np.nan, np.nan
 
-def build_bar(value, threshold, width=50):
-    """Создает строку-полоску для отображения соотношения value/threshold."""
-    if not is_valid_value(value) or not is_valid_value(threshold):
-        return "[" + "-" * width + "]"
-    ratio = value / threshold if threshold > 0 else 0
-    if np.isnan(ratio):
-        ratio = 0
-    ratio = min(max(ratio, 0), 1)
-    filled = int(ratio * width)
-    return "[" + "#" * filled + "-" * (width - filled) + "]"
+def parse_rpm(text):
+    """Разбор ответа /get1../get3 в (обороты, скорость %); nan, если формат не распознан."""
+    match = RPM_RE.match(text)
+    if match is None:
+        return np.nan, np.nan
+    rpm, percent = float(match[1]), np.nan if match[2] is None else float(match[2])
+    if rpm < math.inf and percent != math.inf:
+        return rpm, percent
+    return np.nan, np.nan
 
-def update_terminal():
-    """Обновление псевдографики в терминале."""
-    global last_valid_ppm, last_valid_cur, last_valid_mq2
-    try:
-        ppm_val = cur_val = mq2_val = np.nan
+def parse_number(text):
+    """Неотрицательное число из ответа (/getAnalogRead34, /remtime); nan, если это не число."""
+    match = NUMBER_RE.match(text)
+    if match is None:
+        return np.nan
+    value = float(match[1])
+    return value if value < math.inf else np.nan
+
+TELEMETRY_ENDPOINTS = ("get1", "get2", "get3", "remtime")
+
+def parse_telemetry(ts, texts):
+    """Telemetry из ответов TELEMETRY_ENDPOINTS по порядку; None - ответа нет."""
+    (rpm1, fan1), (rpm2, fan2), (rpm3, fan3) = ((np.nan, np.nan) if text is None else parse_rpm(text)
+                                                for text in texts[:3])
+    remtime = np.nan if texts[3] is None else parse_number(texts[3])
+    failed = tuple(endpoint for endpoint, value in zip(TELEMETRY_ENDPOINTS, (rpm1, rpm2, rpm3, remtime))
+                   if value != value)
+    return Telemetry(ts, rpm1, rpm2, rpm3, fan1, fan2, fan3, remtime, failed)
+
+class SensorPoller:
+    """
+    Опрос /getSmoke и /getAnalogRead34 одновременно с общим крайним сроком на тик.
+    Ответ, не успевший к сроку, не блокирует цикл: отсчёт помечается устаревшим (stale).
+    Раз в telemetry_interval секунд в тот же тик и с тем же сроком читаются обороты
+    вентиляторов и /remtime (Sample.telemetry); их ошибки не портят отсчёт датчиков.
+    """
+    def __init__(self, base_url, deadline=POLL_DEADLINE, pool=None, log=print,
+                 telemetry_interval=TELEMETRY_INTERVAL):
+        self.get_url = f"{base_url}/getSmoke"
+        self.mq2_url = f"{base_url}/getAnalogRead34"
+        self.telemetry_urls = [f"{base_url}/{endpoint}" for endpoint in TELEMETRY_ENDPOINTS]
+        self.deadline = deadline
+        self.telemetry_interval = telemetry_interval
+        self.pool = pool or AsyncHTTPPool()
+        self.log = log
+        self._telemetry_ts = -math.inf
+        self._loop = None
+
+    async def _timed_get(self, url, endpoint):
+        start = time.perf_counter()
+        text = error = reason = None
         try:
-            response = requests.get(GET_URL, timeout=5).text
-            ppm_match = re.search(r'ppm:(\d+\.?\d*)', response)
-            cur_match = re.search(r'cur:(\d+\.?\d*)', response)
-            if ppm_match and cur_match:
-                ppm_val = float(ppm_match.group(1).replace(',', '.'))
-                cur_val = float(cur_match.group(1).replace(',', '.'))
+            text = await asyncio.wait_for(self.pool.get(url), self.deadline)
+        except asyncio.TimeoutError:
+            error, reason = f"нет ответа за {self.deadline}с", "timeout"
         except Exception as e:
-            print(f"Ошибка getSmoke: {e}")
+            error, reason = e, "error"
+        latency = time.perf_counter() - start
+        if metrics.enabled:
+            metrics.observe("http", latency, endpoint=endpoint)
+            metrics.inc("polls", endpoint=endpoint)
+            if reason is not None:
+                metrics.inc("poll_errors", endpoint=endpoint, reason=reason)
+        return text, error, latency
+
+    async def poll(self):
+        ts = time.time()
+        requests = [self._timed_get(self.get_url, "getSmoke"), self._timed_get(self.mq2_url, "getAnalogRead34")]
+        with_telemetry = ts - self._telemetry_ts >= self.telemetry_interval
+        if with_telemetry:
+            self._telemetry_ts = ts
+            requests += [self._timed_get(url, endpoint)
+                         for url, endpoint in zip(self.telemetry_urls, TELEMETRY_ENDPOINTS)]
+        (smoke_text, smoke_err, smoke_lat), (mq2_text, mq2_err, mq2_lat), *extra = await asyncio.gather(*requests)
+        ppm = cur = mq2 = np.nan
+        if smoke_err is None:
+            if metrics.enabled:
+                start = time.perf_counter()
+                ppm, cur = parse_smoke(smoke_text)
+                metrics.observe("parse", time.perf_counter() - start)
+            else:
+                ppm, cur = parse_smoke(smoke_text)
+        else:
+            self.log(f"Ошибка getSmoke: {smoke_err}")
+        if mq2_err is None:
+            mq2 = parse_number(mq2_text)
+            if mq2 != mq2:
+                mq2_err = ESP32Error(f"не число: {mq2_text[:20]!r}")
+                self.log(f"Ошибка MQ2: {mq2_err}")
+        else:
+            self.log(f"Ошибка MQ2: {mq2_err}")
+        telemetry = None
+        if with_telemetry:
+            telemetry = parse_telemetry(ts, [text for text, _, _ in extra])
+            for endpoint, (text, error, _) in zip(TELEMETRY_ENDPOINTS, extra):
+                if endpoint in telemetry.failed:
+                    self.log(f"Ошибка {endpoint}: {error or f'не распознано: {text[:20]!r}'}")
+        return Sample(ts, ppm, cur, mq2, smoke_err is not None, mq2_err is not None, smoke_lat, mq2_lat, telemetry,
+                      len(requests))
+
+    def poll_sync(self):
+        """Синхронная обёртка для цикла терминала/GUI: собственный event loop опросчика."""
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(self.poll())
+
+    def close(self):
+        self.pool.close()
+        if self._loop is not None:
+            self._loop.close()
+            self._loop = None
+
+class FanActuator:
+    """
+    Управление вентилятором вне пути детекции. В очереди хранится только последняя уставка:
+    уставка, заменённая до отправки, не отправляется (coalesced). Команда /set3 повторяется
+    с экспоненциальной задержкой, пока не подтвердится чтением оборотов /get3
+    или не появится новая уставка. Подтверждённое значение передаётся в on_verified.
+
+    Работает как задача event loop (run) - в мультиустройственном режиме на общем пуле,
+    либо в своём потоке (start/stop) - в терминальном режиме и GUI.
+    """
+    def __init__(self, base_url, pool=None, log=print, on_verified=None):
+        self.command_url = f"{base_url}/set3?s3="
+        self.status_url = f"{base_url}/get3"
+        self.pool = pool or AsyncHTTPPool()
+        self.log = log
+        self.on_verified = on_verified
+        self.applied = None
+        self.rpm = np.nan
+        # Статистика: уставок принято, отправлено запросов /set3, сэкономлено объединением, повторов
+        self.submitted = self.sent = self.coalesced = self.retries = 0
+        self.latencies = deque(maxlen=1000)
+        self._pending = None
+        self._lock = threading.Lock()
+        self._wakeup = None
+        self._loop = None
+        self._task = None
+        self._thread = None
+
+    def submit(self, value):
+        """Новая уставка; потокобезопасно, не ждёт сеть."""
+        with self._lock:
+            if self._pending is not None:
+                self.coalesced += 1
+                if metrics.enabled:
+                    metrics.inc("fan_coalesced")
+            self._pending = (value, time.perf_counter())
+            self.submitted += 1
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        if self._pending is not None:
+            self._wakeup.set()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            with self._lock:
+                job, self._pending = self._pending, None
+            if job is not None:
+                await self._apply(*job)
+
+    async def _read_rpm(self):
+        text = await asyncio.wait_for(self.pool.get(self.status_url), FAN_COMMAND_TIMEOUT)
+        # Прошивка отвечает "обороты,скорость %"
+        rpm, _ = parse_rpm(text)
+        if rpm != rpm:
+            raise ESP32Error(f"ответ /get3 не распознан: {text[:20]!r}")
+        return rpm
+
+    async def _apply(self, value, submitted):
+        delay = FAN_RETRY_BASE
+        while True:
+            try:
+                self.sent += 1
+                await asyncio.wait_for(self.pool.get(f"{self.command_url}{value}"), FAN_COMMAND_TIMEOUT)
+                rpm = await self._read_rpm()
+                if value > 0 and rpm < FAN_MIN_RPM:
+                    raise ESP32Error(f"вентилятор не вращается ({rpm:g} об/мин)")
+            except Exception as e:
+                if metrics.enabled:
+                    metrics.inc("fan_commands", result="error")
+                if self._pending is not None:
+                    return  # уже есть новая уставка - эту не добиваем
+                self.log(f"Ошибка команды вентилятору ({value}): {e!r}, повтор через {delay:g}с")
+                self.retries += 1
+                # Ждём задержку, но просыпаемся сразу, если пришла новая уставка
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                if self._pending is not None:
+                    return
+                delay = min(delay * 2, FAN_RETRY_MAX)
+                continue
+            latency = time.perf_counter() - submitted
+            self.applied, self.rpm = value, rpm
+            self.latencies.append(latency)
+            if metrics.enabled:
+                metrics.inc("fan_commands", result="ok")
+                metrics.observe("fan_command", latency)
+            self.log(f"Устройство установлено в {value} ({rpm:g} об/мин)")
+            if self.on_verified is not None:
+                self.on_verified(value, rpm)
+            return
+
+    def summary(self):
+        latency = f", задержка p50 {np.median(self.latencies) * 1000:.0f} мс" if self.latencies else ""
+        return (f"команд вентилятору: уставок {self.submitted}, отправлено {self.sent}, "
+                f"сэкономлено {self.coalesced}, повторов {self.retries}{latency}")
+
+    def start(self):
+        """Фоновый поток со своим event loop (для синхронных режимов)."""
+        self._thread = threading.Thread(target=self._thread_main, name="fan-actuator", daemon=True)
+        self._thread.start()
+
+    def _thread_main(self):
+        loop = asyncio.new_event_loop()
+        self._task = loop.create_task(self.run())
         try:
-            mq2_val = float(requests.get(MQ2_URL, timeout=5).text.strip())
-        except Exception as e:
-            print(f"Ошибка MQ2: {e}")
+            loop.run_until_complete(self._task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.pool.close()
+            loop.close()
 
+    def stop(self, timeout=FAN_COMMAND_TIMEOUT):
+        if self._thread is None:
+            return
+        while self._task is None and self._thread.is_alive():
+            time.sleep(0.01)
+        if self._task is not None:
+            self._loop.call_soon_threadsafe(self._task.cancel)
+        self._thread.join(timeout)
+        self._thread = None
 
-        if ppm_val < baseline_ppm / 4 or ppm_val > baseline_ppm * 4:
-            if last_valid_ppm is not None:
-                ppm_val = last_valid_ppm
-        else:
-            last_valid_ppm = ppm_val
-        
-        if cur_val < baseline_cur / 4 or cur_val > baseline_cur * 4:
-            if last_valid_cur is not None:
-                cur_val = last_valid_cur
+# ======================== Кольцевой буфер истории ===========================
+
+class RingBuffer:
+    """
+    Предвыделенный кольцевой буфер временных рядов: метка времени (epoch, float64) + поля.
+    Каждая строка пишется дважды (i и i + capacity), поэтому последние N точек всегда
+    лежат непрерывно и отдаются срезом без копирования. Добавление - O(1), без реаллокаций.
+    """
+    def __init__(self, capacity, fields=("ppm", "cur", "mq2")):
+        self.capacity = capacity
+        self.fields = fields
+        self._index = {name: i + 1 for i, name in enumerate(fields)}
+        self._data = np.full((len(fields) + 1, 2 * capacity), np.nan)
+        self._head = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, ts, *values):
+        row = (ts,) + values
+        self._data[:, self._head] = row
+        self._data[:, self._head + self.capacity] = row
+        self._head = (self._head + 1) % self.capacity
+        if self._size < self.capacity:
+            self._size += 1
+
+    def _start(self):
+        return 0 if self._size < self.capacity else self._head
+
+    @property
+    def timestamps(self):
+        start = self._start()
+        return self._data[0, start:start + self._size]
+
+    def view(self, field):
+        """Представление (view) поля в хронологическом порядке, без копирования."""
+        start = self._start()
+        return self._data[self._index[field], start:start + self._size]
+
+    def extend(self, ts, *columns):
+        """Добавление пачки строк (массивы одной длины) без цикла по строкам."""
+        rows = np.vstack((ts,) + columns)[:, -self.capacity:]
+        n = rows.shape[1]
+        idx = (self._head + np.arange(n)) % self.capacity
+        self._data[:, idx] = rows
+        self._data[:, idx + self.capacity] = rows
+        self._head = (self._head + n) % self.capacity
+        self._size = min(self._size + n, self.capacity)
+
+    def clear(self):
+        self._head = self._size = 0
+
+def minmax_decimate(x, y_min, y_max, t_from, t_to, width):
+    """
+    Прореживание до width колонок (пикселей): в каждой колонке - минимум и максимум,
+    поэтому одиночный выброс остаётся на графике при любом масштабе.
+    """
+    if not len(x):
+        return x, y_min
+    col = ((x - t_from) * (width / max(t_to - t_from, 1e-9))).astype(np.int64).clip(0, width - 1)
+    starts = np.flatnonzero(np.concatenate(([True], col[1:] != col[:-1])))
+    ends = np.append(starts[1:], len(x)) - 1
+    xs, ys = np.empty(2 * len(starts)), np.empty(2 * len(starts))
+    xs[0::2], xs[1::2] = x[starts], x[ends]
+    ys[0::2], ys[1::2] = np.fmin.reduceat(y_min, starts), np.fmax.reduceat(y_max, starts)
+    return xs, ys
+
+def lttb(x, y, n):
+    """
+    Индексы n точек по Largest-Triangle-Three-Buckets: из каждой корзины берётся точка,
+    образующая наибольший треугольник с соседями, - форма ряда (пики и спады) сохраняется.
+    Первая и последняя точки входят всегда; nan в y не выбираются.
+    """
+    size = len(x)
+    if n >= size or n < 3:
+        return np.arange(size)
+    y = np.where(np.isnan(y), -np.inf, y)
+    edges = np.linspace(1, size - 1, n - 1).astype(np.int64)
+    selected = np.empty(n, dtype=np.int64)
+    selected[0], selected[-1] = 0, size - 1
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nxt_lo, nxt_hi = edges[i + 1], edges[i + 2] if i + 2 < len(edges) else size
+        next_y = y[nxt_lo:nxt_hi]
+        avg_x, avg_y = x[nxt_lo:nxt_hi].mean(), next_y[np.isfinite(next_y)].mean() if np.isfinite(next_y).any() else y[a]
+        with np.errstate(invalid="ignore"):
+            area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.nanargmax(np.where(np.isfinite(area), area, -1)))
+        selected[i + 1] = a
+    return selected
+
+class LODHistory:
+    """
+    История для графиков с уровнями детализации: уровень 0 - сырые отсчёты, уровень k - корзины
+    по LOD_FACTOR**k отсчётов с min/max/mean каждого поля, каждый уровень - RingBuffer на
+    LOD_CAPACITY точек. Агрегаты досчитываются при добавлении, поэтому запрос любого окна
+    (минуты или недели) читает не больше LOD_OVERSAMPLE точек на пиксель - стоимость кадра
+    не зависит от длины окна.
+    """
+    def __init__(self, capacity=LOD_CAPACITY, levels=LOD_LEVELS, factor=LOD_FACTOR, fields=("ppm", "cur", "mq2")):
+        self.fields = fields
+        self.factor = factor
+        self.raw = RingBuffer(capacity, fields)
+        stats = tuple(f"{field}_{stat}" for field in fields for stat in ("min", "max", "mean"))
+        self.levels = [RingBuffer(capacity, stats) for _ in range(levels)]
+        # Строки, ещё не собранные в корзину уровня: [ts, (min, max, mean) по полям] x n
+        self._carry = [np.empty((1 + 3 * len(fields), 0)) for _ in range(levels)]
+
+    def __len__(self):
+        return len(self.raw)
+
+    @property
+    def timestamps(self):
+        return self.raw.timestamps
+
+    def view(self, field):
+        return self.raw.view(field)
+
+    def append(self, ts, *values):
+        self.raw.append(ts, *values)
+        if self.levels:
+            self._aggregate(0, np.array([ts] + [v for v in values for _ in range(3)], dtype=float)[:, None])
+
+    def extend(self, ts, *columns):
+        self.raw.extend(ts, *columns)
+        if self.levels and len(ts):
+            self._aggregate(0, np.vstack([ts] + [c for c in columns for _ in range(3)]).astype(float))
+
+    def _aggregate(self, level, block):
+        block = np.concatenate((self._carry[level], block), axis=1)
+        n = block.shape[1] // self.factor * self.factor
+        self._carry[level] = block[:, n:]
+        if not n:
+            return
+        buckets = block[:, :n].reshape(block.shape[0], -1, self.factor)
+        out = np.empty(buckets.shape[:2])
+        out[0] = buckets[0, :, 0]
+        out[1::3] = np.fmin.reduce(buckets[1::3], axis=2)
+        out[2::3] = np.fmax.reduce(buckets[2::3], axis=2)
+        means = buckets[3::3]
+        valid = ~np.isnan(means)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out[3::3] = np.where(valid, means, 0).sum(axis=2) / valid.sum(axis=2)
+        self.levels[level].extend(*out)
+        if level + 1 < len(self.levels):
+            self._aggregate(level + 1, out)
+
+    def _select(self, t_from, t_to, limit):
+        """
+        Самый подробный уровень, где окно укладывается в limit точек и ещё не вытеснено из буфера.
+        Возвращает (уровень, срез окна на нём, срез сырых отсчётов, ещё не попавших в уровень).
+        """
+        raw_ts = self.raw.timestamps
+        for level, buffer in enumerate([self.raw] + self.levels):
+            ts = buffer.timestamps
+            window = slice(np.searchsorted(ts, t_from), np.searchsorted(ts, t_to, "right"))
+            covers = len(ts) < buffer.capacity or (len(ts) and ts[0] <= t_from)
+            if level == len(self.levels) or (covers and window.stop - window.start <= limit):
+                break
+        if level == 0:
+            return level, window, window
+        # Начало ещё не собранных корзин: самая ранняя строка в переносах нижних уровней
+        pending = [carry[0, 0] for carry in self._carry[:level] if carry.shape[1]]
+        tail_from = max(min(pending), t_from) if pending else np.inf
+        tail = slice(np.searchsorted(raw_ts, tail_from), np.searchsorted(raw_ts, t_to, "right"))
+        return level, window, tail
+
+    def series(self, field, t_from, t_to, width):
+        """Линия поля за [t_from, t_to] для оси шириной width пикселей: (x, y), не больше 2*width точек."""
+        level, window, tail = self._select(t_from, t_to, LOD_OVERSAMPLE * width)
+        raw_x, raw_y = self.raw.timestamps[tail], self.raw.view(field)[tail]
+        if level == 0:
+            x, y_min, y_max = raw_x, raw_y, raw_y
+            if len(x) <= width:
+                return x, y_min
         else:
-            last_valid_cur = cur_val
-        
-        if mq2_val < baseline_mq2 / 4 or mq2_val > baseline_mq2 * 4:
-            if last_valid_mq2 is not None:
-                mq2_val = last_valid_mq2
+            buffer = self.levels[level - 1]
+            x = np.concatenate((buffer.timestamps[window], raw_x))
+            y_min = np.concatenate((buffer.view(f"{field}_min")[window], raw_y))
+            y_max = np.concatenate((buffer.view(f"{field}_max")[window], raw_y))
+        return minmax_decimate(x, y_min, y_max, t_from, t_to, width)
+
+    def points(self, t_from, t_to, n, key="mq2"):
+        """
+        Не больше n точек всех полей за окно, отобранных LTTB по полю key: (ts, поле1, ...).
+        С агрегированных уровней берутся максимумы корзин, чтобы задымление не сгладилось.
+        """
+        level, window, tail = self._select(t_from, t_to, LOD_OVERSAMPLE * n)
+        raw = [self.raw.timestamps[tail]] + [self.raw.view(field)[tail] for field in self.fields]
+        if level == 0:
+            columns = raw
         else:
-            last_valid_mq2 = mq2_val
-
-        mq2_avg_window.append(mq2_val)
-        ppm_avg_window.append(ppm_val)
-        cur_avg_window.append(cur_val)
-        
-        mq2_filtered = np.mean(mq2_avg_window)
-        ppm_filtered = np.mean(ppm_avg_window)
-        cur_filtered = np.mean(cur_avg_window)
-        
-        threshold_mq2, threshold_ppm, threshold_cur = calculate_thresholds()
-        
-        check_smoke(ppm_val, cur_val, mq2_val)
-        
-        bar_mq2 = build_bar(mq2_filtered, threshold_mq2)
-        bar_ppm = build_bar(ppm_filtered, threshold_ppm)
-        bar_cur = build_bar(cur_filtered, threshold_cur)
-        
-        status = "КУРЯТ!" if smoke_detected else "НЕ КУРЯТ"
-        status_msg = (
-            "+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++\n"
-            f"MQ2: {mq2_filtered:.1f} {bar_mq2} (Порог: {threshold_mq2:.1f})\n"
-            f"PPM: {ppm_filtered:.1f} {bar_ppm} (Порог: {threshold_ppm:.1f})\n"
-            f"CUR: {cur_filtered:.1f} {bar_cur} (Порог: {threshold_cur:.1f})\n"
-            f"СТАТУС: {status}\n"
-        )
-        os.system('cls' if os.name == 'nt' else 'clear')
-        print(status_msg)
-    except Exception as e:
-        print(f"Ошибка в update_terminal: {e}")
+            buffer = self.levels[level - 1]
+            columns = [np.concatenate((buffer.timestamps[window], raw[0]))] + [
+                np.concatenate((buffer.view(f"{field}_max")[window], values))
+                for field, values in zip(self.fields, raw[1:])]
+        idx = lttb(columns[0], columns[1 + self.fields.index(key)], n)
+        return tuple(c[idx] for c in columns)
 
-# ======================== Режим GUI: Объединённое окно (2D слева, 3D справа) ===========================
-# Создаем одну фигуру с двумя столбцами
-fig = plt.figure(figsize=(16, 9))
-gs = gridspec.GridSpec(1, 2, width_ratios=[1, 1])
-
-# Левый столбец: 2D графики, организованные в 3 ряда
-gs_left = gridspec.GridSpecFromSubplotSpec(3, 1, subplot_spec=gs[0])
-ax_ppm = fig.add_subplot(gs_left[0, 0])
-ax_cur = fig.add_subplot(gs_left[1, 0])
-ax_mq2 = fig.add_subplot(gs_left[2, 0])
-status_text = ax_ppm.text(0.5, 0.9, "", transform=ax_ppm.transAxes, ha='center', fontsize=12)
-# Настройка подписей для 2D графиков
-ax_ppm.set_title("Датчик PPM")
-ax_ppm.set_xlabel("Время", position=(0, -10))
-ax_ppm.set_ylabel("PPM")
-ax_cur.set_title("Датчик CUR")
-ax_cur.set_xlabel("Время", position=(0, -10))
-ax_cur.set_ylabel("CUR")
-ax_mq2.set_title("Датчик MQ2")
-ax_mq2.set_xlabel("Время", position=(0, -10))
-ax_mq2.set_ylabel("MQ2")
-
-# Правый столбец: 3D график
-ax3d = fig.add_subplot(gs[1], projection='3d')
-
-# Линии для 2D графиков
-line_ppm, = ax_ppm.plot([], [], color='orange', label="PPM")
-line_cur, = ax_cur.plot([], [], color='blue', label="CUR")
-line_mq2, = ax_mq2.plot([], [], color='green', label="MQ2")
-
-ppm_threshold_line = ax_ppm.plot([], [], 'r--', label='Threshold')[0]
-cur_threshold_line = ax_cur.plot([], [], 'r--', label='Threshold')[0]
-mq2_threshold_line = ax_mq2.plot([], [], 'r--', label='Threshold')[0]
-
-def update_plots(frame):
-    global timestamps, ppm_data, cur_data, mq2_data, smoke_detected
-    global last_valid_ppm, last_valid_cur, last_valid_mq2
+    def clear(self):
+        self.raw.clear()
+        for level, buffer in enumerate(self.levels):
+            buffer.clear()
+            self._carry[level] = self._carry[level][:, :0]
+
+# ======================== Хранилище истории на диске ===========================
+
+# Колонки записи: фиксированная ширина, little-endian - каждую можно отобразить через np.memmap
+HISTORY_COLUMNS = (("ts", "<f8"), ("ppm", "<f4"), ("cur", "<f4"), ("mq2", "<f4"), ("fan", "<i2"), ("alarm", "u1"))
+
+class HistoryStore:
+    """
+    Колоночная append-only история одного устройства.
+    Данные лежат сегментами <root>/<начало сегмента, epoch>/<колонка>.bin; имя сегмента и
+    монотонная колонка ts служат индексом времени, так что запрос диапазона читает только
+    нужные сегменты (через memmap + searchsorted) и не разбирает файлы целиком.
+    append() только кладёт строку в очередь - на диск пишет HistoryWriter пачками.
+    Недописанная пачка (обрыв питания) при чтении не видна, а перед первой дозаписью
+    сегмента колонки обрезаются до общего числа строк.
+    """
+    def __init__(self, root, segment_duration=HISTORY_SEGMENT_DURATION):
+        self.root = root
+        self.segment_duration = segment_duration
+        os.makedirs(root, exist_ok=True)
+        self.pending = deque()
+        self._segments = sorted(int(d) for d in os.listdir(root) if d.isdigit())
+        # Сегменты, колонки которых выровнены с открытия хранилища
+        self._aligned = set()
+
+    def append(self, ts, ppm, cur, mq2, fan, alarm):
+        self.pending.append((ts, ppm, cur, mq2, fan, alarm))
+
+    def flush(self):
+        """Записывает накопленные строки; вызывается из потока HistoryWriter."""
+        rows = []
+        while self.pending:
+            rows.append(self.pending.popleft())
+        if not rows:
+            return 0
+        batches = {}
+        for row in rows:
+            if not self._segments or row[0] - self._segments[-1] >= self.segment_duration:
+                self._segments.append(int(row[0]))
+            batches.setdefault(self._segments[-1], []).append(row)
+        for seg, seg_rows in batches.items():
+            self._write_segment(seg, seg_rows)
+        return len(rows)
+
+    def _write_segment(self, seg, rows):
+        path = os.path.join(self.root, str(seg))
+        os.makedirs(path, exist_ok=True)
+        if seg not in self._aligned:
+            self._align_segment(path)
+            self._aligned.add(seg)
+        columns = list(zip(*rows))
+        try:
+            for (name, dtype), values in zip(HISTORY_COLUMNS, columns):
+                with open(os.path.join(path, f"{name}.bin"), "ab") as f:
+                    f.write(np.asarray(values, dtype=dtype).tobytes())
+        except OSError:
+            self._aligned.discard(seg)  # пачка записана не во все колонки
+            raise
+
+    @staticmethod
+    def _segment_rows(path):
+        """Число целых строк, записанных во все колонки сегмента."""
+        return min(os.path.getsize(os.path.join(path, f"{name}.bin")) // np.dtype(dtype).itemsize
+                   if os.path.exists(os.path.join(path, f"{name}.bin")) else 0
+                   for name, dtype in HISTORY_COLUMNS)
+
+    def _align_segment(self, path):
+        """
+        Обрезает колонки до общего числа строк. Колонки дописываются каждая со своего конца:
+        хвост недописанной пачки в одной из них сдвинул бы все следующие строки относительно ts.
+        """
+        n = self._segment_rows(path)
+        for name, dtype in HISTORY_COLUMNS:
+            file = os.path.join(path, f"{name}.bin")
+            if os.path.exists(file) and os.path.getsize(file) != n * np.dtype(dtype).itemsize:
+                os.truncate(file, n * np.dtype(dtype).itemsize)
+
+    def _map_segment(self, seg):
+        path = os.path.join(self.root, str(seg))
+        n = self._segment_rows(path)  # недописанная пачка (обрыв питания) отбрасывается
+        if n == 0:
+            return None
+        return {name: np.memmap(os.path.join(path, f"{name}.bin"), dtype=dtype, mode="r", shape=(n,))
+                for name, dtype in HISTORY_COLUMNS}
+
+    def query(self, t_from, t_to):
+        """Все колонки за [t_from, t_to) как NumPy-массивы."""
+        parts = {name: [] for name, _ in HISTORY_COLUMNS}
+        segments = self._segments
+        for i, seg in enumerate(segments):
+            seg_end = segments[i + 1] if i + 1 < len(segments) else float("inf")
+            if seg_end <= t_from or seg >= t_to:
+                continue
+            columns = self._map_segment(seg)
+            if columns is None:
+                continue
+            ts = columns["ts"]
+            lo, hi = np.searchsorted(ts, t_from, "left"), np.searchsorted(ts, t_to, "left")
+            for name, _ in HISTORY_COLUMNS:
+                parts[name].append(np.array(columns[name][lo:hi]))
+        return {name: (np.concatenate(chunks) if chunks else np.empty(0, dtype=dtype))
+                for (name, dtype), chunks in ((c, parts[c[0]]) for c in HISTORY_COLUMNS)}
+
+    def last(self, seconds):
+        now = time.time()
+        return self.query(now - seconds, now + 1)
+
+class HistoryWriter(threading.Thread):
+    """Один фоновый поток сбрасывает на диск пачки всех открытых хранилищ."""
+    def __init__(self, root=HISTORY_DIR, flush_interval=HISTORY_FLUSH_INTERVAL):
+        super().__init__(name="history-writer", daemon=True)
+        self.root = root
+        self.flush_interval = flush_interval
+        self.stores = []
+        self._stop_event = threading.Event()
+
+    def open(self, name):
+        store = HistoryStore(os.path.join(self.root, name))
+        self.stores.append(store)
+        return store
+
+    def flush(self):
+        for store in list(self.stores):
+            try:
+                store.flush()
+            except OSError as e:
+                print(f"Ошибка записи истории {store.root}: {e}")
+
+    def run(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+def device_history_name(url):
+    """Имя каталога истории устройства: host[_port]."""
+    parts = urlsplit(url)
+    return parts.hostname + (f"_{parts.port}" if parts.port else "")
+
+def start_history(controllers):
+    """Подключает запись истории на диск к контроллерам; None, если HISTORY_DIR не задан."""
+    if HISTORY_DIR is None:
+        return None
+    writer = HistoryWriter(HISTORY_DIR)
+    for ctrl in controllers:
+        ctrl.recorder = writer.open(ctrl.name or device_history_name(ctrl.url))
+    writer.start()
+    return writer
+
+def backfill(buffer, store, seconds):
+    """Заполняет RingBuffer или LODHistory последними данными с диска (поля буфера - по именам колонок)."""
+    data = store.last(seconds)
+    buffer.extend(data["ts"].astype(float), *(data[field].astype(float) for field in buffer.fields))
+    return len(data["ts"])
+
+# ======================== Снимки состояния (тёплый старт) ===========================
+
+SNAPSHOT_VERSION = 1
+
+def save_snapshot(path, state):
+    """Атомарная запись: временный файл, fsync, os.replace - на диске всегда целый снимок."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def load_snapshot(path):
+    """Снимок или None, если файла нет, он повреждён или другой версии."""
     try:
-        ppm_val = cur_val = mq2_val = np.nan
+        with open(path, encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return state if isinstance(state, dict) and state.get("version") == SNAPSHOT_VERSION else None
+
+class SnapshotWriter(threading.Thread):
+    """
+    Один фоновый поток пишет снимки всех контроллеров: цикл управления только передаёт готовый
+    словарь (submit), а open, json, fsync и os.replace идут здесь. На файл хранится лишь
+    последний ещё не записанный снимок - при медленном диске промежуточные пропускаются.
+    """
+    def __init__(self):
+        super().__init__(name="snapshot-writer", daemon=True)
+        self.written = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+
+    def submit(self, path, state, log=print):
+        with self._lock:
+            self._pending[path] = (state, log)
+        self._wakeup.set()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for path, (state, log) in pending.items():
+            try:
+                save_snapshot(path, state)
+                self.written += 1
+            except OSError as e:
+                log(f"Ошибка записи снимка: {e}")
+
+    def run(self):
+        while not self._stopping:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            self.flush()
+        self.flush()
+
+    def stop(self):
+        """Дописывает принятые снимки (в том числе последние при выходе) и завершает поток."""
+        self._stopping = True
+        self._wakeup.set()
+        self.join()
+
+def start_snapshots(controllers):
+    """Включает периодические снимки состояния контроллеров в SNAPSHOT_DIR; None, если он не задан."""
+    if SNAPSHOT_DIR is None:
+        return None
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    writer = SnapshotWriter()
+    for ctrl in controllers:
+        ctrl.snapshot_path = os.path.join(SNAPSHOT_DIR, f"{ctrl.name or device_history_name(ctrl.url)}.json")
+        ctrl.snapshot_writer = writer
+    writer.start()
+    return writer
+
+# ======================== Потоковая статистика для калибровки ===========================
+
+class P2Quantile:
+    """
+    Онлайн-оценка квантиля p алгоритмом P² (Jain & Chlamtac, 1985).
+    Пять маркеров, O(1) памяти и времени на отсчёт - годится для часов данных.
+    """
+    __slots__ = ("p", "count", "q", "n", "np", "dn")
+
+    def __init__(self, p):
+        self.p = p
+        self.count = 0
+        self.q = []                                   # высоты маркеров
+        self.n = [0, 1, 2, 3, 4]                      # позиции маркеров
+        self.np = [0, 2 * p, 4 * p, 2 + 2 * p, 4]     # желаемые позиции
+        self.dn = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        self.count += 1
+        q, n = self.q, self.n
+        if self.count <= 5:
+            q.append(x)
+            if self.count == 5:
+                q.sort()
+            return
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.np[i] += self.dn[i]
+        for i in (1, 2, 3):
+            d = self.np[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                # Параболическая (P²) поправка, при нарушении монотонности - линейная
+                qp = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if not q[i - 1] < qp < q[i + 1]:
+                    qp = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = qp
+                n[i] += d
+
+    def value(self):
+        if self.count == 0:
+            return np.nan
+        if self.count <= 5:
+            return float(np.percentile(self.q, self.p * 100))
+        return self.q[2]
+
+class RobustBaseline:
+    """
+    Медиана без выбросов в потоке: квартили Q1/Q3 оцениваются по всем отсчётам,
+    в медиану попадают только отсчёты внутри (Q1 - 1.5*IQR, Q3 + 1.5*IQR).
+    """
+    def __init__(self):
+        self.q1 = P2Quantile(0.25)
+        self.q3 = P2Quantile(0.75)
+        self.median = P2Quantile(0.5)
+
+    @property
+    def count(self):
+        return self.median.count
+
+    def add(self, x):
+        self.q1.add(x)
+        self.q3.add(x)
+        if self.q1.count > 5:
+            q1, q3 = self.q1.value(), self.q3.value()
+            iqr = q3 - q1
+            if not (q1 - 1.5 * iqr <= x <= q3 + 1.5 * iqr):
+                return
+        self.median.add(x)
+
+    def value(self):
+        return self.median.value()
+
+class StreamingCalibrator:
+    """Потоковые базовые уровни ppm/cur/MQ2 с ограниченной памятью."""
+    def __init__(self):
+        self.ppm = RobustBaseline()
+        self.cur = RobustBaseline()
+        self.mq2 = RobustBaseline()
+
+    def add(self, ppm, cur, mq2):
+        if is_valid_value(ppm):
+            self.ppm.add(ppm)
+        if is_valid_value(cur):
+            self.cur.add(cur)
+        if is_valid_value(mq2):
+            self.mq2.add(mq2)
+
+    def baselines(self, min_samples=1):
+        """(ppm, cur, mq2); None для датчика, по которому отсчётов меньше min_samples."""
+        return tuple(b.value() if b.count >= min_samples else None for b in (self.ppm, self.cur, self.mq2))
+
+# ======================== Детекция: общее ядро ===========================
+
+def compute_thresholds(baseline_mq2, baseline_ppm, baseline_cur):
+    """
+    Пороги baseline * (1 + TRIGGER_PERCENTAGE/100); работает и для чисел, и для массивов.
+    """
+    return (baseline_mq2 * (1 + TRIGGER_PERCENTAGEMQ2 / 100),
+            baseline_ppm * (1 + TRIGGER_PERCENTAGEPPM / 100),
+            baseline_cur * (1 + TRIGGER_PERCENTAGECUR / 100))
+
+def combine_triggers(mq2_trigger, ppm_trigger, cur_trigger):
+    """
+    Срабатывания отдельных датчиков в общее условие с учётом use_mq2_pin/use_getSmoke;
+    для массивов - поэлементная маска.
+    """
+    if use_mq2_pin and use_getSmoke:
+        return mq2_trigger | ppm_trigger | cur_trigger
+    if use_mq2_pin:
+        return mq2_trigger
+    if use_getSmoke:
+        return ppm_trigger | cur_trigger
+    return np.zeros(np.shape(mq2_trigger), dtype=bool) if np.ndim(mq2_trigger) else False
+
+def smoke_condition(mq2_filtered, ppm_filtered, cur_filtered, threshold_mq2, threshold_ppm, threshold_cur):
+    """Условие срабатывания по процентным порогам; для массивов - поэлементная маска."""
+    return combine_triggers(mq2_filtered > threshold_mq2, ppm_filtered > threshold_ppm, cur_filtered > threshold_cur)
+
+def mq2_excess(mq2_filtered, threshold_mq2):
+    """Превышение MQ2 над порогом, отрицательное обнуляется (nan остаётся nan)."""
+    excess = mq2_filtered - threshold_mq2
+    if np.ndim(excess):
+        return np.where(excess < 0, 0.0, excess)
+    return 0 if excess < 0 else excess
+
+class RunningMean:
+    """
+    Скользящее среднее по окну с O(1) обновлением вместо np.mean по deque.
+    Как и np.mean, даёт nan, если в окне есть nan/inf. Сумма пересчитывается
+    заново раз в оборот окна, чтобы не накапливалась ошибка округления.
+    """
+    __slots__ = ("values", "total", "bad", "_since_resum")
+
+    def __init__(self, size):
+        self.values = deque(maxlen=size)
+        self.total = 0.0
+        self.bad = 0
+        self._since_resum = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def append(self, x):
+        values = self.values
+        if len(values) == values.maxlen:
+            old = values[0]
+            if math.isfinite(old):
+                self.total -= old
+            else:
+                self.bad -= 1
+        values.append(x)
+        if math.isfinite(x):
+            self.total += x
+        else:
+            self.bad += 1
+        self._since_resum += 1
+        if self._since_resum >= values.maxlen:
+            self.total = math.fsum(v for v in values if math.isfinite(v))
+            self._since_resum = 0
+
+    def mean(self):
+        if not self.values or self.bad:
+            return np.nan
+        return self.total / len(self.values)
+
+def rolling_mean(values, window=AVG_WINDOW_SIZE):
+    """
+    Скользящее среднее по последней оси, как у окна deque(maxlen=window): первые точки
+    усредняются по тому, что есть. nan портит только окна, в которые попал.
+    """
+    values = np.asarray(values, dtype=float)
+    n = values.shape[-1]
+    total = np.zeros_like(values)
+    count = np.zeros(n)
+    for k in range(min(window, n)):
+        total[..., k:] += values[..., :n - k]
+        count[k:] += 1
+    return total / count
+
+DetectionResult = namedtuple("DetectionResult", "mq2_filtered ppm_filtered cur_filtered thresholds trigger alarm fan")
+
+def _alarm_timeline(ts, trigger, excess, initial_fan=20):
+    """
+    Машина состояний удержания/плавного снижения для одного устройства.
+    Обрабатывается по эпизодам тревоги: внутри эпизода всё считается векторно
+    (cumsum шагов снижения, поиск окончания через argmax), Python-цикл - только по эпизодам.
+    """
+    n = len(ts)
+    alarm = np.zeros(n, dtype=bool)
+    fan = np.empty(n, dtype=np.int16)
+    steps_to_min = max(MAXFANSPEED - 20, 1)
+    current_fan = initial_fan
+    i = 0
+    while i < n:
+        onset = i + int(np.argmax(trigger[i:]))
+        if not trigger[onset]:
+            fan[i:] = current_fan
+            break
+        fan[i:onset] = current_fan
+        rest = slice(onset + 1, n)
+        elapsed = ts[rest] - ts[onset]
+        cond = trigger[rest]
+        # Шаг снижения: тревога продолжается, прошло >= 50% удержания и превышение упало вдвое
+        step = cond & (elapsed >= SMOKE_HOLD_DURATION * 0.5) & (excess[rest] <= excess[onset] * 0.5)
+        steps = np.cumsum(step)
+        ends = step & (steps >= steps_to_min)                   # вентилятор дошёл до минимума
+        ends |= ~cond & (elapsed >= SMOKE_HOLD_DURATION)        # условие ушло и удержание истекло
+        end = onset + 1 + int(np.argmax(ends)) if ends.any() else n
+        alarm[onset:end] = True
+        fan[onset] = MAXFANSPEED
+        fan[onset + 1:end] = np.maximum(MAXFANSPEED - steps[:end - onset - 1], 20)
+        if end < n:
+            fan[end] = 20
+        current_fan = 20
+        i = end + 1
+    return alarm, fan
+
+def detect_batch(ts, ppm, cur, mq2, baseline_ppm, baseline_cur, baseline_mq2, initial_fan=20):
+    """
+    Пакетная детекция без состояния: массивы ppm/cur/mq2 формы (n,) или (устройства, n),
+    baseline - числа или массивы по устройствам. Возвращает скользящие средние, пороги,
+    маску срабатывания и временные ряды тревоги и скорости вентилятора - те же, что дал бы
+    check_smoke() по тем же отсчётам (после прогрева).
+    """
+    ts = np.asarray(ts, dtype=float)
+    mq2_f, ppm_f, cur_f = rolling_mean(mq2), rolling_mean(ppm), rolling_mean(cur)
+    baselines = [np.asarray(b, dtype=float) for b in (baseline_mq2, baseline_ppm, baseline_cur)]
+    if mq2_f.ndim == 2:
+        baselines = [b.reshape(-1, 1) if b.ndim else b for b in baselines]
+    thresholds = compute_thresholds(*baselines)
+    trigger = smoke_condition(mq2_f, ppm_f, cur_f, *thresholds)
+    excess = mq2_excess(mq2_f, thresholds[0])
+    if mq2_f.ndim == 1:
+        alarm, fan = _alarm_timeline(ts, trigger, excess, initial_fan)
+    else:
+        rows = [_alarm_timeline(ts if ts.ndim == 1 else ts[d], trigger[d], excess[d], initial_fan)
+                for d in range(mq2_f.shape[0])]
+        alarm, fan = np.array([r[0] for r in rows]), np.array([r[1] for r in rows])
+    return DetectionResult(mq2_f, ppm_f, cur_f, thresholds, trigger, alarm, fan)
+
+# ======================== Детекторы изменений ===========================
+
+class Detector:
+    """
+    Потоковый детектор одного датчика. update() получает сырой отсчёт (после fallback),
+    скользящее среднее, baseline и процентный порог и возвращает срабатывание; O(1) на отсчёт.
+    Базовый класс - прежнее правило: скользящее среднее выше порога.
+    Срабатывание детектора только начинает тревогу: удержание, снижение скорости и конец
+    тревоги идут по процентному порогу, а в начале тревоги вызывается disarm().
+    """
+    name = "threshold"
+
+    def update(self, x, filtered, baseline, threshold):
+        return filtered > threshold
+
+    def disarm(self):
+        """Тревога началась; процентному порогу взводиться не нужно."""
+
+class ChangeDetector(Detector):
+    """
+    Общее для статистических детекторов: шум оценивается экспоненциальной дисперсией остатков
+    x - baseline, пока среднее ниже процентного порога (в том числе при небольшом подъёме -
+    сдвиг baseline усваивается); остаток в единицах шума обрезается до ±DETECTOR_CLIP,
+    поэтому одиночный выброс не поднимает статистику выше порога. Срабатывание требует подъёма
+    не меньше DETECTOR_MIN_RISE над baseline и дополняет процентный порог, а не заменяет его.
+    После начала тревоги (disarm) детектор молчит, пока отсчёт не опустится ниже этого подъёма:
+    иначе сигнал чуть выше baseline заново начинал бы тревогу сразу после её конца.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.var = 0.0
+        self.armed = True
+
+    def sigma(self, baseline):
+        return max(math.sqrt(self.var), baseline * DETECTOR_MIN_SIGMA)
+
+    def learn(self, residual):
+        # Первые отсчёты - обычное среднее, дальше - экспоненциальное с DETECTOR_NOISE_ALPHA
+        alpha = max(DETECTOR_NOISE_ALPHA, 1 / (self.count + 1))
+        delta = residual - self.mean
+        self.mean += alpha * delta
+        self.var = (1 - alpha) * (self.var + alpha * delta * delta)
+        self.count += 1
+
+    def step(self, z):
+        """
+        Обновление статистики по нормированному остатку z; True - сдвиг вверх.
+        Без статистики (по умолчанию) срабатывает только процентный порог.
+        """
+        return False
+
+    def disarm(self):
+        self.armed = False
+
+    def rearm(self, x, baseline):
+        """Подъём над baseline для срабатывания; ниже него детектор снова взводится. True - подъём есть."""
+        raised = x > baseline * (1 + DETECTOR_MIN_RISE)
+        if not raised:
+            self.armed = True
+        return raised
+
+    def update(self, x, filtered, baseline, threshold):
+        over = filtered > threshold
+        if not (math.isfinite(x) and baseline > 0):
+            return over
+        residual = x - baseline
+        z = min(max((residual - self.mean) / self.sigma(baseline), -DETECTOR_CLIP), DETECTOR_CLIP)
+        # rearm() - на каждом отсчёте: спад ниже подъёма взводит детектор, даже если статистика молчит
+        raised = self.rearm(x, baseline)
+        fired = self.step(z) and raised and self.armed and self.count >= DETECTOR_MIN_SAMPLES
+        if not over:
+            self.learn(residual)
+        return fired or over
+
+class EWMADetector(ChangeDetector):
+    """EWMA-карта: сглаженный остаток выше EWMA_L стандартных отклонений EWMA."""
+    name = "ewma"
+
+    def __init__(self, alpha=EWMA_ALPHA, width=EWMA_L):
+        super().__init__()
+        self.alpha = alpha
+        self.limit = width * math.sqrt(alpha / (2 - alpha))
+        self.level = 0.0
+
+    def step(self, z):
+        self.level += self.alpha * (z - self.level)
+        return self.level > self.limit
+
+class CUSUMDetector(ChangeDetector):
+    """
+    Двусторонний CUSUM: S+ копит подъём (тревога), S- - спад. Спад ниже baseline тревогой
+    не является - это признак устаревшего baseline, он отмечается в shift_down для диагностики.
+    """
+    name = "cusum"
+
+    def __init__(self, k=CUSUM_K, h=CUSUM_H):
+        super().__init__()
+        self.k = k
+        self.h = h
+        self.pos = 0.0
+        self.neg = 0.0
+        self.shift_down = False
+
+    def step(self, z):
+        self.pos = max(0.0, self.pos + z - self.k)
+        self.neg = max(0.0, self.neg - z - self.k)
+        if self.neg > self.h:
+            self.shift_down = True
+            self.neg = 0.0
+        return self.pos > self.h
+
+class RobustZDetector(ChangeDetector):
+    """
+    Скользящий робастный z: медиана трёх последних отсчётов против медианы окна ZSCORE_WINDOW,
+    масштаб - 1.4826 * MAD. Окно хранится отсортированным (bisect), MAD пересчитывается
+    раз в ZSCORE_MAD_EVERY отсчётов - стоимость не растёт с длиной истории.
+    """
+    name = "zscore"
+
+    def __init__(self, window=ZSCORE_WINDOW, threshold=ZSCORE_THRESHOLD):
+        super().__init__()
+        self.threshold = threshold
+        self.values = deque(maxlen=window)
+        self.sorted = []
+        self.recent = deque(maxlen=3)
+        self.mad = 0.0
+        self._since_mad = 0
+
+    def sigma(self, baseline):
+        return max(1.4826 * self.mad, baseline * DETECTOR_MIN_SIGMA)
+
+    def update(self, x, filtered, baseline, threshold):
+        over = filtered > threshold
+        if not (math.isfinite(x) and baseline > 0):
+            return over
+        values = self.values
+        if len(values) == values.maxlen:
+            del self.sorted[bisect.bisect_left(self.sorted, values[0])]
+        values.append(x)
+        bisect.insort(self.sorted, x)
+        self.recent.append(x)
+        self.count += 1
+        n = len(self.sorted)
+        median = self.sorted[n // 2] if n % 2 else (self.sorted[n // 2 - 1] + self.sorted[n // 2]) / 2
+        self._since_mad += 1
+        if self._since_mad >= ZSCORE_MAD_EVERY or not self.mad:
+            deviations = sorted(abs(v - median) for v in values)
+            self.mad = deviations[len(deviations) // 2]
+            self._since_mad = 0
+        current = sorted(self.recent)[len(self.recent) // 2]
+        fired = (self.rearm(current, baseline) and self.armed and self.count >= DETECTOR_MIN_SAMPLES
+                 and (current - median) / self.sigma(baseline) > self.threshold)
+        return fired or over
+
+DETECTOR_TYPES = {cls.name: cls for cls in (Detector, EWMADetector, CUSUMDetector, RobustZDetector)}
+
+def make_detectors(spec=None):
+    """Детекторы по датчикам {"mq2": ..., "ppm": ..., "cur": ...} по именам из DETECTOR_TYPES."""
+    spec = DETECTORS if spec is None else spec
+    return {sensor: DETECTOR_TYPES[spec.get(sensor, "threshold")]() for sensor in ("mq2", "ppm", "cur")}
+
+def parse_detectors(arg):
+    """'cusum' - для всех датчиков; 'mq2:cusum,ppm:ewma' - по датчикам."""
+    if ":" not in arg:
+        spec = {sensor: arg.strip() for sensor in ("mq2", "ppm", "cur")}
+    else:
+        spec = dict(DETECTORS)
+        for item in arg.split(","):
+            sensor, _, name = item.partition(":")
+            spec[sensor.strip()] = name.strip()
+    unknown = set(spec.values()) - set(DETECTOR_TYPES)
+    if unknown:
+        raise ValueError(f"неизвестные детекторы: {', '.join(sorted(unknown))}")
+    return spec
+
+# ======================== Адаптивный опрос ===========================
+
+class AdaptiveSampler:
+    """
+    Интервал до следующего опроса по состоянию сигнала:
+      - тревога, прогрев - базовый интервал (плавное снижение вентилятора идёт по тикам);
+      - сырой отсчёт любого датчика выше SAMPLING_NEAR_THRESHOLD порога - минимальный интервал
+        (не усреднённый: среднее запаздывает на окно, а окно при редком опросе длинное);
+      - рост к порогу - такой, чтобы до прогнозного пересечения успело пройти SAMPLING_LOOKAHEAD опросов;
+      - спокойный воздух - интервал растёт в SAMPLING_BACKOFF раз за тик до максимального.
+    Бюджет запросов узла - маркерная корзина: при исчерпании интервал растягивается. Списывается
+    фактическая стоимость последнего опроса (Sample.requests, с телеметрией - больше);
+    requests_per_poll - стоимость до первого отсчёта.
+    """
+    def __init__(self, min_interval=SAMPLING_MIN_INTERVAL, max_interval=SAMPLING_MAX_INTERVAL,
+                 budget_per_hour=SAMPLING_BUDGET_PER_HOUR, burst=SAMPLING_BUDGET_BURST, requests_per_poll=2):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.rate = budget_per_hour / 3600
+        self.burst = burst
+        self.tokens = burst
+        self.cost = requests_per_poll
+        self.interval = min_interval
+        self._prev = None  # (ts, доли порога) прошлого отсчёта
+
+    def next_interval(self, ctrl, base=INTERVAL):
+        sample = ctrl.last_sample
+        if sample is None or not ctrl.sensor_warmed_up or ctrl.smoke_detected:
+            interval = base
+            self._prev = None
+        else:
+            # По сырому отсчёту: усреднённое значение запаздывает на окно, а окно при редком опросе длинное
+            ratios = tuple(v / t if t > 0 and is_valid_value(v) else np.nan
+                           for v, t in zip((sample.mq2, sample.ppm, sample.cur), ctrl.calculate_thresholds()))
+            interval = self.interval * SAMPLING_BACKOFF
+            if any(r >= SAMPLING_NEAR_THRESHOLD for r in ratios):
+                interval = self.min_interval
+            elif self._prev is not None and sample.ts > self._prev[0]:
+                dt = sample.ts - self._prev[0]
+                for r, prev in zip(ratios, self._prev[1]):
+                    slope = (r - prev) / dt
+                    if slope > 0:
+                        interval = min(interval, (1 - r) / slope / SAMPLING_LOOKAHEAD)
+            self._prev = (sample.ts, ratios)
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        self.interval = interval
+        # Маркеры копятся за время ожидания; не хватает на опрос - ждём дольше
+        cost = sample.requests if sample is not None else self.cost
+        self.tokens = min(self.burst, self.tokens + interval * self.rate)
+        if self.tokens < cost:
+            interval += (cost - self.tokens) / self.rate
+            self.tokens = cost
+        self.tokens -= cost
+        return interval
+
+# ======================== Контроллер одного устройства ===========================
+
+class DeviceController:
+    """
+    Состояние и логика одного узла ESP32: базовые уровни, окна усреднения,
+    состояние тревоги и вентилятора. Каждый узел держит всё своё, глобальных переменных нет.
+    """
+    def __init__(self, url, name=None, pool=None, clock=time.time):
+        self.url = url
+        self.name = name
+        # Источник времени для детекции и калибровки; при воспроизведении подменяется
+        self.clock = clock
+        # Куда выводить сообщения (print или хвост лога терминальной отрисовки)
+        self.log_sink = print
+        self.poller = SensorPoller(url, pool=pool, log=self.log)
+        self.actuator = FanActuator(url, pool=pool, log=self.log, on_verified=self._fan_verified)
+
+        # Калибровка
+        self.baseline_ppm = self.baseline_cur = self.baseline_mq2 = 0
+        self.sensor_warmed_up = False
+        self.warmup_start_time = None  # Время начала прогрева
+        self._calibration = None
+        # Фоновая перекалибровка: baseline обновляется раз в RECALIBRATION_INTERVAL без паузы детекции
+        self._recalibration = StreamingCalibrator()
+        self.last_calibration_time = None
+
+        # Тревога
+        self.smoke_detected = False
+        self.smoke_start_time = 0
+        # fan_setpoint - запрошенная скорость (по ней идёт плавное снижение),
+        # current_device_state - скорость, подтверждённая чтением /get3
+        self.fan_setpoint = 20
+        self.current_device_state = 20
+        self.fan_rpm = np.nan
+        # Последняя Telemetry узла; fan_stalled - вентилятор не вращается во время тревоги
+        self.telemetry = None
+        self.fan_stalled = False
+        self._stall_count = 0
+        self._fan_command_time = -math.inf
+        # Начальное превышение MQ2 при активации режима
+        self.initial_excess_mq2 = None
+        # Тревога подтверждена процентным порогом (а не только статистическим детектором)
+        self.alarm_confirmed = False
+
+        # Детекторы срабатывания по датчикам
+        self.detectors = make_detectors()
+
+        # Буферы для усреднения
+        self.mq2_avg_window = RunningMean(AVG_WINDOW_SIZE)
+        self.ppm_avg_window = RunningMean(AVG_WINDOW_SIZE)
+        self.cur_avg_window = RunningMean(AVG_WINDOW_SIZE)
+
+        # Для сохранения последних валидных значений (fallback)
+        self.last_valid_ppm = None
+        self.last_valid_cur = None
+        self.last_valid_mq2 = None
+
+        # Адаптивный интервал опроса (None - фиксированный)
+        self.sampler = AdaptiveSampler() if ADAPTIVE_SAMPLING else None
+        self.poll_interval = INTERVAL
+        # Подмена отправки команд (воспроизведение): команда считается применённой сразу
+        self.command_sender = None
+        self.polls = 0
+        # HistoryStore устройства, если история на диске включена
+        self.recorder = None
+        # Файл снимка состояния для тёплого старта и поток его записи, если снимки включены
+        self.snapshot_path = None
+        self.snapshot_writer = None
+        self._last_checkpoint = 0
+        # Последний обработанный отсчёт (для таблицы узлов и дашбордов)
+        self.last_sample = None
+        self.last_filtered = None
+
+    def log(self, msg):
+        self.log_sink(f"[{self.name}] {msg}" if self.name else msg)
+
+    def send_device_command(self, value, force=False):
+        """Новая уставка вентилятора; сеть не ждём - отправкой и проверкой занимается actuator."""
+        if not (force or self.fan_setpoint != value):
+            return
+        self.fan_setpoint = value
+        self._fan_command_time = self.clock()
+        if self.command_sender is not None:
+            self.command_sender(self, value)
+            self.current_device_state = value
+            return
+        self.actuator.submit(value)
+
+    def next_poll_interval(self, base=INTERVAL):
+        """Интервал до следующего опроса: фиксированный base или от адаптивного планировщика."""
+        self.poll_interval = base if self.sampler is None else self.sampler.next_interval(self, base)
+        return self.poll_interval
+
+    def _fan_verified(self, value, rpm):
+        self.current_device_state = value
+        self.fan_rpm = rpm
+
+    def update_telemetry(self, telemetry):
+        """
+        Обороты вентилятора из Telemetry. Во время тревоги, после FAN_STALL_GRACE на разгон,
+        FAN_STALL_SAMPLES замеров подряд ниже FAN_MIN_RPM означают, что вентилятор встал:
+        пишем в лог и повторяем команду (actuator добивается подтверждения с повторами).
+        Признак сбрасывается только когда обороты вернулись или тревога кончилась: время на
+        разгон после повтора команды замеры не считает, но и не сбрасывает.
+        """
+        self.telemetry = telemetry
+        rpm = telemetry.rpm3
+        if rpm != rpm:
+            return  # /get3 не ответил - о вращении ничего не известно
+        self.fan_rpm = rpm
+        if self.smoke_detected and self.fan_setpoint > 0 and rpm < FAN_MIN_RPM:
+            if self.clock() - self._fan_command_time < FAN_STALL_GRACE:
+                return  # вентилятор ещё разгоняется
+            self._stall_count += 1
+            if self._stall_count == FAN_STALL_SAMPLES:
+                self.fan_stalled = True
+                self.log(f"ВЕНТИЛЯТОР НЕ ВРАЩАЕТСЯ во время тревоги: {rpm:g} об/мин при скорости "
+                         f"{self.fan_setpoint}%. Повтор команды.")
+                if metrics.enabled:
+                    metrics.inc("fan_stalls")
+                self.send_device_command(self.fan_setpoint, force=True)
+            return
+        self._stall_count = 0
+        if self.fan_stalled:
+            self.fan_stalled = False
+            if rpm >= FAN_MIN_RPM:
+                self.log(f"Вентилятор снова вращается: {rpm:g} об/мин.")
+
+    # ---------- калибровка ----------
+
+    def start_calibration(self):
+        self.warmup_start_time = self.clock() + CALIBRATION_DURATION + 30
+        self.sensor_warmed_up = False
+        self._calibration = StreamingCalibrator()
+        self.log("Калибровка датчиков...")
+
+    def add_calibration_sample(self, sample):
+        self._calibration.add(sample.ppm, sample.cur, sample.mq2)
+
+    def _apply_baselines(self, calibrator, min_samples=1):
+        ppm, cur, mq2 = calibrator.baselines(min_samples)
+        if ppm is not None:
+            self.baseline_ppm = ppm
+        if cur is not None:
+            self.baseline_cur = cur
+        if mq2 is not None:
+            self.baseline_mq2 = mq2
+        self.last_calibration_time = self.clock()
+
+    def finish_calibration(self):
+        """Базовые уровни - потоковые медианы без выбросов."""
+        self._apply_baselines(self._calibration)
+        self._calibration = None
+        self._recalibration = StreamingCalibrator()
+        self.log(f"Калибровка завершена.\n  ppm: {self.baseline_ppm:.1f}\n  cur: {self.baseline_cur:.1f}\n  MQ2: {self.baseline_mq2:.1f}")
+
+    def _update_recalibration(self, ppm, cur, mq2):
+        """
+        Копит отсчёты вне тревоги и раз в RECALIBRATION_INTERVAL подменяет baseline. Тревога,
+        которую начал детектор, а процентный порог так и не подтвердил (подъём в несколько
+        процентов, например сдвиг baseline), перекалибровку не останавливает.
+        """
+        if (self.last_calibration_time is None or not self.sensor_warmed_up
+                or (self.smoke_detected and self.alarm_confirmed)):
+            return
+        self._recalibration.add(ppm, cur, mq2)
+        if self.clock() - self.last_calibration_time >= RECALIBRATION_INTERVAL:
+            self._apply_baselines(self._recalibration, RECALIBRATION_MIN_SAMPLES)
+            self._recalibration = StreamingCalibrator()
+            self.log(f"Фоновая перекалибровка: ppm {self.baseline_ppm:.1f}, cur {self.baseline_cur:.1f}, MQ2 {self.baseline_mq2:.1f}")
+
+    def calibrate(self):
+        """
+        Калибровка всех датчиков (getSmoke: ppm и cur, а также MQ2).
+        Отсчёты идут в потоковые оценки квантилей, выбросы отсекаются по IQR, baseline - медиана.
+        """
+        self.start_calibration()
+        start_time = self.clock()
+        while self.clock() - start_time < CALIBRATION_DURATION:
+            self.add_calibration_sample(self.poller.poll_sync())
+            time.sleep(INTERVAL)
+        self.finish_calibration()
+
+    async def calibrate_async(self, interval=INTERVAL):
+        self.start_calibration()
+        start_time = self.clock()
+        while self.clock() - start_time < CALIBRATION_DURATION:
+            self.add_calibration_sample(await self.poller.poll())
+            await asyncio.sleep(interval)
+        self.finish_calibration()
+
+    # ---------- снимки состояния и тёплый старт ----------
+
+    def snapshot(self):
+        return {
+            "version": SNAPSHOT_VERSION,
+            "saved_at": self.clock(),
+            "url": self.url,
+            "baselines": [self.baseline_ppm, self.baseline_cur, self.baseline_mq2],
+            "last_calibration_time": self.last_calibration_time,
+            "sensor_warmed_up": self.sensor_warmed_up,
+            "warmup_start_time": self.warmup_start_time,
+            "windows": [list(w.values) for w in (self.mq2_avg_window, self.ppm_avg_window, self.cur_avg_window)],
+            "last_valid": [self.last_valid_ppm, self.last_valid_cur, self.last_valid_mq2],
+            "smoke_detected": self.smoke_detected,
+            "smoke_start_time": self.smoke_start_time,
+            "alarm_confirmed": self.alarm_confirmed,
+            "initial_excess_mq2": self.initial_excess_mq2,
+            "fan_setpoint": self.fan_setpoint,
+        }
+
+    def checkpoint(self):
+        """Снимок в очередь записи на диск; до окончания калибровки сохранять нечего."""
+        if self.snapshot_writer is None or self.last_calibration_time is None:
+            return
+        self._last_checkpoint = self.clock()
+        self.snapshot_writer.submit(self.snapshot_path, self.snapshot(), self.log)
+
+    def restore(self, state):
+        self.baseline_ppm, self.baseline_cur, self.baseline_mq2 = state["baselines"]
+        self.last_calibration_time = state["last_calibration_time"]
+        self.mq2_avg_window, self.ppm_avg_window, self.cur_avg_window = (
+            RunningMean(AVG_WINDOW_SIZE) for _ in range(3))
+        for window, values in zip((self.mq2_avg_window, self.ppm_avg_window, self.cur_avg_window), state["windows"]):
+            for value in values:
+                window.append(value)
+        self.last_valid_ppm, self.last_valid_cur, self.last_valid_mq2 = state["last_valid"]
+        self.smoke_detected = state["smoke_detected"]
+        self.smoke_start_time = state["smoke_start_time"]
+        self.alarm_confirmed = state.get("alarm_confirmed", True)
+        self.initial_excess_mq2 = state["initial_excess_mq2"]
+        # Прогрев MQ2 отсчитывается по абсолютному времени: снимок, снятый до его окончания, дождётся остатка
+        self.sensor_warmed_up = state["sensor_warmed_up"]
+        self.warmup_start_time = state["warmup_start_time"]
+        # Оценки шума детекторов не сохраняются - до DETECTOR_MIN_SAMPLES работает процентный порог
+        self.detectors = {sensor: type(d)() for sensor, d in self.detectors.items()}
+        self._calibration = None
+        self._recalibration = StreamingCalibrator()
+        # Реальная скорость после перезапуска неизвестна - уставка отправляется и проверяется заново
+        self.send_device_command(state["fan_setpoint"], force=True)
+
+    def _fresh_snapshot(self):
+        """Снимок, пригодный для тёплого старта, или None."""
+        if self.snapshot_path is None:
+            return None
+        state = load_snapshot(self.snapshot_path)
+        if state is None:
+            return None
+        age = self.clock() - state["saved_at"]
+        if not 0 <= age <= SNAPSHOT_MAX_AGE:
+            self.log(f"Снимок состояния устарел ({age:.0f} с) - полная калибровка")
+            return None
+        return state
+
+    def _snapshot_matches(self, state, samples):
+        """
+        Живые отсчёты согласуются со снимком: медиана каждого датчика в пределах SNAPSHOT_TOLERANCE
+        от baseline либо выше порога (идёт задымление - тогда baseline снимка тем более нужен).
+        """
+        baseline_ppm, baseline_cur, baseline_mq2 = state["baselines"]
+        threshold_mq2, threshold_ppm, threshold_cur = compute_thresholds(baseline_mq2, baseline_ppm, baseline_cur)
+        checked = 0
+        for field, baseline, threshold in (("ppm", baseline_ppm, threshold_ppm), ("cur", baseline_cur, threshold_cur),
+                                           ("mq2", baseline_mq2, threshold_mq2)):
+            values = [getattr(s, field) for s in samples if is_valid_value(getattr(s, field))]
+            if not values or baseline <= 0:
+                continue
+            live = float(np.median(values))
+            if abs(live / baseline - 1) > SNAPSHOT_TOLERANCE and live <= threshold:
+                self.log(f"Снимок не совпадает с датчиками: {field} {live:.1f} при baseline {baseline:.1f} - полная калибровка")
+                return False
+            checked += 1
+        return checked > 0
+
+    def _finish_warm_start(self, state, samples):
+        if not self._snapshot_matches(state, samples):
+            return False
+        self.restore(state)
+        # Проверочные отсчёты сразу идут в детекцию
+        for sample in samples:
+            self.process(sample)
+        self.log(f"Тёплый старт по снимку {self.clock() - state['saved_at']:.0f} с назад: ppm {self.baseline_ppm:.1f}, "
+                 f"cur {self.baseline_cur:.1f}, MQ2 {self.baseline_mq2:.1f}"
+                 f"{', тревога активна' if self.smoke_detected else ''}")
+        return True
+
+    def warm_start(self):
+        """Тёплый старт по свежему снимку вместо калибровки и прогрева; False - нужна калибровка."""
+        state = self._fresh_snapshot()
+        if state is None:
+            return False
+        samples = []
+        for _ in range(SNAPSHOT_VALIDATION_SAMPLES):
+            samples.append(self.poller.poll_sync())
+            time.sleep(SNAPSHOT_VALIDATION_INTERVAL)
+        return self._finish_warm_start(state, samples)
+
+    async def warm_start_async(self):
+        state = self._fresh_snapshot()
+        if state is None:
+            return False
+        samples = []
+        for _ in range(SNAPSHOT_VALIDATION_SAMPLES):
+            samples.append(await self.poller.poll())
+            await asyncio.sleep(SNAPSHOT_VALIDATION_INTERVAL)
+        return self._finish_warm_start(state, samples)
+
+    # ---------- детекция ----------
+
+    def calculate_thresholds(self):
+        """
+        Вычисление порогов для датчиков как baseline * (1 + TRIGGER_PERCENTAGE/100).
+        """
+        return compute_thresholds(self.baseline_mq2, self.baseline_ppm, self.baseline_cur)
+
+    def check_smoke(self, ppm, cur, mq2):
+        """
+        Детекция дыма:
+          - Если оба датчика используются, срабатывание, если MQ2 и хотя бы один из getSmoke (ppm или cur) превышают порог.
+          - Если один из датчиков отключён, то детекция по оставшемуся.
+          - При активации фиксируется начальное превышение (initial_excess_mq2).
+          - Если в режиме задымления, начиная с 50% времени, текущее превышение MQ2 снижается до 50% от начального, скорость вентилятора уменьшается постепенно.
+        """
+        if not self.sensor_warmed_up and self.clock() - self.warmup_start_time >= WARMUP_TIME:
+            self.sensor_warmed_up = True
+            self.log("Датчик прогрелся, данные теперь можно использовать.")
+        if not self.sensor_warmed_up:
+            self.log("Датчик ещё не прогрет. Пропускаем данные.")
+            return  # Пропускаем обработку данных, если датчик не прогрелся
+        self.mq2_avg_window.append(mq2)
+        self.ppm_avg_window.append(ppm)
+        self.cur_avg_window.append(cur)
+
+        mq2_filtered = self.mq2_avg_window.mean()
+        ppm_filtered = self.ppm_avg_window.mean()
+        cur_filtered = self.cur_avg_window.mean()
+
+        threshold_mq2, threshold_ppm, threshold_cur = self.calculate_thresholds()
+        detectors = self.detectors
+        triggered = combine_triggers(
+            detectors["mq2"].update(mq2, mq2_filtered, self.baseline_mq2, threshold_mq2),
+            detectors["ppm"].update(ppm, ppm_filtered, self.baseline_ppm, threshold_ppm),
+            detectors["cur"].update(cur, cur_filtered, self.baseline_cur, threshold_cur))
+        over = smoke_condition(mq2_filtered, ppm_filtered, cur_filtered, threshold_mq2, threshold_ppm, threshold_cur)
+        # Детекторы только начинают тревогу; удержание и снижение скорости - по процентному порогу
+        condition = over if self.smoke_detected else triggered
+
+        if condition:
+            if not self.smoke_detected:
+                self.smoke_start_time = self.clock()
+                self.initial_excess_mq2 = mq2_excess(mq2_filtered, threshold_mq2)
+                self.send_device_command(MAXFANSPEED)
+                self.smoke_detected = True
+                self.alarm_confirmed = over
+                for detector in detectors.values():
+                    detector.disarm()
+                self.log("Обнаружено задымление!")
+            else:
+                if not self.alarm_confirmed:
+                    # Тревога детектора подтвердилась порогом: снижение скорости - от этого превышения
+                    self.alarm_confirmed = True
+                    self.initial_excess_mq2 = mq2_excess(mq2_filtered, threshold_mq2)
+                elapsed = self.clock() - self.smoke_start_time
+                current_excess = mq2_excess(mq2_filtered, threshold_mq2)
+                # Если прошло 50% от SMOKE_HOLD_DURATION
+                if elapsed >= SMOKE_HOLD_DURATION * 0.5:
+                    # После 75% времени продолжаем мониторинг и, если превышение снизилось до 50% от начального, уменьшаем скорость
+                    if current_excess <= self.initial_excess_mq2 * 0.5:
+                        new_speed = max(20, self.fan_setpoint - 1)
+                        if new_speed != self.fan_setpoint:
+                            self.send_device_command(new_speed)
+                            self.log(f"Снижение скорости вентилятора до {new_speed} (elapsed: {elapsed:.1f}s, excess: {current_excess:.1f})")
+                        if new_speed == 20:
+                            self.smoke_detected = False
+                            self.log("Задымление прекращено (минимальная скорость).")
+        else:
+            if self.smoke_detected and (self.clock() - self.smoke_start_time >= SMOKE_HOLD_DURATION):
+                self.smoke_detected = False
+                self.send_device_command(20)
+                self.log("Задымление прекратилось.")
+
+    def _fallback(self, value, baseline, last_valid):
+        """Невалидное значение или выход за [baseline/4, baseline*4] заменяется последним валидным."""
+        if not is_valid_value(value) or (baseline > 0 and (value < baseline / 4 or value > baseline * 4)):
+            return (last_valid if last_valid is not None else value), last_valid
+        return value, value
+
+    def process(self, sample):
+        """
+        Один цикл обработки отсчёта: подстановка последних валидных значений, детекция.
+        Возвращает (ppm, cur, mq2) после fallback и усреднённые (mq2, ppm, cur) для отображения.
+        """
+        self.polls += 1
+        ppm_val, self.last_valid_ppm = self._fallback(sample.ppm, self.baseline_ppm, self.last_valid_ppm)
+        cur_val, self.last_valid_cur = self._fallback(sample.cur, self.baseline_cur, self.last_valid_cur)
+        mq2_val, self.last_valid_mq2 = self._fallback(sample.mq2, self.baseline_mq2, self.last_valid_mq2)
+
+        was_detected = self.smoke_detected
+        if metrics.enabled:
+            start = time.perf_counter()
+            self.check_smoke(ppm_val, cur_val, mq2_val)
+            metrics.observe("check_smoke", time.perf_counter() - start)
+        else:
+            self.check_smoke(ppm_val, cur_val, mq2_val)
+        if sample.telemetry is not None:
+            self.update_telemetry(sample.telemetry)
+        # Во время тревоги обороты читаются чаще - чтобы заметить вставший вентилятор
+        self.poller.telemetry_interval = TELEMETRY_ALARM_INTERVAL if self.smoke_detected else TELEMETRY_INTERVAL
+        self._update_recalibration(ppm_val, cur_val, mq2_val)
+        if self.snapshot_writer is not None and (self.smoke_detected != was_detected
+                                               or self.clock() - self._last_checkpoint >= SNAPSHOT_INTERVAL):
+            self.checkpoint()
+        if self.recorder is not None:
+            self.recorder.append(sample.ts, ppm_val, cur_val, mq2_val, self.current_device_state, self.smoke_detected)
+
+        # До прогрева окна не заполняются - показываем сырые значения
+        if self.mq2_avg_window:
+            filtered = (self.mq2_avg_window.mean(), self.ppm_avg_window.mean(), self.cur_avg_window.mean())
+        else:
+            filtered = (mq2_val, ppm_val, cur_val)
+        self.last_sample, self.last_filtered = sample, filtered
+        if dashboard.enabled:
+            dashboard.publish(self)
+        return (ppm_val, cur_val, mq2_val), filtered
+
+# ======================== Опрос множества устройств ===========================
+
+def load_devices(path):
+    """
+    Список устройств из JSON: ["http://192.168.1.75", {"name": "kitchen", "url": "http://..."}, ...].
+    """
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+    devices = []
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {"url": entry}
+        devices.append((entry.get("name") or device_history_name(entry["url"]), entry["url"]))
+    return devices
+
+class FleetScheduler:
+    """
+    Опрос десятков-сотен узлов из одного процесса в одном event loop.
+    Каждый узел работает в своей задаче со своим расписанием и крайним сроком опроса,
+    поэтому медленный узел не добавляет задержку остальным. HTTP-соединения - из общего пула.
+    """
+    def __init__(self, devices, interval=INTERVAL, max_connections=FLEET_MAX_CONNECTIONS, table=None, rows=None):
+        self.interval = interval
+        self.pool = AsyncHTTPPool(max_connections=max_connections)
+        self.controllers = [DeviceController(url, name=name, pool=self.pool) for name, url in devices]
+        # Общая таблица состояния парка (FleetTable) и строки этих узлов в ней - в процессе-шарде
+        self.table = table
+        self.rows = list(rows) if rows is not None else list(range(len(self.controllers)))
+
+    async def _run_device(self, ctrl, row, calibrate, stop_at):
+        if calibrate and not await ctrl.warm_start_async():
+            ctrl.send_device_command(20, force=True)
+            await ctrl.calibrate_async(self.interval)
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while stop_at is None or loop.time() < stop_at:
+            try:
+                tick_start = time.perf_counter()
+                ctrl.process(await ctrl.poller.poll())
+                if self.table is not None:
+                    self.table.publish(row, ctrl)
+                if metrics.enabled:
+                    metrics.observe("tick", time.perf_counter() - tick_start)
+            except Exception as e:
+                ctrl.log(f"Ошибка цикла устройства: {e!r}")
+            # Сетка тиков: задержка одного опроса не сдвигает расписание
+            next_tick += ctrl.next_poll_interval(self.interval)
+            await asyncio.sleep(max(0, next_tick - loop.time()))
+
+    async def _summary(self):
+        last_polls = 0
+        while True:
+            await asyncio.sleep(FLEET_SUMMARY_INTERVAL)
+            polls = sum(c.polls for c in self.controllers)
+            alarms = [c.name for c in self.controllers if c.smoke_detected]
+            sent = sum(c.actuator.sent for c in self.controllers)
+            coalesced = sum(c.actuator.coalesced for c in self.controllers)
+            print(f"Узлов: {len(self.controllers)}, опросов/с: {(polls - last_polls) / FLEET_SUMMARY_INTERVAL:.1f}, "
+                  f"тревога: {', '.join(alarms) if alarms else 'нет'}, "
+                  f"команд вентилятору: {sent} (сэкономлено {coalesced})")
+            last_polls = polls
+
+    async def _table(self, renderer, log_tail):
+        """Таблица узлов в терминале с частотой TERMINAL_REFRESH_RATE."""
+        while True:
+            rows = shutil.get_terminal_size().lines - 4 - TERMINAL_LOG_LINES
+            lines = fleet_table_lines(self.controllers, max(rows, 1))
+            lines.append("")
+            lines.extend(log_tail.lines)
+            renderer.render(lines)
+            await asyncio.sleep(1 / TERMINAL_REFRESH_RATE)
+
+    async def run(self, duration=None, calibrate=True, summary=True, table=False):
+        loop = asyncio.get_running_loop()
+        stop_at = None if duration is None else loop.time() + duration
+        # Вентиляторы управляются отдельными задачами, детекция их не ждёт
+        background = [loop.create_task(c.actuator.run()) for c in self.controllers]
+        renderer = None
+        if table:
+            renderer, log_tail = TerminalRenderer(), LogTail()
+            for ctrl in self.controllers:
+                ctrl.log_sink = log_tail
+            background.append(loop.create_task(self._table(renderer, log_tail)))
+        elif summary:
+            background.append(loop.create_task(self._summary()))
         try:
-            response = requests.get(GET_URL, timeout=5).text
-            ppm_match = re.search(r'ppm:(\d+\.?\d*)', response)
-            cur_match = re.search(r'cur:(\d+\.?\d*)', response)
-            if ppm_match and cur_match:
-                ppm_val = float(ppm_match.group(1).replace(',', '.'))
-                cur_val = float(cur_match.group(1).replace(',', '.'))
-        except Exception as e:
-            print(f"Ошибка getSmoke: {e}")
+            await asyncio.gather(*(self._run_device(c, row, calibrate, stop_at)
+                                   for c, row in zip(self.controllers, self.rows)))
+        finally:
+            for task in background:
+                task.cancel()
+            await asyncio.gather(*background, return_exceptions=True)
+            for ctrl in self.controllers:
+                ctrl.checkpoint()
+            if renderer is not None:
+                renderer.close()
+            self.pool.close()
+
+# ======================== Шардирование по процессам ===========================
+
+# Строка узла в общей таблице. seq - счётчик seqlock (первым полем: при копировании строки
+# он читается раньше данных), нечётный - строка в процессе записи.
+FLEET_TABLE_DTYPE = np.dtype([
+    ("seq", "<u4"), ("ts", "<f8"), ("polls", "<u8"),
+    ("alarm", "u1"), ("calibrated", "u1"), ("stale", "u1"),
+    ("fan", "<i2"), ("fan_setpoint", "<i2"), ("fan_rpm", "<f4"), ("latency", "<f4"),
+    ("ppm", "<f4"), ("cur", "<f4"), ("mq2", "<f4"),
+    ("mq2_filtered", "<f4"), ("ppm_filtered", "<f4"), ("cur_filtered", "<f4"),
+    ("threshold_mq2", "<f4"), ("threshold_ppm", "<f4"), ("threshold_cur", "<f4"),
+])
+# Заголовок: версия раскладки, число узлов и шардов, pid супервизора
+FLEET_TABLE_HEADER = np.dtype([("version", "<u4"), ("nodes", "<u4"), ("shards", "<u4"), ("pid", "<u4")])
+FLEET_TABLE_VERSION = 1
+FLEET_NAME_DTYPE = np.dtype("S32")
+
+def process_alive(pid):
+    """Жив ли процесс pid: os.kill(pid, 0) только проверяет, сигнал не посылается."""
+    if os.name == "nt":
+        return True  # там разделяемая память без владельца исчезает сама: раз она есть - владелец жив
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # процесс есть, но чужой
+    return True
+
+def _untrack_shm(shm):
+    """Сторонний процесс: его трекер ресурсов не должен удалить чужую память при выходе."""
+    import multiprocessing
+    if multiprocessing.parent_process() is None and os.name != "nt":
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+
+class FleetTable:
+    """
+    Состояние всех узлов парка в разделяемой памяти: заголовок, имена узлов, строка
+    FLEET_TABLE_DTYPE на узел и метки жизни шардов. Каждый шард пишет только свои строки;
+    супервизор, дашборд или API читают весь парк прямо из памяти, без передачи данных
+    через IPC. Запись строки - seqlock: seq нечётный во время записи, read() перечитывает
+    строки, которые менялись во время копирования.
+    """
+    def __init__(self, shm, owner=False):
+        self.shm = shm
+        self.owner = owner
+        header = np.ndarray((), dtype=FLEET_TABLE_HEADER, buffer=shm.buf)
+        if header["version"] != FLEET_TABLE_VERSION:
+            raise ValueError(f"Таблица {shm.name}: неизвестная версия {header['version']}")
+        self.header = header
+        nodes, shards = int(header["nodes"]), int(header["shards"])
+        offset = FLEET_TABLE_HEADER.itemsize
+        self._names = np.ndarray((nodes,), dtype=FLEET_NAME_DTYPE, buffer=shm.buf, offset=offset)
+        offset += nodes * FLEET_NAME_DTYPE.itemsize
+        self.rows = np.ndarray((nodes,), dtype=FLEET_TABLE_DTYPE, buffer=shm.buf, offset=offset)
+        offset += nodes * FLEET_TABLE_DTYPE.itemsize
+        self.heartbeats = np.ndarray((shards,), dtype="<f8", buffer=shm.buf, offset=offset)
+        self._seq = self.rows["seq"]
+
+    @staticmethod
+    def size(nodes, shards):
+        return (FLEET_TABLE_HEADER.itemsize + nodes * (FLEET_NAME_DTYPE.itemsize + FLEET_TABLE_DTYPE.itemsize)
+                + shards * 8)
+
+    @classmethod
+    def create(cls, names, shards, name=FLEET_TABLE_NAME):
+        """
+        Новая таблица (в супервизоре); таблица, оставшаяся от упавшего супервизора, удаляется.
+        Если её супервизор (pid в заголовке) ещё работает - FileExistsError: второй супервизор
+        отнял бы таблицу у живого и опрашивал бы те же узлы повторно.
+        """
+        from multiprocessing import shared_memory
+        size = cls.size(len(names), shards)
         try:
-            mq2_val = float(requests.get(MQ2_URL, timeout=5).text.strip())
-        except Exception as e:
-            print(f"Ошибка MQ2: {e}")
-        
-        # Восстановление последних валидных значений
-        if not is_valid_value(ppm_val) and last_valid_ppm is not None:
-            ppm_val = last_valid_ppm
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(name=name)
+            pid = 0
+            if stale.size >= FLEET_TABLE_HEADER.itemsize:
+                header = np.ndarray((), dtype=FLEET_TABLE_HEADER, buffer=stale.buf)
+                if header["version"] == FLEET_TABLE_VERSION:
+                    pid = int(header["pid"])
+                del header  # представление держит буфер: без этого close() не освободит его
+            if process_alive(pid):
+                _untrack_shm(stale)
+                stale.close()
+                raise FileExistsError(f"Таблица {name} занята работающим супервизором (pid {pid}); "
+                                      f"читать её можно через FleetTable.attach()") from None
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        header = np.ndarray((), dtype=FLEET_TABLE_HEADER, buffer=shm.buf)
+        header[()] = (FLEET_TABLE_VERSION, len(names), shards, os.getpid())
+        table = cls(shm, owner=True)
+        # Обрезка по границе символа: половина многобайтового символа не декодируется
+        table._names[:] = [n.encode()[:FLEET_NAME_DTYPE.itemsize].decode("utf-8", "ignore").encode()
+                           for n in names]
+        table.rows[:] = np.zeros(1, dtype=FLEET_TABLE_DTYPE)
+        for field in FLEET_TABLE_DTYPE.names[FLEET_TABLE_DTYPE.names.index("fan_rpm"):]:
+            table.rows[field] = np.nan
+        table.heartbeats[:] = 0
+        return table
+
+    @classmethod
+    def attach(cls, name=FLEET_TABLE_NAME):
+        """Подключение к таблице супервизора (шард, дашборд, API); FileNotFoundError, если её нет."""
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(name=name)
+        _untrack_shm(shm)
+        return cls(shm)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def names(self):
+        return [n.decode("utf-8", "ignore") for n in self._names]
+
+    def publish(self, row, ctrl):
+        """Последний отсчёт и состояние узла в его строку (вызывается шардом после каждого тика)."""
+        sample = ctrl.last_sample
+        seq = int(self._seq[row]) + 1
+        self._seq[row] = seq
+        self.rows[row] = (seq, sample.ts, ctrl.polls,
+                          ctrl.smoke_detected, ctrl.last_calibration_time is not None,
+                          sample.smoke_stale or sample.mq2_stale,
+                          ctrl.current_device_state, ctrl.fan_setpoint, ctrl.fan_rpm, sample.latency,
+                          sample.ppm, sample.cur, sample.mq2,
+                          *ctrl.last_filtered, *ctrl.calculate_thresholds())
+        self._seq[row] = seq + 1
+
+    def beat(self, shard):
+        self.heartbeats[shard] = time.time()
+
+    def read(self):
+        """Согласованная копия всех строк: строки, попавшие на запись во время копирования, перечитываются."""
+        data = self.rows.copy()
+        for _ in range(100):
+            torn = np.flatnonzero(((data["seq"] & 1) == 1) | (data["seq"] != self._seq))
+            if not len(torn):
+                break
+            data[torn] = self.rows[torn]
+        return data
+
+    def close(self):
+        # Представления держат ссылку на буфер: без их удаления close() не сможет его освободить
+        self.header = self._names = self.rows = self.heartbeats = self._seq = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def shard_table_lines(names, data, max_rows=None):
+    """Таблица узлов по строкам FleetTable (как fleet_table_lines, но без объектов контроллеров)."""
+    threshold = data["threshold_mq2"]
+    ratio = np.nan_to_num(data["mq2_filtered"] / np.where(threshold > 0, threshold, np.inf))
+    order = np.lexsort((-ratio, data["alarm"] == 0))
+    alarms = int(data["alarm"].sum())
+    lines = [f"Узлов: {len(data)}   тревога: {alarms}   {time.strftime('%H:%M:%S')}",
+             f"{'Узел':<20} {'MQ2':>7} {'порог':>7} {'':22} {'ppm':>6} {'cur':>6} {'вент.':>5} {'мс':>5}  статус"]
+    for i in order[:max_rows]:
+        row = data[i]
+        mq2, threshold_mq2 = float(row["mq2_filtered"]), float(row["threshold_mq2"])
+        if row["ts"] == 0:
+            status = "нет данных"
         else:
-            last_valid_ppm = ppm_val
-        if not is_valid_value(cur_val) and last_valid_cur is not None:
-            cur_val = last_valid_cur
+            status = "КУРЯТ!" if row["alarm"] else ("норма" if row["calibrated"] else "калибровка")
+        lines.append(f"{names[i][:20]:<20} {mq2:>7.1f} {threshold_mq2:>7.1f} {build_bar(mq2, threshold_mq2, 20)} "
+                     f"{row['ppm_filtered']:>6.1f} {row['cur_filtered']:>6.1f} {row['fan']:>5} "
+                     f"{row['latency'] * 1000:>5.0f}  {status}")
+    if max_rows is not None and len(order) > max_rows:
+        lines.append(f"... ещё {len(order) - max_rows} узлов")
+    return lines
+
+async def run_until_stopped(coro):
+    """Выполняет корутину до её завершения или SIGTERM/SIGINT (задача отменяется, finally отрабатывают)."""
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, task.cancel)
+        except NotImplementedError:
+            pass  # Windows: остаётся KeyboardInterrupt
+    try:
+        await coro
+    except asyncio.CancelledError:
+        pass
+
+# Параметры, которые задаются из командной строки и должны дойти до процессов-шардов
+SHARD_SETTINGS = ("ADAPTIVE_SAMPLING", "DETECTORS", "HISTORY_DIR", "SNAPSHOT_DIR")
+
+def shard_worker(shard, devices, rows, interval, settings, table_name=FLEET_TABLE_NAME):
+    """
+    Процесс-шард: свои узлы в одном event loop (FleetScheduler), состояние - в общую таблицу,
+    метка жизни - раз в SHARD_HEARTBEAT_INTERVAL. Снимки состояния и история пишутся как в
+    одиночном режиме, поэтому перезапущенный шард продолжает без калибровки.
+    """
+    globals().update(settings)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C получает вся группа; шарды останавливает супервизор
+    sys.stdout.reconfigure(line_buffering=True)
+    table = FleetTable.attach(table_name)
+    table.beat(shard)
+    scheduler = FleetScheduler(devices, interval=interval, table=table, rows=rows)
+    snapshots = start_snapshots(scheduler.controllers)
+    writer = start_history(scheduler.controllers)
+
+    async def heartbeat():
+        while True:
+            table.beat(shard)
+            await asyncio.sleep(SHARD_HEARTBEAT_INTERVAL)
+
+    async def run():
+        beat = asyncio.get_running_loop().create_task(heartbeat())
+        try:
+            await scheduler.run(summary=False)
+        finally:
+            beat.cancel()
+
+    try:
+        asyncio.run(run_until_stopped(run()))
+    finally:
+        if writer is not None:
+            writer.stop()
+        if snapshots is not None:
+            snapshots.stop()
+        table.close()
+
+class ShardSupervisor:
+    """
+    Парк, разделённый между процессами-шардами (по умолчанию - по числу ядер): каждый шард
+    опрашивает свою часть узлов в своём интерпретаторе, поэтому разбор и детекция не упираются
+    в один GIL. Узлы раздаются по кругу, состояние всех узлов - в FleetTable. Упавший шард или
+    шард без метки жизни дольше SHARD_HEARTBEAT_TIMEOUT перезапускается с нарастающей задержкой.
+    """
+    def __init__(self, devices, shards=None, interval=INTERVAL, settings=None, table_name=FLEET_TABLE_NAME):
+        import multiprocessing
+        self.devices = devices
+        self.shards = max(1, min(shards or FLEET_SHARDS or os.cpu_count() or 1, len(devices)))
+        self.interval = interval
+        self.settings = {name: globals()[name] for name in SHARD_SETTINGS}
+        self.settings.update(settings or {})
+        self.assignment = [list(range(shard, len(devices), self.shards)) for shard in range(self.shards)]
+        self.table = FleetTable.create([name for name, _ in devices], self.shards, table_name)
+        # spawn, а не fork: потоки родителя (метрики, история) не копируются в шард в неопределённом состоянии
+        self._context = multiprocessing.get_context("spawn")
+        self.processes = [None] * self.shards
+        self.started = [0.0] * self.shards
+        self.restarts = [0] * self.shards
+        self._failures = [0] * self.shards
+        self._restart_at = [0.0] * self.shards
+
+    def _spawn(self, shard):
+        rows = self.assignment[shard]
+        self.table.heartbeats[shard] = 0
+        process = self._context.Process(
+            target=shard_worker, name=f"shard-{shard}",
+            args=(shard, [self.devices[i] for i in rows], rows, self.interval, self.settings,
+                  self.table.name))
+        process.start()
+        self.processes[shard] = process
+        self.started[shard] = time.time()
+
+    def check(self):
+        """Проверка шардов: перезапуск упавших и зависших (вызывается периодически из run)."""
+        now = time.time()
+        for shard, process in enumerate(self.processes):
+            if process is None:
+                if now >= self._restart_at[shard]:
+                    self._spawn(shard)
+                    self.restarts[shard] += 1
+                continue
+            beat = max(self.table.heartbeats[shard], self.started[shard])
+            if process.is_alive() and now - beat < SHARD_HEARTBEAT_TIMEOUT:
+                if now - self.started[shard] >= SHARD_STABLE_TIME:
+                    self._failures[shard] = 0
+                continue
+            if process.is_alive():
+                print(f"Шард {shard} не отвечает {now - beat:.0f} с - перезапуск")
+                process.kill()
+            else:
+                print(f"Шард {shard} завершился (код {process.exitcode}) - перезапуск")
+            process.join()
+            self.processes[shard] = None
+            self._restart_at[shard] = now + min(SHARD_RESTART_DELAY * 2 ** self._failures[shard], SHARD_RESTART_MAX)
+            self._failures[shard] += 1
+
+    def summary(self, data, last_polls, elapsed):
+        names = self.table.names
+        alarms = [names[i] for i in np.flatnonzero(data["alarm"])]
+        polls = data["polls"]
+        # Перезапущенный шард считает опросы заново
+        new_polls = np.where(polls >= last_polls, polls - last_polls, polls).sum()
+        return (f"Узлов: {len(data)}, шардов: {sum(p is not None for p in self.processes)}/{self.shards} "
+                f"(перезапусков: {sum(self.restarts)}), опросов/с: {new_polls / elapsed:.1f}, "
+                f"тревога: {', '.join(alarms[:10]) + (' ...' if len(alarms) > 10 else '') if alarms else 'нет'}")
+
+    def run(self, duration=None, table=False):
+        for shard in range(self.shards):
+            self._spawn(shard)
+        renderer = None
+        if table:
+            renderer, period = TerminalRenderer(), 1 / TERMINAL_REFRESH_RATE
         else:
-            last_valid_cur = cur_val
-        if not is_valid_value(mq2_val) and last_valid_mq2 is not None:
-            mq2_val = last_valid_mq2
+            period = FLEET_SUMMARY_INTERVAL
+        stop_at = None if duration is None else time.monotonic() + duration
+        last_report, last_polls = time.monotonic(), self.table.rows["polls"].copy()
+        try:
+            while stop_at is None or time.monotonic() < stop_at:
+                self.check()
+                now = time.monotonic()
+                if now - last_report >= period:
+                    data = self.table.read()
+                    if renderer is not None:
+                        rows = shutil.get_terminal_size().lines - 2
+                        renderer.render(shard_table_lines(self.table.names, data, max(rows, 1)))
+                    else:
+                        print(self.summary(data, last_polls, now - last_report))
+                        last_polls = data["polls"]
+                    last_report = now
+                time.sleep(min(0.5, period))
+        finally:
+            if renderer is not None:
+                renderer.close()
+            self.stop()
+
+    def stop(self):
+        """Штатная остановка: SIGTERM шардам (снимки и история дописываются), затем kill по таймауту."""
+        running = [p for p in self.processes if p is not None]
+        for process in running:
+            process.terminate()
+        for process in running:
+            process.join(SHARD_STOP_TIMEOUT)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        self.processes = [None] * self.shards
+        self.table.close()
+
+# ======================== Воспроизведение и симуляция ===========================
+
+class ReplayClock:
+    """Управляемые часы: время берётся из метки текущего отсчёта трассы."""
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+ReplayReport = namedtuple("ReplayReport", "samples duration wall_time samples_per_sec alarms retriggers "
+                                          "fan_commands events detected missed false_positives latencies polls "
+                                          "requests")
+
+def load_trace(path):
+    """
+    Трасса для воспроизведения: CSV с заголовком ts,ppm,cur,mq2[,event]
+    или каталог истории устройства (HistoryStore). Возвращает словарь NumPy-массивов.
+    """
+    if os.path.isdir(path):
+        data = HistoryStore(path).query(0, float("inf"))
+        return {name: data[name].astype(float) for name in ("ts", "ppm", "cur", "mq2")}
+    table = np.genfromtxt(path, delimiter=",", names=True, dtype=float)
+    return {name: np.atleast_1d(table[name]) for name in table.dtype.names}
+
+def events_from_mask(ts, mask):
+    """Интервалы [начало, конец) истинных событий задымления по колонке event."""
+    mask = np.asarray(mask) > 0
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], mask.astype(np.int8), [0]))))
+    return [(ts[a], ts[b - 1]) for a, b in zip(edges[::2], edges[1::2])]
+
+def synthetic_trace(hours=24, interval=INTERVAL, events=6, spikes=20, seed=0):
+    """
+    Синтетическая трасса: шум датчиков вокруг типичных уровней, эпизоды задымления
+    (рост за ~20 с, затухание за ~5 мин) и одиночные выбросы для оценки ложных срабатываний.
+    """
+    rng = np.random.default_rng(seed)
+    n = int(hours * 3600 / interval)
+    ts = 1_700_000_000 + np.arange(n) * interval
+    smoke = np.zeros(n)
+    event = np.zeros(n)
+    warm = int((CALIBRATION_DURATION + 30 + WARMUP_TIME) / interval) + 1
+    for start in rng.choice(np.arange(warm + 600, n - 900), size=events, replace=False):
+        length = min(int(900 / interval), n - start)
+        t = np.arange(length) * interval
+        smoke[start:start + length] += np.minimum(t / 20, 1) * np.exp(-np.maximum(t - 20, 0) / 300)
+        event[start:start + int(300 / interval)] = 1
+    trace = {
+        "ts": ts,
+        "mq2": 1200 * (1 + 0.5 * smoke) + rng.normal(0, 10, n),
+        "ppm": 12.5 * (1 + 1.0 * smoke) + rng.normal(0, 0.3, n),
+        "cur": 3.2 * (1 + 1.2 * smoke) + rng.normal(0, 0.05, n),
+        "event": event,
+    }
+    for idx in rng.choice(np.arange(warm, n), size=spikes, replace=False):
+        trace["mq2"][idx] *= 1.6
+    return trace
+
+def replay(trace, controller=None, interval=None):
+    """
+    Прогон трассы через ту же логику, что и в работе (fallback, усреднение, пороги,
+    удержание и плавное снижение), с управляемыми часами и максимальной скоростью.
+    Первые CALIBRATION_DURATION секунд трассы идут на калибровку.
+    Без interval и адаптивного опроса обрабатывается каждый отсчёт трассы; иначе - отсчёты,
+    к которым пришёлся бы очередной опрос (трасса должна быть записана чаще интервала опроса).
+    Запросы к узлу считаются как у SensorPoller: два на отсчёт и TELEMETRY_ENDPOINTS раз в
+    telemetry_interval опросчика (в трассе оборотов нет, но бюджет они расходуют).
+    """
+    ts, ppm, cur, mq2 = trace["ts"], trace["ppm"], trace["cur"], trace["mq2"]
+    clock = ReplayClock(ts[0])
+    ctrl = controller or DeviceController("http://replay", clock=clock)
+    ctrl.clock = clock
+    ctrl.log_sink = lambda msg: None
+    fan_commands = []
+    ctrl.command_sender = lambda c, value: fan_commands.append((clock.now, value))
+
+    alarms = []
+    calibrating = True
+    ctrl.start_calibration()
+    ts_list = ts.tolist()
+    rows = list(zip(ts_list, ppm.tolist(), cur.tolist(), mq2.tolist()))
+    paced = interval is not None or ctrl.sampler is not None
+    base = interval or INTERVAL
+    i = polls = requests = 0
+    telemetry_ts = -math.inf
+    start = time.perf_counter()
+    while i < len(rows):
+        row = rows[i]
+        clock.now = row[0]
+        cost = 2
+        if row[0] - telemetry_ts >= ctrl.poller.telemetry_interval:
+            telemetry_ts = row[0]
+            cost += len(TELEMETRY_ENDPOINTS)
+        sample = Sample(row[0], row[1], row[2], row[3], False, False, 0.0, 0.0, None, cost)
+        polls += 1
+        requests += cost
+        if calibrating:
+            ctrl.add_calibration_sample(sample)
+            if row[0] - ts[0] >= CALIBRATION_DURATION:
+                ctrl.finish_calibration()
+                calibrating = False
+            step = base
         else:
-            last_valid_mq2 = mq2_val
-        
-        # Используем datetime для оси X
-        current_time = datetime.now()
-        timestamps.append(current_time)
-        ppm_data.append(ppm_val if is_valid_value(ppm_val) else np.nan)
-        cur_data.append(cur_val if is_valid_value(cur_val) else np.nan)
-        mq2_data.append(mq2_val if is_valid_value(mq2_val) else np.nan)
-        
-        max_len = 100
-        if len(timestamps) > max_len:
-            timestamps[:] = timestamps[-max_len:]
-            ppm_data[:] = ppm_data[-max_len:]
-            cur_data[:] = cur_data[-max_len:]
-            mq2_data[:] = mq2_data[-max_len:]
-        
-        # Преобразуем время в формат для matplotlib
-        x_dates = mdates.date2num(timestamps)
-        
-        # Обновляем 2D графики
-        line_ppm.set_data(x_dates, ppm_data)
-        line_cur.set_data(x_dates, cur_data)
-        line_mq2.set_data(x_dates, mq2_data)
-        
-        threshold_mq2, threshold_ppm, threshold_cur = calculate_thresholds()
-        ppm_threshold_line.set_data(x_dates, [threshold_ppm]*len(x_dates))
-        cur_threshold_line.set_data(x_dates, [threshold_cur]*len(x_dates))
-        mq2_threshold_line.set_data(x_dates, [threshold_mq2]*len(x_dates))
-        
-        for ax, data, thr in zip([ax_ppm, ax_cur, ax_mq2],
-                                 [ppm_data, cur_data, mq2_data],
-                                 [threshold_ppm, threshold_cur, threshold_mq2]):
-            if data:
-                valid_data = [d for d in data if not np.isnan(d)]
-                if valid_data:
-                    y_min = min(valid_data + [thr]) - 10
-                    y_max = max(valid_data + [thr]) + 10
-                    ax.set_ylim(y_min, y_max)
-                    ax.set_xlim(x_dates[0], x_dates[-1])
-                    ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M:%S'))  # формат времени
-        
-        check_smoke(ppm_val, cur_val, mq2_val)
-        
-        # Обновление текста статуса
-        status_msg = (
+            was_detected = ctrl.smoke_detected
+            ctrl.process(sample)
+            if ctrl.smoke_detected != was_detected:
+                if ctrl.smoke_detected:
+                    alarms.append([row[0], float("inf")])
+                else:
+                    alarms[-1][1] = row[0]
+            step = ctrl.next_poll_interval(base) if paced else 0
+        # Следующий отсчёт - первый не раньше момента следующего опроса
+        i = max(i + 1, bisect.bisect_left(ts_list, row[0] + step - 1e-6)) if paced else i + 1
+    wall = time.perf_counter() - start
+
+    events = events_from_mask(ts, trace["event"]) if "event" in trace else []
+    latencies = []
+    for ev_start, ev_end in events:
+        # Тревога, уже активная к началу события, - задержка 0
+        onset = next((max(a, ev_start) for a, off in alarms if a <= ev_end and off >= ev_start), None)
+        if onset is not None:
+            latencies.append(onset - ev_start)
+    # Срабатывание вне событий (и их хвостов) - ложное
+    false_positives = [a for a, _ in alarms
+                       if not any(s <= a <= e + SMOKE_HOLD_DURATION for s, e in events)]
+    # Повторное - началось раньше SMOKE_HOLD_DURATION после конца предыдущей тревоги; внутри хвоста
+    # события оно не считается ложным, но гоняет вентилятор вверх-вниз
+    retriggers = sum(1 for (_, off), (on, _) in zip(alarms, alarms[1:]) if on - off < SMOKE_HOLD_DURATION)
+    return ReplayReport(len(ts), ts[-1] - ts[0], wall, len(ts) / wall if wall > 0 else float("inf"),
+                        len(alarms), retriggers, len(fan_commands), len(events), len(latencies),
+                        len(events) - len(latencies), len(false_positives), latencies, polls, requests)
+
+def print_replay_report(report):
+    print(f"Отсчётов: {report.samples} ({report.duration / 3600:.1f} ч трассы) за {report.wall_time:.2f} с "
+          f"- {report.samples_per_sec:,.0f} отсчётов/с")
+    print(f"Тревог: {report.alarms} (повторных: {report.retriggers}), команд вентилятору: {report.fan_commands}")
+    if report.duration > 0:
+        print(f"Опросов: {report.polls}, запросов к узлу в час: {report.requests / report.duration * 3600:,.0f}")
+    if report.events:
+        print(f"События: {report.events}, обнаружено: {report.detected}, пропущено: {report.missed}, "
+              f"ложных срабатываний: {report.false_positives}")
+        if report.latencies:
+            print(f"Задержка обнаружения: медиана {np.median(report.latencies):.1f} с, "
+                  f"макс. {np.max(report.latencies):.1f} с")
+
+def compare_sampling(trace):
+    """Фиксированный опрос раз в INTERVAL против адаптивного на одной трассе."""
+    fixed_ctrl, adaptive_ctrl = DeviceController("http://replay"), DeviceController("http://replay")
+    fixed_ctrl.sampler, adaptive_ctrl.sampler = None, AdaptiveSampler()
+    reports = [("фиксированный", replay(trace, fixed_ctrl, interval=INTERVAL)),
+               ("адаптивный", replay(trace, adaptive_ctrl))]
+    print(f"{'опрос':<14} {'запросов/ч':>10} {'обнаружено':>10} {'пропущено':>9} {'ложных':>6} "
+          f"{'задержка медиана, с':>19} {'макс., с':>8}")
+    for name, r in reports:
+        median = np.median(r.latencies) if r.latencies else np.nan
+        worst = np.max(r.latencies) if r.latencies else np.nan
+        print(f"{name:<14} {r.requests / r.duration * 3600:>10,.0f} {r.detected:>10} {r.missed:>9} "
+              f"{r.false_positives:>6} {median:>19.2f} {worst:>8.2f}")
+    return reports
+
+def compare_detectors(trace, kinds=None):
+    """Каждый детектор на всех датчиках против процентного порога на одной трассе."""
+    print(f"{'детектор':<10} {'тревог':>6} {'повторных':>9} {'команд':>6} {'обнаружено':>10} {'пропущено':>9} "
+          f"{'ложных':>6} {'задержка медиана, с':>19} {'макс., с':>8} {'отсчётов/с':>10}")
+    reports = []
+    for kind in kinds or DETECTOR_TYPES:
+        ctrl = DeviceController("http://replay")
+        ctrl.detectors = make_detectors({sensor: kind for sensor in ("mq2", "ppm", "cur")})
+        r = replay(trace, ctrl)
+        median = np.median(r.latencies) if r.latencies else np.nan
+        worst = np.max(r.latencies) if r.latencies else np.nan
+        print(f"{kind:<10} {r.alarms:>6} {r.retriggers:>9} {r.fan_commands:>6} {r.detected:>10} {r.missed:>9} "
+              f"{r.false_positives:>6} {median:>19.2f} {worst:>8.2f} {r.samples_per_sec:>10,.0f}")
+        reports.append((kind, r))
+    return reports
+
+controller = DeviceController(URL)
+
+# ======================== Терминальный режим ===========================
+
+Reading = namedtuple("Reading", "sample values filtered thresholds smoke_detected fan fan_setpoint fan_rpm interval")
+
+class AcquisitionThread(threading.Thread):
+    """
+    Опрос ESP32 и детекция в фоновом потоке. GUI/терминал получают готовые отсчёты (Reading)
+    через очередь и никогда не ждут сеть, поэтому интерфейс не замирает, даже если ESP32 отвечает медленно.
+    """
+    def __init__(self, controller, out_queue, interval=INTERVAL, calibrate=True):
+        super().__init__(name="acquisition", daemon=True)
+        self.controller = controller
+        self.queue = out_queue
+        self.interval = interval
+        self.calibrate = calibrate
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        ctrl = self.controller
+        ctrl.actuator.start()
+        try:
+            if self.calibrate and not ctrl.warm_start():
+                ctrl.send_device_command(20, force=True)
+                ctrl.calibrate()
+            next_tick = time.monotonic()
+            while not self._stop_event.is_set():
+                try:
+                    tick_start = time.perf_counter()
+                    sample = ctrl.poller.poll_sync()
+                    values, filtered = ctrl.process(sample)
+                    interval = ctrl.next_poll_interval(self.interval)
+                    if metrics.enabled:
+                        metrics.observe("tick", time.perf_counter() - tick_start)
+                    try:
+                        self.queue.put_nowait(Reading(sample, values, filtered, ctrl.calculate_thresholds(),
+                                                      ctrl.smoke_detected, ctrl.current_device_state,
+                                                      ctrl.fan_setpoint, ctrl.fan_rpm, interval))
+                    except queue.Full:
+                        pass  # интерфейс не успевает - отсчёт останется только в контроллере
+                except Exception as e:
+                    ctrl.log(f"Ошибка опроса: {e}")
+                    interval = self.interval
+                next_tick += interval
+                self._stop_event.wait(max(0, next_tick - time.monotonic()))
+        finally:
+            ctrl.checkpoint()
+            ctrl.poller.close()
+            ctrl.actuator.stop()
+            ctrl.log(ctrl.actuator.summary())
+
+class TerminalRenderer:
+    """
+    Вывод в терминал без clear: курсор ставится ANSI-последовательностью на строку,
+    и перерисовываются только изменившиеся строки. Нет порождения процессов и мерцания,
+    поэтому обновлять экран можно часто (TERMINAL_REFRESH_RATE).
+    Строки обрезаются по ширине терминала: перенесённый хвост попал бы на следующую строку,
+    а та перерисовывается, только если изменилась. При смене размера - полная перерисовка.
+    """
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._lines = None
+        self._size = None
+        if os.name == 'nt':
+            os.system('')  # включает обработку ANSI-последовательностей в консоли Windows
+
+    def render(self, lines):
+        out = []
+        size = shutil.get_terminal_size()
+        if self._lines is None or size != self._size:
+            out.append("\x1b[?25l\x1b[2J")  # скрыть курсор, очистить экран (при старте и смене размера)
+            self._lines = []
+            self._size = size
+        lines = [line[:size.columns] for line in lines]
+        previous = self._lines
+        for i, line in enumerate(lines):
+            if i >= len(previous) or previous[i] != line:
+                out.append(f"\x1b[{i + 1};1H{line}\x1b[K")
+        for i in range(len(lines), len(previous)):
+            out.append(f"\x1b[{i + 1};1H\x1b[K")
+        self._lines = list(lines)
+        if out:
+            self.stream.write("".join(out))
+            self.stream.flush()
+        return len(out)
+
+    def close(self):
+        rows = len(self._lines or ())
+        self.stream.write(f"\x1b[{rows + 1};1H\x1b[?25h\n")
+        self.stream.flush()
+
+class LogTail:
+    """Последние сообщения для вывода внизу экрана вместо print поверх отрисовки."""
+    def __init__(self, size=TERMINAL_LOG_LINES):
+        self.lines = deque(maxlen=size)
+
+    def __call__(self, msg):
+        for line in str(msg).splitlines():
+            self.lines.append(f"{time.strftime('%H:%M:%S')} {line}")
+
+@functools.lru_cache(maxsize=None)
+def _bar(filled, width):
+    return "[" + "#" * filled + "-" * (width - filled) + "]"
+
+def build_bar(value, threshold, width=50):
+    """Создает строку-полоску для отображения соотношения value/threshold."""
+    if not is_valid_value(value) or not is_valid_value(threshold):
+        return _bar(0, width)
+    ratio = value / threshold if threshold > 0 else 0
+    if np.isnan(ratio):
+        ratio = 0
+    ratio = min(max(ratio, 0), 1)
+    return _bar(int(ratio * width), width)
+
+def sparkline(values):
+    """Строка тренда из блочных символов; nan - пробел."""
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0 or np.isnan(values).all():
+        return ""
+    lo, hi = np.nanmin(values), np.nanmax(values)
+    levels = np.zeros(len(values), dtype=int) if hi == lo else ((values - lo) / (hi - lo) * 7).round()
+    return "".join(" " if np.isnan(v) else SPARK_CHARS[int(level)] for v, level in zip(values, levels))
+
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+# Тренд MQ2 для терминала (заполняется с диска при старте)
+trend = RingBuffer(TREND_WIDTH, fields=("mq2",))
+
+def update_terminal(renderer, reading, log_tail):
+    """Обновление псевдографики в терминале; reading - последний отсчёт или None до конца калибровки."""
+    if reading is None:
+        lines = ["+" * 79, "Калибровка датчиков..."]
+    else:
+        mq2_filtered, ppm_filtered, cur_filtered = reading.filtered
+        threshold_mq2, threshold_ppm, threshold_cur = reading.thresholds
+        sample = reading.sample
+        status = "КУРЯТ!" if reading.smoke_detected else "НЕ КУРЯТ"
+        lines = [
+            "+" * 79,
+            f"MQ2: {mq2_filtered:.1f} {build_bar(mq2_filtered, threshold_mq2)} (Порог: {threshold_mq2:.1f})",
+            f"PPM: {ppm_filtered:.1f} {build_bar(ppm_filtered, threshold_ppm)} (Порог: {threshold_ppm:.1f})",
+            f"CUR: {cur_filtered:.1f} {build_bar(cur_filtered, threshold_cur)} (Порог: {threshold_cur:.1f})",
+            f"Тренд MQ2: {sparkline(trend.view('mq2'))}",
+            f"СТАТУС: {status}    Вентилятор: {reading.fan}%"
+            f"{'' if reading.fan == reading.fan_setpoint else f' (уставка {reading.fan_setpoint}%)'}"
+            f"{'' if np.isnan(reading.fan_rpm) else f', {reading.fan_rpm:.0f} об/мин'}",
+            f"Задержка опроса: {sample.latency * 1000:.0f} мс, интервал {reading.interval:g} с"
+            f"{' (устаревшие данные)' if sample.smoke_stale or sample.mq2_stale else ''}",
+        ]
+    lines.append("")
+    lines.extend(log_tail.lines)
+    if metrics.enabled:
+        start = time.perf_counter()
+        renderer.render(lines)
+        metrics.observe("terminal_render", time.perf_counter() - start)
+    else:
+        renderer.render(lines)
+
+def fleet_table_lines(controllers, max_rows=None):
+    """Таблица состояния всех узлов: сначала тревоги, затем по близости MQ2 к порогу."""
+    def ratio(ctrl):
+        mq2 = ctrl.last_filtered[0] if ctrl.last_filtered else np.nan
+        threshold = ctrl.calculate_thresholds()[0]
+        return mq2 / threshold if threshold > 0 and is_valid_value(mq2) else 0
+
+    ordered = sorted(controllers, key=lambda c: (not c.smoke_detected, -ratio(c)))
+    alarms = sum(c.smoke_detected for c in controllers)
+    lines = [f"Узлов: {len(controllers)}   тревога: {alarms}   {time.strftime('%H:%M:%S')}",
+             f"{'Узел':<20} {'MQ2':>7} {'порог':>7} {'':22} {'ppm':>6} {'cur':>6} {'вент.':>5} {'мс':>5}  статус"]
+    for ctrl in ordered[:max_rows]:
+        mq2, ppm, cur = ctrl.last_filtered or (np.nan, np.nan, np.nan)
+        threshold_mq2 = ctrl.calculate_thresholds()[0]
+        latency = ctrl.last_sample.latency * 1000 if ctrl.last_sample else np.nan
+        status = "КУРЯТ!" if ctrl.smoke_detected else ("калибровка" if ctrl.last_calibration_time is None else "норма")
+        lines.append(f"{ctrl.name[:20]:<20} {mq2:>7.1f} {threshold_mq2:>7.1f} {build_bar(mq2, threshold_mq2, 20)} "
+                     f"{ppm:>6.1f} {cur:>6.1f} {ctrl.current_device_state:>5} {latency:>5.0f}  {status}")
+    if max_rows is not None and len(ordered) > max_rows:
+        lines.append(f"... ещё {len(ordered) - max_rows} узлов")
+    return lines
+
+# ======================== Режим GUI: Объединённое окно (2D слева, 3D справа) ===========================
+def format_epoch(x, pos=None):
+    """Подпись оси времени: ось X хранит epoch-секунды, без конвертации в даты matplotlib."""
+    return time.strftime("%H:%M:%S", time.localtime(x))
+
+GuiFigure = namedtuple("GuiFigure", "fig ax_ppm ax_cur ax_mq2 ax3d lines status_text")
+
+def build_figure():
+    """
+    Окно GUI: 2D-графики слева, 3D справа. matplotlib импортируется здесь, а не при загрузке модуля,
+    поэтому демон и терминальный режим не тратят на него время запуска и память и не требуют дисплея.
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib import gridspec
+    from matplotlib.ticker import FuncFormatter
+    from mpl_toolkits.mplot3d import Axes3D  # noqa: F401 - регистрирует проекцию '3d'
+
+    # Создаем одну фигуру с двумя столбцами
+    fig = plt.figure(figsize=(16, 9))
+    gs = gridspec.GridSpec(1, 2, width_ratios=[1, 1])
+
+    # Левый столбец: 2D графики, организованные в 3 ряда
+    gs_left = gridspec.GridSpecFromSubplotSpec(3, 1, subplot_spec=gs[0])
+    ax_ppm = fig.add_subplot(gs_left[0, 0])
+    ax_cur = fig.add_subplot(gs_left[1, 0])
+    ax_mq2 = fig.add_subplot(gs_left[2, 0])
+    status_text = ax_ppm.text(0.5, 0.9, "", transform=ax_ppm.transAxes, ha='center', fontsize=12)
+    # Настройка подписей для 2D графиков
+    ax_ppm.set_title("Датчик PPM")
+    ax_ppm.set_xlabel("Время", position=(0, -10))
+    ax_ppm.set_ylabel("PPM")
+    ax_cur.set_title("Датчик CUR")
+    ax_cur.set_xlabel("Время", position=(0, -10))
+    ax_cur.set_ylabel("CUR")
+    ax_mq2.set_title("Датчик MQ2")
+    ax_mq2.set_xlabel("Время", position=(0, -10))
+    ax_mq2.set_ylabel("MQ2")
+    for ax in (ax_ppm, ax_cur, ax_mq2):
+        ax.xaxis.set_major_formatter(FuncFormatter(format_epoch))  # формат времени
+
+    # Правый столбец: 3D график
+    ax3d = fig.add_subplot(gs[1], projection='3d')
+
+    # Линии для 2D графиков
+    line_ppm, = ax_ppm.plot([], [], color='orange', label="PPM")
+    line_cur, = ax_cur.plot([], [], color='blue', label="CUR")
+    line_mq2, = ax_mq2.plot([], [], color='green', label="MQ2")
+
+    ppm_threshold_line = ax_ppm.plot([], [], 'r--', label='Threshold')[0]
+    cur_threshold_line = ax_cur.plot([], [], 'r--', label='Threshold')[0]
+    mq2_threshold_line = ax_mq2.plot([], [], 'r--', label='Threshold')[0]
+
+    lines = ((ax_ppm, line_ppm, ppm_threshold_line, "ppm"),
+             (ax_cur, line_cur, cur_threshold_line, "cur"),
+             (ax_mq2, line_mq2, mq2_threshold_line, "mq2"))
+    return GuiFigure(fig, ax_ppm, ax_cur, ax_mq2, ax3d, lines, status_text)
+
+class BlitRenderer:
+    """
+    Отрисовка GUI с блиттингом: фон (оси, подписи, 3D-поверхность) кэшируется,
+    каждый кадр перерисовываются только линии и статус. Полная перерисовка - только
+    при сдвиге осей или перестроении 3D-поверхности (раз в SURFACE_REFRESH_INTERVAL).
+    Линии берутся из LODHistory по ширине оси в пикселях, поэтому окно в часы и сутки
+    рисуется так же быстро, как в минуты; клавиши -/+ меняют окно в LOD_FACTOR раз.
+    """
+    def __init__(self, figure, data_queue, history):
+        self.figure = figure
+        self.fig = figure.fig
+        self.canvas = figure.fig.canvas
+        self.queue = data_queue
+        self.history = history
+        self.lines = figure.lines
+        self.status_text = figure.status_text
+        self.animated = [a for _, line, thr, _ in self.lines for a in (line, thr)] + [self.status_text]
+        for artist in self.animated:
+            artist.set_animated(True)
+        self.thresholds = (np.nan, np.nan, np.nan)
+        self.smoke_detected = False
+        self.frame_times = deque(maxlen=100)
+        self._background = None
+        self._last_surface = 0
+        self.window = GUI_WINDOW
+        self._rezoom = False
+        self._widths = {}
+        self.canvas.mpl_connect("draw_event", self._on_draw)
+        self.canvas.mpl_connect("key_press_event", self._on_key)
+        self.status_text.set_text("\nКалибровка датчиков...")
+
+    def _on_draw(self, event):
+        self._background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self._widths = {field: max(int(ax.get_window_extent().width), 1) for ax, _, _, field in self.lines}
+        self._draw_animated()
+
+    def _on_key(self, event):
+        if event.key in ("-", "+", "="):
+            longest = LOD_CAPACITY * INTERVAL * LOD_FACTOR ** LOD_LEVELS
+            scale = LOD_FACTOR if event.key == "-" else 1 / LOD_FACTOR
+            self.window = min(max(self.window * scale, GUI_WINDOW_MIN), longest)
+            self._rezoom = True
+            self._last_surface = 0
+
+    def _draw_animated(self):
+        for artist in self.animated:
+            self.fig.draw_artist(artist)
+
+    def _drain(self):
+        count = 0
+        while True:
+            try:
+                reading = self.queue.get_nowait()
+            except queue.Empty:
+                return count
+            ppm_val, cur_val, mq2_val = reading.values
+            self.thresholds, self.smoke_detected = reading.thresholds, reading.smoke_detected
+            self.history.append(reading.sample.ts,
+                                ppm_val if is_valid_value(ppm_val) else np.nan,
+                                cur_val if is_valid_value(cur_val) else np.nan,
+                                mq2_val if is_valid_value(mq2_val) else np.nan)
+            count += 1
+
+    def _update_artists(self):
+        """Обновляет данные линий; True, если сдвинулись пределы осей и нужна полная перерисовка."""
+        last = self.history.timestamps[-1]
+        threshold_mq2, threshold_ppm, threshold_cur = self.thresholds
+        thresholds = {"ppm": threshold_ppm, "cur": threshold_cur, "mq2": threshold_mq2}
+        relimit = self._rezoom
+        x_min, x_max = self.figure.ax_ppm.get_xlim()
+        if relimit or last > x_max:
+            # Окно по X с запасом справа: ось сдвигается скачком, а не каждый отсчёт
+            x_max = last + 0.2 * self.window
+            x_min = x_max - self.window
+            relimit = True
+        self._rezoom = False
+        for ax, line, thr_line, field in self.lines:
+            x_vals, data = self.history.series(field, x_min, x_max, self._widths.get(field, 800))
+            thr = thresholds[field]
+            line.set_data(x_vals, data)
+            thr_line.set_data((x_min, x_max), (thr, thr))
+            if relimit:
+                ax.set_xlim(x_min, x_max)
+            if np.isnan(data).all():
+                continue
+            y_min, y_max = min(np.nanmin(data), thr) - 10, max(np.nanmax(data), thr) + 10
+            cur_min, cur_max = ax.get_ylim()
+            if relimit or y_min < cur_min or y_max > cur_max:
+                pad = 0.1 * (y_max - y_min)
+                ax.set_ylim(y_min - pad, y_max + pad)
+                relimit = True
+        self.status_text.set_text(
             "\n"
             f"Порог MQ2: {threshold_mq2:.1f}, ppm: {threshold_ppm:.1f}, cur: {threshold_cur:.1f}    "
-            f"СТАТУС: {'КУРЯТ!' if smoke_detected else 'НЕ КУРЯТ'}"
+            f"СТАТУС: {'КУРЯТ!' if self.smoke_detected else 'НЕ КУРЯТ'}"
         )
-        status_text.set_text(status_msg)
-        status_text.set_color('red' if smoke_detected else 'green')
-        status_text.set_zorder(100)
-        
-        # Преобразуем время в формат для matplotlib
-        x_vals = mdates.date2num(timestamps)
-        
-        # Проверим данные перед построением графика
-        if len(x_vals) == 0 or len(ppm_data) == 0 or len(cur_data) == 0 or len(mq2_data) == 0:
-            print("Ошибка: данные пусты, график не будет построен")
-            return
-        
-        # Выводим данные перед фильтрацией
-#        print(f"Данные перед фильтрацией: ")
-#        print(f"x_vals: {len(x_vals)}, ppm_data: {len(ppm_data)}, cur_data: {len(cur_data)}, mq2_data: {len(mq2_data)}")
-        
-        # Фильтрация данных (убираем nan-значения)
-        valid_mask = (~np.isnan(x_vals)) & (~np.isnan(ppm_data)) & (~np.isnan(cur_data)) & (~np.isnan(mq2_data))
-        x_vals = x_vals[valid_mask]
-        ppm_vals = np.array(ppm_data)[valid_mask]
-        cur_vals = np.array(cur_data)[valid_mask]
-        mq2_vals = np.array(mq2_data)[valid_mask]
-        mq2_vals = mq2_vals / 10
-
-        
-        # Если после фильтрации данных мало, пропускаем отрисовку
-        if len(x_vals) < 3:
-            print("Недостаточно данных для построения 3D графика")
-            return
-        
-        # Проверим, что фильтрация дала данные
-#        print(f"Данные после фильтрации: ")
-#        print(f"x_vals: {len(x_vals)}, ppm_vals: {len(ppm_vals)}, cur_vals: {len(cur_vals)}, mq2_vals: {len(mq2_vals)}")
-        
-        # Подготовка данных для 3D
-        x_vals_flat = np.tile(x_vals, 3)  # Все данные по оси X
-        y_vals_flat = np.concatenate([np.zeros(len(ppm_vals)), np.ones(len(cur_vals)), np.full(len(mq2_vals), 2)])  # Y для PPM, CUR и MQ2
-        z_vals_flat = np.concatenate([ppm_vals, cur_vals, mq2_vals])  # Z-значения: PPM, CUR и MQ2
-        
-        # Удаляем старые графики и рисуем новые
-        ax3d.cla()  # Очистка оси перед новым рисованием
-
-        # Рисуем новые поверхности с меньшей прозрачностью и улучшенными цветами
-        ax3d.plot_trisurf(x_vals_flat, y_vals_flat, z_vals_flat, cmap='viridis', edgecolor='none', alpha=0.7)
-        
-        # Подписи на осях
-        ax3d.set_xticks(np.linspace(x_vals[0], x_vals[-1], num=5))
-        ax3d.set_xticklabels([mdates.num2date(t).strftime("%H:%M:%S") for t in np.linspace(x_vals[0], x_vals[-1], num=5)], rotation=45, ha='right')
-        ax3d.set_zticks([0, 1, 2])
-        ax3d.set_zticklabels(['PPM', 'CUR', 'MQ2'])
-
-        # Обновление графика
-        fig.canvas.draw()
-
-    except Exception as e:
-        print(f"Ошибка в update_plots: {e}")
-    return []
+        self.status_text.set_color('red' if self.smoke_detected else 'green')
+        self.status_text.set_zorder(100)
+        return relimit
+
+    def frame(self):
+        start = time.perf_counter()
+        try:
+            if self._drain() or (self._rezoom and len(self.history)):
+                full_redraw = self._update_artists()
+                if (time.monotonic() - self._last_surface >= SURFACE_REFRESH_INTERVAL
+                        and update_surface(self.figure.ax3d, self.history, self.window)):
+                    self._last_surface = time.monotonic()
+                    full_redraw = True
+                if full_redraw or self._background is None:
+                    self.canvas.draw_idle()  # фон пересохранится в _on_draw
+                else:
+                    self.canvas.restore_region(self._background)
+                    self._draw_animated()
+                    self.canvas.blit(self.fig.bbox)
+                self.frame_times.append(time.perf_counter() - start)
+                if metrics.enabled:
+                    metrics.observe("gui_frame", self.frame_times[-1], redraw="full" if full_redraw else "blit")
+        except Exception as e:
+            print(f"Ошибка отрисовки: {e}")
+
+def update_surface(ax3d, history, window):
+    """
+    Перестроение 3D-поверхности по последним window секундам истории; False, если данных ещё мало.
+    Триангуляция - по LOD_SURFACE_POINTS точкам (LTTB), а не по всем отсчётам окна.
+    """
+    if not len(history):
+        return False
+    last = history.timestamps[-1]
+    ts, ppm_data, cur_data, mq2_data = history.points(last - window, last, LOD_SURFACE_POINTS)
+    # Фильтрация данных (убираем nan-значения)
+    valid_mask = ~(np.isnan(ppm_data) | np.isnan(cur_data) | np.isnan(mq2_data))
+    x_vals = ts[valid_mask]
+    ppm_vals = ppm_data[valid_mask]
+    cur_vals = cur_data[valid_mask]
+    mq2_vals = mq2_data[valid_mask] / 10
+
+    # Если после фильтрации данных мало, пропускаем отрисовку
+    if len(x_vals) < 3:
+        return False
+
+    # Подготовка данных для 3D
+    x_vals_flat = np.tile(x_vals, 3)  # Все данные по оси X
+    y_vals_flat = np.concatenate([np.zeros(len(ppm_vals)), np.ones(len(cur_vals)), np.full(len(mq2_vals), 2)])  # Y для PPM, CUR и MQ2
+    z_vals_flat = np.concatenate([ppm_vals, cur_vals, mq2_vals])  # Z-значения: PPM, CUR и MQ2
+
+    # Удаляем старые графики и рисуем новые
+    ax3d.cla()  # Очистка оси перед новым рисованием
+
+    # Рисуем новые поверхности с меньшей прозрачностью и улучшенными цветами
+    ax3d.plot_trisurf(x_vals_flat, y_vals_flat, z_vals_flat, cmap='viridis', edgecolor='none', alpha=0.7)
+
+    # Подписи на осях
+    ax3d.set_xticks(np.linspace(x_vals[0], x_vals[-1], num=5))
+    ax3d.set_xticklabels([format_epoch(t) for t in np.linspace(x_vals[0], x_vals[-1], num=5)], rotation=45, ha='right')
+    ax3d.set_zticks([0, 1, 2])
+    ax3d.set_zticklabels(['PPM', 'CUR', 'MQ2'])
+    return True
 
 
 # ======================== Режимы работы ===========================
 def gui_mode():
-    send_device_command(20, force=True)
-    calibrate_sensor()
-    ani = FuncAnimation(fig, update_plots, interval=int(INTERVAL * 1000), blit=False)
+    # Калибровка и опрос - в фоновом потоке, окно доступно сразу
+    import matplotlib.pyplot as plt
+    figure = build_figure()
+    # Данные для графиков: буферы LOD занимают несколько мегабайт - только в режиме GUI
+    history = LODHistory()
+    data_queue = queue.Queue(maxsize=GUI_QUEUE_SIZE)
+    acquisition = AcquisitionThread(controller, data_queue)
+    renderer = BlitRenderer(figure, data_queue, history)
+    snapshots = start_snapshots([controller])
+    writer = start_history([controller])
+    if writer is not None:
+        backfill(history, controller.recorder, GUI_BACKFILL)
+    timer = figure.fig.canvas.new_timer(interval=int(GUI_FRAME_INTERVAL * 1000))
+    timer.add_callback(renderer.frame)
     plt.tight_layout()
+    acquisition.start()
+    timer.start()
     plt.show()
+    timer.stop()
+    acquisition.stop()
+    acquisition.join(POLL_DEADLINE + INTERVAL)
+    if writer is not None:
+        writer.stop()
+    if snapshots is not None:
+        snapshots.stop()
 
 def terminal_mode():
-    send_device_command(20, force=True)
-    calibrate_sensor()
+    snapshots = start_snapshots([controller])
+    writer = start_history([controller])
+    if writer is not None:
+        backfill(trend, controller.recorder, TREND_WIDTH * INTERVAL)
+    # Сообщения контроллера - в хвост лога под таблицей, а не print поверх экрана
+    log_tail = LogTail()
+    controller.log_sink = log_tail
+    data_queue = queue.Queue(maxsize=GUI_QUEUE_SIZE)
+    acquisition = AcquisitionThread(controller, data_queue)
+    renderer = TerminalRenderer()
+    reading = None
+    acquisition.start()
     try:
         while True:
-            update_terminal()
-            time.sleep(INTERVAL)
+            while True:
+                try:
+                    reading = data_queue.get_nowait()
+                except queue.Empty:
+                    break
+                mq2_val = reading.values[2]
+                trend.append(reading.sample.ts, mq2_val if is_valid_value(mq2_val) else np.nan)
+            update_terminal(renderer, reading, log_tail)
+            time.sleep(1 / TERMINAL_REFRESH_RATE)
     except KeyboardInterrupt:
+        pass
+    finally:
+        acquisition.stop()
+        acquisition.join(POLL_DEADLINE + INTERVAL)
+        renderer.close()
         print("Выход из терминального режима.")
+        if writer is not None:
+            writer.stop()
+        if snapshots is not None:
+            snapshots.stop()
+
+def sharded_mode(devices, shards, table=False):
+    """Парк по процессам-шардам под ShardSupervisor; остановка по Ctrl+C или SIGTERM."""
+    try:
+        supervisor = ShardSupervisor(devices, shards=shards)
+    except FileExistsError as e:
+        print(f"Ошибка: {e}")
+        sys.exit(1)
+    print(f"Узлов: {len(devices)}, шардов: {supervisor.shards}, таблица состояния: {supervisor.table.name}")
+    signal.signal(signal.SIGTERM, signal.default_int_handler)  # как Ctrl+C: finally в run останавливает шарды
+    try:
+        supervisor.run(table=table)
+    except KeyboardInterrupt:
+        pass
+
+def fleet_mode(devices_path, table=False, shards=None):
+    """
+    Опрос всех узлов из списка устройств в одном процессе или, с shards, по процессам-шардам;
+    table - таблица узлов в терминале.
+    """
+    devices = load_devices(devices_path)
+    print(f"Узлов в списке: {len(devices)}")
+    if shards is not None:
+        sharded_mode(devices, shards, table)
+        print("Выход из мультиустройственного режима.")
+        return
+    scheduler = FleetScheduler(devices)
+    snapshots = start_snapshots(scheduler.controllers)
+    writer = start_history(scheduler.controllers)
+    try:
+        asyncio.run(scheduler.run(table=table))
+    except KeyboardInterrupt:
+        print("Выход из мультиустройственного режима.")
+    finally:
+        if writer is not None:
+            writer.stop()
+        if snapshots is not None:
+            snapshots.stop()
+
+def daemon_mode(devices_path=None, shards=None):
+    """
+    Служба без интерфейса: опрос, детекция, вентилятор, история и метрики - без matplotlib и дисплея.
+    Один узел URL или список devices= (с shards - по процессам-шардам);
+    завершается по SIGTERM/SIGINT с записью истории на диск.
+    """
+    sys.stdout.reconfigure(line_buffering=True)  # журнал службы не должен застревать в буфере
+    devices = load_devices(devices_path) if devices_path else [(device_history_name(URL), URL)]
+    if shards is not None:
+        print(f"Служба запущена, узлов: {len(devices)}")
+        sharded_mode(devices, shards)
+        print("Служба остановлена.")
+        return
+    scheduler = FleetScheduler(devices)
+    snapshots = start_snapshots(scheduler.controllers)
+    writer = start_history(scheduler.controllers)
+
+    print(f"Служба запущена, узлов: {len(devices)}")
+    try:
+        asyncio.run(run_until_stopped(scheduler.run()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if writer is not None:
+            writer.stop()
+        if snapshots is not None:
+            snapshots.stop()
+        print("Служба остановлена.")
+
+def replay_mode(source, compare=False, detectors=None):
+    """
+    Воспроизведение трассы (CSV, каталог истории или synthetic[:часы]) и отчёт.
+    compare - сравнение адаптивного опроса с фиксированным (синтетическая трасса
+    строится с шагом SAMPLING_MIN_INTERVAL, записанная должна быть не реже).
+    detectors="compare" - сравнение детекторов на трассе.
+    """
+    if source.startswith("synthetic"):
+        hours = float(source.partition(":")[2] or 24)
+        trace = synthetic_trace(hours, interval=SAMPLING_MIN_INTERVAL if compare else INTERVAL)
+    else:
+        trace = load_trace(source)
+    if detectors == "compare":
+        compare_detectors(trace)
+    elif compare:
+        compare_sampling(trace)
+    else:
+        print_replay_report(replay(trace))
 
 def print_help():
     help_msg = (
         "Использование:\n"
-        "  python3 script.py [--help] [gui=true|false]\n\n"
+        "  python3 script.py [--help] [gui=true|false] [daemon] [devices=devices.json [shards=N]] [replay=trace.csv] [web=PORT]\n\n"
         "Опции:\n"
         "  --help         Вывод этой справки\n"
         "  gui=true       Запуск в графическом режиме (по умолчанию)\n"
         "  gui=false      Запуск в терминальном режиме (псевдографика)\n"
+        "  daemon         Служба без интерфейса (без matplotlib), с devices= - для всех узлов\n"
+        "  devices=FILE   Опрос нескольких ESP32 из JSON-списка устройств (без GUI)\n"
+        "  view=table     С devices=: таблица состояния всех узлов в терминале\n"
+        "  shards=N|auto  С devices= или daemon: узлы по N процессам (auto - по числу ядер),\n"
+        "                 состояние парка - в разделяемой памяти (FLEET_TABLE_NAME)\n"
+        "  replay=SRC     Прогон трассы через детекцию: CSV (ts,ppm,cur,mq2[,event]),\n"
+        "                 каталог истории или synthetic[:часы]\n"
+        "  sampling=adaptive  Интервал опроса по состоянию воздуха (SAMPLING_MIN_INTERVAL..\n"
+        "                 SAMPLING_MAX_INTERVAL); с replay= - сравнение с фиксированным опросом\n"
+        "  detectors=SPEC Детекторы: threshold|ewma|cusum|zscore для всех датчиков или\n"
+        "                 по датчикам (mq2:cusum,ppm:ewma); с replay= detectors=compare -\n"
+        "                 сравнение детекторов на трассе\n"
+        "  metrics=PORT   Замеры этапов цикла: /metrics (Prometheus) на порту PORT\n"
+        "                 (metrics=true - порт по умолчанию) и строка сводки в консоли\n"
+        "  web=PORT       Веб-дашборд на http://DASHBOARD_HOST:PORT/ (web=true - порт по умолчанию):\n"
+        "                 таблица узлов и график, обновления по WebSocket без лишних запросов к ESP32\n"
     )
     print(help_msg)
 
@@ -502,6 +3467,43 @@ if __name__ == "__main__":
         print_help()
         sys.exit(0)
     
+    metrics_arg = next((a.split("=", 1)[1] for a in sys.argv[1:] if a.startswith("metrics=")), None)
+    if metrics_arg and metrics_arg.lower() not in ("false", "0"):
+        enable_metrics(METRICS_PORT if metrics_arg.lower() == "true" else int(metrics_arg))
+
+    sampling_arg = next((a.split("=", 1)[1] for a in sys.argv[1:] if a.startswith("sampling=")), None)
+    if sampling_arg == "adaptive":
+        ADAPTIVE_SAMPLING = True
+        controller.sampler = AdaptiveSampler()
+
+    detectors_arg = next((a.split("=", 1)[1] for a in sys.argv[1:] if a.startswith("detectors=")), None)
+    if detectors_arg and detectors_arg != "compare":
+        DETECTORS = parse_detectors(detectors_arg)
+        controller.detectors = make_detectors()
+
+    replay_arg = next((a.split("=", 1)[1] for a in sys.argv[1:] if a.startswith("replay=")), None)
+    if replay_arg:
+        replay_mode(replay_arg, compare=ADAPTIVE_SAMPLING, detectors=detectors_arg)
+        sys.exit(0)
+
+    devices_arg = next((a.split("=", 1)[1] for a in sys.argv[1:] if a.startswith("devices=")), None)
+    shards_arg = next((a.split("=", 1)[1] for a in sys.argv[1:] if a.startswith("shards=")), None)
+    shards = None if shards_arg is None else (0 if shards_arg == "auto" else int(shards_arg))
+
+    web_arg = next((a.split("=", 1)[1] for a in sys.argv[1:] if a.startswith("web=")), None)
+    if web_arg and web_arg.lower() not in ("false", "0"):
+        if shards is not None:
+            print("Дашборд с shards= не поддерживается: узлы опрашиваются в других процессах, "
+                  "состояние парка - в разделяемой памяти (FLEET_TABLE_NAME).")
+        else:
+            enable_dashboard(DASHBOARD_PORT if web_arg.lower() == "true" else int(web_arg))
+    if "daemon" in sys.argv:
+        daemon_mode(devices_arg, shards=shards)
+        sys.exit(0)
+    if devices_arg:
+        fleet_mode(devices_arg, table="view=table" in sys.argv, shards=shards)
+        sys.exit(0)
+
     gui_mode_flag = True
     if "gui=false" in sys.argv or "gui=0" in sys.argv or "nogui" in sys.argv:
         gui_mode_flag = False